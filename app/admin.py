@@ -1,57 +1,79 @@
 import os
+import time
+import logging
+import zipfile
 import aiohttp
-import asyncpg
 import asyncio
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types
-from aiogram.types import ContentType
+from aiogram import types
+from aiogram.types import ContentType, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils.exceptions import MessageNotModified, FileIsTooBig
 from aiogram.utils import executor
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+import webhook
+import metrics
+import bots
+import db
+import images
+import broadcast
+from sender import ThrottledBot
+import sales
+from product_import import ImportFileError, ImageArchive, read_rows, import_products
 
 # Загружаем переменные окружения
 load_dotenv()
-bot_token = os.getenv('BOT_TOKEN')
-imgbb_api_key = os.getenv('IMGBB_API_KEY')
 
-bot = Bot(token=bot_token)
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
+# Сколько фото загружается одновременно при импорте
+IMPORT_CONCURRENCY = int(os.getenv('IMPORT_CONCURRENCY', 8))
+# Как часто обновлять сообщение с прогрессом импорта (в секундах)
+IMPORT_PROGRESS_INTERVAL = 3
+# Сколько ошибок импорта показывать в отчёте
+IMPORT_ERRORS_SHOWN = 20
+# Сколько сообщений рассылки отправляется одновременно и не чаще скольких в секунду
+# (остаток общего лимита Telegram остаётся пользовательскому боту)
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 50))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+# Лимит Telegram на длину подписи к фото
+CAPTION_LIMIT = 1024
+# Период /stats по умолчанию и наибольший (в днях, по строке на день в одном сообщении),
+# сколько товаров показывать и до скольких символов сокращать их названия
+STATS_DAYS = 7
+STATS_MAX_DAYS = 60
+STATS_TOP_PRODUCTS = 10
+STATS_NAME_LENGTH = 40
+# Как часто статистика продаж сверяется с заказами (в секундах)
+SALES_RECONCILE_INTERVAL = int(os.getenv('SALES_RECONCILE_INTERVAL', 24 * 60 * 60))
+
+# Бот, хранилище состояний и диспетчер создаются в setup() при запуске
+bot = None
+storage = None
+dp = None
+handlers = bots.Handlers()
+# Пользовательский бот: рассылки получают его пользователи, поэтому и отправляет их он
+shop_bot = None
 
 db_pool = None
+http_session = None  # Общая сессия для загрузки изображений
+image_store = None  # Хранилище фото товаров (imgbb или локальный каталог)
+broadcast_tasks = {}  # id рассылки -> задача отправки
+sales_tasks = []  # Свёртка заказов в статистику продаж и сверка
 
-async def create_db_pool():
-    global db_pool
-    db_pool = await asyncpg.create_pool(
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        database=os.getenv('DB_NAME'),
-        host=os.getenv('DB_HOST'),
-        port=os.getenv('DB_PORT'),
-        min_size=1,
-        max_size=10
-    )
+# Создаёт бота и диспетчер с хендлерами этого модуля (повторный вызов ничего не меняет)
+def setup():
+    global bot, storage, dp, shop_bot
+    if dp is None:
+        # У админ-бота свой токен (ADMIN_BOT_TOKEN), BOT_TOKEN — токен пользовательского бота
+        admin_token = os.getenv('ADMIN_BOT_TOKEN')
+        bot, storage, dp = bots.create('admin', handlers, admin_token)
+        shop_bot = ThrottledBot(token=os.getenv('BOT_TOKEN')) if admin_token and admin_token != os.getenv('BOT_TOKEN') else bot
 
-async def upload_to_imgbb(image_path):
-    url = "https://api.imgbb.com/1/upload"
-    async with aiohttp.ClientSession() as session:
-        with open(image_path, "rb") as file:
-            form = aiohttp.FormData()
-            form.add_field("key", imgbb_api_key)
-            form.add_field("image", file, filename=image_path)
-            async with session.post(url, data=form) as response:
-                result = await response.json()
-                if response.status == 200:
-                    return result["data"]["image"]["url"]
-                return None
-
-async def add_product_to_db(name, description, quantity, price, image_url):
+async def add_product_to_db(name, description, quantity, price, image_url, telegram_file_id=None):
     async with db_pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO goods (name, description, quantity, price, image_url) VALUES ($1, $2, $3, $4, $5)",
-            name, description, quantity, price, image_url
-        )
+        product_id = await db.add_product(conn, name, description, quantity, price, image_url, telegram_file_id)
+        await db.notify_goods_changed(conn)
+    return product_id
 
 class ProductStates(StatesGroup):
     waiting_for_name = State()
@@ -60,28 +82,40 @@ class ProductStates(StatesGroup):
     waiting_for_price = State()
     waiting_for_image = State()
 
-@dp.message_handler(commands=['start'])
+class ImportStates(StatesGroup):
+    waiting_for_table = State()
+    waiting_for_images = State()
+
+class BroadcastStates(StatesGroup):
+    waiting_for_message = State()
+    waiting_for_confirmation = State()
+
+@handlers.message_handler(commands=['start'])
 async def start(message: types.Message):
-    await message.answer("Привет! Введи команду /add_product для добавления товара.")
+    await message.answer(
+        "Привет! Введи команду /add_product для добавления товара или /import для загрузки каталога из файла.\n"
+        "Рассылка всем пользователям — /broadcast, объявление о товаре — /announce <id товара>, статистика рассылок — /broadcasts.\n"
+        "Продажи за последние дни — /stats [дней]."
+    )
 
-@dp.message_handler(commands=['add_product'])
+@handlers.message_handler(commands=['add_product'])
 async def start_adding_product(message: types.Message):
     await message.answer("Введите название товара:")
     await ProductStates.waiting_for_name.set()
 
-@dp.message_handler(state=ProductStates.waiting_for_name)
+@handlers.message_handler(state=ProductStates.waiting_for_name)
 async def get_product_name(message: types.Message, state: FSMContext):
     await state.update_data(product_name=message.text)
     await message.answer("Введите описание товара:")
     await ProductStates.waiting_for_description.set()
 
-@dp.message_handler(state=ProductStates.waiting_for_description)
+@handlers.message_handler(state=ProductStates.waiting_for_description)
 async def get_product_description(message: types.Message, state: FSMContext):
     await state.update_data(product_description=message.text)
     await message.answer("Введите количество товара:")
     await ProductStates.waiting_for_quantity.set()
 
-@dp.message_handler(state=ProductStates.waiting_for_quantity)
+@handlers.message_handler(state=ProductStates.waiting_for_quantity)
 async def get_product_quantity(message: types.Message, state: FSMContext):
     try:
         await state.update_data(product_quantity=int(message.text))
@@ -90,7 +124,7 @@ async def get_product_quantity(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("Введите число.")
 
-@dp.message_handler(state=ProductStates.waiting_for_price)
+@handlers.message_handler(state=ProductStates.waiting_for_price)
 async def get_product_price(message: types.Message, state: FSMContext):
     try:
         await state.update_data(product_price=float(message.text))
@@ -99,30 +133,318 @@ async def get_product_price(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("Введите число.")
 
-@dp.message_handler(content_types=ContentType.PHOTO, state=ProductStates.waiting_for_image)
+@handlers.message_handler(content_types=ContentType.PHOTO, state=ProductStates.waiting_for_image)
 async def get_product_image(message: types.Message, state: FSMContext):
     file_id = message.photo[-1].file_id
     file_info = await bot.get_file(file_id)
-    file_path = file_info.file_path
-    downloaded_file = await bot.download_file(file_path)
-    
+    downloaded_file = await bot.download_file(file_info.file_path)  # BytesIO, без временного файла
+
     product_data = await state.get_data()
-    image_name = f"temp_{product_data['product_name'].replace(' ', '_')}.jpg"
-    
-    await asyncio.to_thread(lambda: open(image_name, "wb").write(downloaded_file.getvalue()))
-    image_url = await upload_to_imgbb(image_name)
-    await asyncio.to_thread(lambda: os.remove(image_name))
-    
+    try:
+        image_url = await image_store.store(downloaded_file.getbuffer(), file_info.file_path)
+    except images.UploadError:
+        image_url = None
+
     if image_url:
-        await add_product_to_db(product_data['product_name'], product_data['product_description'], product_data['product_quantity'], product_data['product_price'], image_url)
-        await message.answer(f"Товар '{product_data['product_name']}' успешно добавлен!")
+        # file_id сохраняем сразу, чтобы пользовательский бот не загружал фото из хранилища
+        # (только если у ботов один токен: file_id другого бота недействителен)
+        product_id = await add_product_to_db(product_data['product_name'], product_data['product_description'], product_data['product_quantity'], product_data['product_price'], image_url, file_id if shop_bot is bot else None)
+        await message.answer(f"Товар '{product_data['product_name']}' успешно добавлен! Сообщить о нём покупателям: /announce {product_id}")
     else:
         await message.answer("Ошибка загрузки фото.")
     await state.finish()
 
+@handlers.message_handler(commands=['import'])
+async def start_import(message: types.Message):
+    await message.answer(
+        "Отправьте таблицу товаров файлом .csv или .xlsx. Первая строка — заголовок с колонками "
+        "name, description, quantity, price, image. В колонке image — имя файла фото в zip-архиве или ссылка на фото."
+    )
+    await ImportStates.waiting_for_table.set()
+
+@handlers.message_handler(content_types=ContentType.DOCUMENT, state=ImportStates.waiting_for_table)
+async def get_import_table(message: types.Message, state: FSMContext):
+    file_name = message.document.file_name or ''
+    if not file_name.lower().endswith(('.csv', '.xlsx')):
+        await message.answer("Нужен файл .csv или .xlsx.")
+        return
+    await state.update_data(table_file_id=message.document.file_id, table_file_name=file_name)
+    await message.answer("Отправьте zip-архив с фото товаров или /skip, если фото не нужны или заданы ссылками.")
+    await ImportStates.waiting_for_images.set()
+
+@handlers.message_handler(commands=['skip'], state=ImportStates.waiting_for_images)
+async def skip_import_images(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    await state.finish()
+    await run_import(message, data['table_file_id'], data['table_file_name'], None)
+
+@handlers.message_handler(content_types=ContentType.DOCUMENT, state=ImportStates.waiting_for_images)
+async def get_import_images(message: types.Message, state: FSMContext):
+    if not (message.document.file_name or '').lower().endswith('.zip'):
+        await message.answer("Нужен zip-архив или /skip.")
+        return
+    data = await state.get_data()
+    await state.finish()
+    await run_import(message, data['table_file_id'], data['table_file_name'], message.document.file_id)
+
+# Импортирует таблицу товаров, показывая прогресс в одном сообщении и итоговый отчёт с ошибками
+async def run_import(message: types.Message, table_file_id, table_file_name, archive_file_id):
+    try:
+        table = (await bot.download_file_by_id(table_file_id)).getvalue()
+        archive = (await bot.download_file_by_id(archive_file_id)).getvalue() if archive_file_id else None
+        rows = read_rows(table_file_name, table)
+        photos = ImageArchive(archive)
+    except ImportFileError as e:
+        await message.answer(f"Импорт невозможен: {e}")
+        return
+    except FileIsTooBig:
+        await message.answer("Импорт невозможен: Bot API не скачивает файлы больше 20 МБ. Разбейте таблицу или архив с фото на части.")
+        return
+    except zipfile.BadZipFile:
+        await message.answer("Импорт невозможен: архив с фото повреждён.")
+        return
+
+    status = await message.answer("Импорт начат...")
+    last_update = time.monotonic()
+
+    async def show_progress(report):
+        nonlocal last_update
+        if time.monotonic() - last_update < IMPORT_PROGRESS_INTERVAL:
+            return
+        last_update = time.monotonic()
+        try:
+            await status.edit_text(f"Импорт: обработано {report.processed} строк, ошибок {len(report.errors)}...")
+        except MessageNotModified:
+            pass
+
+    report = await import_products(db_pool, rows, photos, image_store.store, concurrency=IMPORT_CONCURRENCY, progress=show_progress)
+    async with db_pool.acquire() as conn:
+        await db.notify_goods_changed(conn)
+
+    text = f"Импорт завершён: добавлено {report.imported} из {report.total} товаров."
+    if report.errors:
+        lines = [f"строка {line_number}: {error}" for line_number, error in report.errors[:IMPORT_ERRORS_SHOWN]]
+        if len(report.errors) > IMPORT_ERRORS_SHOWN:
+            lines.append(f"и ещё {len(report.errors) - IMPORT_ERRORS_SHOWN} ошибок")
+        text += "\n\nОшибки:\n" + "\n".join(lines)
+    await status.edit_text(text)
+
+# Показывает текст или фото с подписью, которые получат пользователи, и просит подтвердить рассылку
+async def ask_broadcast_confirmation(message: types.Message, state: FSMContext, text, photo=None, reply_markup=None):
+    async with db_pool.acquire() as conn:
+        recipients = await conn.fetchval("SELECT COUNT(*) FROM users")
+    await state.update_data(broadcast_text=text, broadcast_photo=photo, broadcast_markup=reply_markup)
+    await BroadcastStates.waiting_for_confirmation.set()
+    await message.answer(f"Сообщение получат {recipients} пользователей. Отправить — /confirm, отменить — любой другой ответ.")
+
+@handlers.message_handler(commands=['broadcast'])
+async def start_broadcast(message: types.Message):
+    await message.answer("Отправьте текст или фото с подписью для рассылки всем пользователям. Для отмены напишите 'отмена'.")
+    await BroadcastStates.waiting_for_message.set()
+
+@handlers.message_handler(content_types=[ContentType.TEXT, ContentType.PHOTO], state=BroadcastStates.waiting_for_message)
+async def get_broadcast_message(message: types.Message, state: FSMContext):
+    if message.text and message.text.lower() == "отмена":
+        await message.answer("Рассылка отменена.")
+        await state.finish()
+        return
+    if message.photo:
+        if len(message.caption or '') > CAPTION_LIMIT:
+            await message.answer(f"Подпись к фото длиннее {CAPTION_LIMIT} символов. Сократите её или отправьте текст без фото.")
+            return
+        photo = message.photo[-1].file_id
+        if shop_bot is not bot:
+            # file_id админ-бота недействителен для пользовательского: рассылаем фото по ссылке из хранилища
+            file_info = await bot.get_file(photo)
+            downloaded_file = await bot.download_file(file_info.file_path)
+            try:
+                photo = await image_store.store(downloaded_file.getbuffer(), file_info.file_path)
+            except images.UploadError:
+                await message.answer("Ошибка загрузки фото. Попробуйте ещё раз или отправьте текст без фото.")
+                return
+        await ask_broadcast_confirmation(message, state, message.caption or '', photo)
+    else:
+        await ask_broadcast_confirmation(message, state, message.text)
+
+# Объявление о товаре (например, о поступлении на склад) с кнопкой поиска товара в пользовательском боте
+@handlers.message_handler(commands=['announce'])
+async def announce_product(message: types.Message, state: FSMContext):
+    product_id = message.get_args().strip()
+    if not product_id.isdigit():
+        await message.answer("Укажите id товара: /announce <id>.")
+        return
+    async with db_pool.acquire() as conn:
+        product = await conn.fetchrow(
+            "SELECT name, quantity, price, image_url, telegram_file_id FROM goods WHERE id = $1", int(product_id))
+    if not product:
+        await message.answer("Товар не найден.")
+        return
+
+    text = f"🆕 В наличии: {product['name']}\nЦена: {product['price']} руб.\nОсталось: {product['quantity']} шт."
+    # Кнопку поиска открывает бот, отправивший сообщение, — пользовательский (shop_bot), а не админ-бот
+    markup = InlineKeyboardMarkup().add(
+        InlineKeyboardButton("Найти в магазине 🔍", switch_inline_query_current_chat=product['name']))
+    # file_id товара мог получить админ-бот, тогда пользовательский бот отправляет фото по ссылке
+    photo = product['image_url'] if shop_bot is not bot else product['telegram_file_id'] or product['image_url']
+    await ask_broadcast_confirmation(message, state, text, photo, markup.to_python())
+
+@handlers.message_handler(state=BroadcastStates.waiting_for_confirmation)
+async def confirm_broadcast(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    await state.finish()
+    if message.text != "/confirm":
+        await message.answer("Рассылка отменена.")
+        return
+    job_id = await broadcast.create_job(
+        db_pool, data['broadcast_text'], data['broadcast_photo'], data['broadcast_markup'], message.chat.id)
+    start_broadcast_task(job_id, message.chat.id)
+
+# Строка статистики рассылки: прогресс, результаты и скорость отправки
+def describe_broadcast(job):
+    finished_at = job['finished_at'] or datetime.now(timezone.utc)
+    duration = max((finished_at - job['created_at']).total_seconds(), 1)
+    processed = job['sent'] + job['failed'] + job['blocked']
+    text = (f"Рассылка #{job['id']} ({job['status']}): обработано {processed} из {job['total']}, "
+            f"доставлено {job['sent']}, заблокировали бота {job['blocked']}, ошибок {job['failed']}, "
+            f"{processed / duration:.1f} сообщ./с")
+    if job['status'] != 'running' and broadcast.unknown(job):
+        text += f", без подтверждения (бот останавливался) {broadcast.unknown(job)}"
+    return text
+
+# Отправляет рассылку в фоне, показывая прогресс в одном сообщении в чате chat_id.
+# Рассылку, которую уже отправляет другой процесс, пропускает
+def start_broadcast_task(job_id, chat_id):
+    async def send():
+        status = await bot.send_message(chat_id, f"Рассылка #{job_id} начата...") if chat_id else None
+
+        async def show_progress(job):
+            if status:
+                try:
+                    await status.edit_text(describe_broadcast(job))
+                except MessageNotModified:
+                    pass
+
+        try:
+            job = await broadcast.run_job(db_pool, shop_bot, job_id, BROADCAST_CONCURRENCY, BROADCAST_RATE, show_progress)
+        except Exception:
+            logging.exception("Рассылка %s прервана", job_id)
+            if status:
+                await status.edit_text(f"Рассылка #{job_id} прервана из-за ошибки, она продолжится после перезапуска бота.")
+            return
+        await show_progress(job)
+
+    async def run():
+        try:
+            async with broadcast.job_lock(db_pool, job_id) as locked:
+                if locked:
+                    await send()
+        finally:
+            broadcast_tasks.pop(job_id, None)
+
+    broadcast_tasks[job_id] = asyncio.create_task(run())
+
+@handlers.message_handler(commands=['broadcasts'])
+async def show_broadcasts(message: types.Message):
+    jobs = await broadcast.recent_jobs(db_pool)
+    if not jobs:
+        await message.answer("Рассылок ещё не было.")
+        return
+    await message.answer("\n\n".join(describe_broadcast(job) for job in jobs) + "\n\nОстановить рассылку — /stop_broadcast <id>.")
+
+@handlers.message_handler(commands=['stop_broadcast'])
+async def stop_broadcast(message: types.Message):
+    job_id = message.get_args().strip()
+    if not job_id.isdigit():
+        await message.answer("Укажите id рассылки: /stop_broadcast <id>.")
+        return
+    if await broadcast.cancel_job(db_pool, int(job_id)):
+        await message.answer(f"Рассылка #{job_id} остановлена.")
+    else:
+        await message.answer(f"Рассылка #{job_id} не идёт.")
+
+# Продажи за последние дни: итоги по дням и товары с наибольшей выручкой.
+# Читаются только сводные таблицы и ещё не свёрнутые заказы
+@handlers.message_handler(commands=['stats'])
+async def show_stats(message: types.Message):
+    args = message.get_args().strip()
+    if args and not (args.isdigit() and 1 <= int(args) <= STATS_MAX_DAYS):
+        await message.answer(f"Укажите число дней от 1 до {STATS_MAX_DAYS}: /stats 30.")
+        return
+    days = int(args) if args else STATS_DAYS
+    daily = await sales.daily_sales(db_pool, days)
+    if not daily:
+        await message.answer(f"За последние {days} дн. продаж не было.")
+        return
+    products = await sales.top_products(db_pool, days, STATS_TOP_PRODUCTS)
+
+    lines = [f"📊 Продажи за последние {days} дн.: заказов {sum(row['orders'] for row in daily)}, "
+             f"продано {sum(row['units'] for row in daily)} шт., выручка {sum(row['revenue'] for row in daily)} руб.", ""]
+    lines += [f"{row['day']:%d.%m}: заказов {row['orders']}, {row['units']} шт., {row['revenue']} руб." for row in daily]
+    lines += ["", "Товары с наибольшей выручкой:"]
+    for i, row in enumerate(products, 1):
+        # product_id = 0 — позиции удалённых товаров, их названия разные
+        name = row['product_name'][:STATS_NAME_LENGTH] if row['product_id'] else "Удалённые товары"
+        lines.append(f"{i}. {name}: заказов {row['orders']}, {row['units']} шт., {row['revenue']} руб.")
+    await message.answer("\n".join(lines))
+
+# Пересчёт статистики продаж по заказам (то же делает ежедневная сверка)
+@handlers.message_handler(commands=['rebuild_stats'])
+async def rebuild_stats(message: types.Message):
+    mismatches = await sales.rebuild_sales(db_pool)
+    if mismatches:
+        await message.answer(f"Статистика пересчитана, исправлено строк: {mismatches}.")
+    else:
+        await message.answer("Статистика сходится с заказами.")
+
+metrics_runner = None
+images_runner = None
+
+# Подготовка процесса к обработке апдейтов (и при polling, и в воркере webhook)
+async def on_startup():
+    global db_pool, metrics_runner, images_runner, http_session, image_store
+    setup()
+    metrics_runner = await metrics.start_server()  # /metrics для Prometheus
+    http_session = aiohttp.ClientSession()  # Одна сессия на все загрузки изображений
+    # Админ-боту хватает одного постоянного соединения, остальные открываются под рассылки и импорт;
+    # запросы покупателей он не выполняет и заранее их не готовит
+    db_pool = await db.create_pool(min_size=1, prepare=False)
+    await storage.start(db_pool)  # Подключаем хранилище состояний к базе
+    image_store = images.create_store(db_pool, http_session)
+    images_runner = await images.start_server()  # Раздача локального хранилища фото
+    # Продолжаем рассылки, прерванные остановкой бота (уже взятые получатели не получат их повторно).
+    # Каждую продолжает один процесс: остальные не получат её блокировку
+    for job in await broadcast.running_jobs(db_pool):
+        start_broadcast_task(job['id'], job['created_by'])
+    sales_tasks.append(asyncio.create_task(sales.sales_folder(db_pool)))  # Сворачиваем новые заказы в статистику
+    sales_tasks.append(asyncio.create_task(sales.sales_reconciler(db_pool, SALES_RECONCILE_INTERVAL)))
+
+async def on_shutdown():
+    for task in list(broadcast_tasks.values()):
+        task.cancel()  # Подтверждённые отправки записываются, неотправленные получатели возвращаются в рассылку
+    if broadcast_tasks:
+        await asyncio.wait(list(broadcast_tasks.values()))
+    for task in sales_tasks:
+        task.cancel()
+    await storage.close()  # Сохраняем несброшенные состояния
+    await db_pool.close()
+    await http_session.close()
+    await (await bot.get_session()).close()
+    if shop_bot is not bot:
+        await (await shop_bot.get_session()).close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    if images_runner:
+        await images_runner.cleanup()
+
 async def main():
-    await create_db_pool()  # Запускаем пул соединений
-    await dp.start_polling()  # Запускаем бота
+    await on_startup()
+    try:
+        await dp.start_polling()  # Запускаем бота
+    finally:
+        await on_shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())  # Асинхронно запускаем бота
+    if os.getenv('WEBHOOK_URL'):
+        webhook.run('admin')  # Webhook и несколько процессов-обработчиков
+    else:
+        asyncio.run(main())  # Асинхронно запускаем бота
@@ -1,39 +1,57 @@
 import os
-import asyncpg
+import re
 import asyncio
+import logging
 
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types
+from aiogram import types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.utils.exceptions import MessageNotModified, BotBlocked, CantInitiateConversation, BadRequest
 
 from aiogram.dispatcher.filters import Command
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+import webhook
+import metrics
+import callbacks
+import ledger
+import bots
+import db
+from cache import TTLCache
 
 load_dotenv()
-bot_token = os.getenv('BOT_TOKEN')
 
-bot = Bot(token=bot_token)
-
-# Инициализация хранилища состояний
-storage = MemoryStorage()
-
-# Инициализация Dispatcher с хранилищем
-dp = Dispatcher(bot, storage=storage)
+# Бот, хранилище состояний и диспетчер создаются в setup() при запуске
+bot = None
+storage = None
+dp = None
+handlers = bots.Handlers()
+
+# Теги действий в callback_data. Номера не меняются: по ним разбираются уже отправленные кнопки
+CB_CATALOG = 1
+CB_BUY = 2
+CB_REMOVE = 3  # Не используется: прежние кнопки удаления по id строки корзины
+CB_CHECKOUT = 4
+CB_ORDERS = 5
+CB_TOP_UP = 6
+CB_CART_INCREASE = 7
+CB_CART_DECREASE = 8
+CB_CART_DELETE = 9
+
+# Все нажатия на кнопки проходят через один хендлер с таблицей обработчиков
+router = callbacks.CallbackRouter()
 
 db_pool = None
 
-async def create_db_pool():
-    global db_pool
-    db_pool = await asyncpg.create_pool(
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        database=os.getenv('DB_NAME'),
-        host=os.getenv('DB_HOST'),
-        port=os.getenv('DB_PORT')
-    )
+# Создаёт бота и диспетчер с хендлерами этого модуля (повторный вызов ничего не меняет)
+def setup():
+    global bot, storage, dp
+    if dp is None:
+        bot, storage, dp = bots.create('shop', handlers)
+        router.register(dp)
 
 # Состояния для процесса покупки товара
 class PurchaseStates(StatesGroup):
@@ -43,17 +61,27 @@ class PurchaseStates(StatesGroup):
 class BalanceStates(StatesGroup):
     waiting_for_amount = State()
 
+# Кэш профилей пользователей (telegram_id -> запись users). Сбрасывается при изменении баланса;
+# апдейты одного пользователя в режиме webhook всегда попадают в один процесс
+user_cache = TTLCache('users', maxsize=int(os.getenv('USER_CACHE_SIZE', 10000)), ttl=int(os.getenv('USER_CACHE_TTL', 300)))
+
+# Возвращает профиль пользователя (telegram_id, username, balance) или None.
+# Баланс — снимок из users плюс несвёрнутые записи журнала balance_ledger
+async def get_user(user_id):
+    async def load():
+        async with db_pool.acquire() as conn:
+            return await db.fetch_user(conn, user_id)
+    return await user_cache.get_or_load(user_id, load)
+
 # Хендлер для команды /start
-@dp.message_handler(Command("start"))
+@handlers.message_handler(Command("start"))
 async def privet_command(message: types.Message):
-    async with db_pool.acquire() as conn:  # Теперь conn объявлен правильно
-        user_exists = await conn.fetchrow("SELECT id FROM users WHERE telegram_id = $1", message.from_user.id)
-        
-        if not user_exists:  # Если пользователя нет, добавляем его в БД
-            await conn.execute("""
-                INSERT INTO users (telegram_id, username, balance) 
-                VALUES ($1, $2, $3)
-            """, message.from_user.id, message.from_user.username, 0)  # Баланс по умолчанию = 0
+    # Пользователь из кэша уже есть в базе; иначе добавляем его одним запросом (повторный /start ничего не меняет).
+    # В кэше может лежать и None — пользователя не было в базе, когда его искали
+    if user_cache.get(message.from_user.id) is None:
+        async with db_pool.acquire() as conn:
+            await db.add_user(conn, message.from_user.id, message.from_user.username)
+        user_cache.invalidate(message.from_user.id)
 
     # Создаем клавиатуру
     keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
@@ -69,48 +97,311 @@ async def privet_command(message: types.Message):
     await message.answer("Привет, я бот интернет-магазина!", reply_markup=keyboard)
 
 
+# Размер страницы каталога, ограничение на число закэшированных страниц и товаров и время
+# их жизни в кэше (в секундах): кэш сбрасывается по NOTIFY, срок жизни ограничивает устаревание,
+# если уведомление потерялось (например, пока соединение подписки переподключалось)
+CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', 5))
+CATALOG_CACHE_SIZE = 1000
+CATALOG_CACHE_TTL = int(os.getenv('CATALOG_CACHE_TTL', 60))
+
+# Кэш страниц каталога: (направление, курсор) -> (товары, есть ли ещё страницы)
+catalog_cache = TTLCache('catalog', maxsize=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL)
+# Кэш товаров по id для обработки нажатий
+product_cache = TTLCache('products', maxsize=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL)
+# Страницы каталога, на которых есть товар: id товара -> ключи страниц в catalog_cache
+catalog_pages = {}
+goods_listener = None
+relisten_task = None
+
+def invalidate_catalog_cache():
+    catalog_cache.clear()
+    product_cache.clear()
+    catalog_pages.clear()
+
+# Сбрасывает кэш по NOTIFY: товары из payload и страницы каталога с ними, а пустой payload — весь каталог
+def invalidate_goods(connection, pid, channel, payload):
+    if not payload:
+        invalidate_catalog_cache()
+        return
+    for product_id in map(int, payload.split(',')):
+        product_cache.invalidate(product_id)
+        for key in catalog_pages.pop(product_id, ()):
+            catalog_cache.invalidate(key)
+    catalog_cache.drop_loading()  # Загружаемая страница могла прочитать старые остатки
+
+# Подписываемся на изменения товаров (админ-бот, резервы и оформление заказов шлют NOTIFY)
+async def listen_goods_changes():
+    global goods_listener
+    conn = await db_pool.acquire()
+    try:
+        await conn.add_listener(db.GOODS_CHANNEL, invalidate_goods)
+    except BaseException:
+        await db_pool.release(conn)
+        raise
+    conn.add_termination_listener(goods_listener_lost)
+    goods_listener = conn
+
+# Соединение подписки закрылось (перезапуск PostgreSQL, обрыв сети): уведомления до
+# переподключения теряются, поэтому кэш сбрасывается, а подписка восстанавливается в фоне
+def goods_listener_lost(connection):
+    global goods_listener, relisten_task
+    goods_listener = None  # Пул сам забирает закрытое соединение
+    logging.warning("Соединение подписки на изменения товаров закрыто, переподключаемся")
+    invalidate_catalog_cache()
+    relisten_task = asyncio.create_task(relisten_goods_changes())
+
+async def relisten_goods_changes(delay=1, max_delay=30):
+    while True:
+        try:
+            await listen_goods_changes()
+        except Exception as e:
+            logging.warning("Не удалось подписаться на изменения товаров (%s), повтор через %s с", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+        else:
+            invalidate_catalog_cache()  # Изменения, пропущенные без подписки
+            return
+
+# Загружает страницу каталога по ключу (keyset-пагинация по id)
+async def fetch_catalog_page(direction, cursor):
+    key = (direction, cursor)
+
+    async def load():
+        async with db_pool.acquire() as conn:
+            goods = await db.catalog_page(conn, cursor, CATALOG_PAGE_SIZE + 1, forward=direction == 'next')
+
+        has_more = len(goods) > CATALOG_PAGE_SIZE
+        goods = goods[:CATALOG_PAGE_SIZE]
+        if direction == 'prev':
+            goods = goods[::-1]
+        for product in goods:
+            catalog_pages.setdefault(product['id'], set()).add(key)
+        return goods, has_more
+
+    return await catalog_cache.get_or_load(key, load)
+
+# Возвращает товар (id, name, quantity, price) из кэша или базы; None, если товара нет
+async def get_product(product_id):
+    async def load():
+        async with db_pool.acquire() as conn:
+            return await db.fetch_product(conn, product_id)
+
+    return await product_cache.get_or_load(product_id, load)
+
+# Формирует текст и клавиатуру страницы каталога
+async def render_catalog_page(direction='next', cursor=0):
+    goods, has_more = await fetch_catalog_page(direction, cursor)
+    if not goods and cursor:
+        # Товары на странице могли удалить — возвращаемся к началу
+        direction, cursor = 'next', 0
+        goods, has_more = await fetch_catalog_page(direction, cursor)
+
+    if not goods:
+        return "В каталоге нет товаров.", None
+
+    lines = ["🔍Каталог товаров:"]
+    markup = InlineKeyboardMarkup()
+    for product in goods:
+        product_id, name, description, quantity, price, image_url = product
+        if description and len(description) > 200:
+            description = description[:200] + "…"
+        lines.append(f"\n📦 {name}\nОписание: {description}\nКоличество: {quantity}\nЦена: {price} руб.")
+
+        # Создаем inline кнопку "Купить" для каждого товара (цена и остаток определяются при нажатии)
+        markup.add(InlineKeyboardButton(f"Купить 💵 {name}", callback_data=callbacks.encode(CB_BUY, product_id)))
+
+    # Кнопки навигации по страницам
+    has_prev = has_more if direction == 'prev' else cursor > 0
+    has_next = has_more if direction == 'next' else True
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=callbacks.encode(CB_CATALOG, 0, goods[0]['id'])))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Вперёд ➡️", callback_data=callbacks.encode(CB_CATALOG, 1, goods[-1]['id'])))
+    if navigation:
+        markup.row(*navigation)
+
+    return "\n".join(lines), markup
+
 # Хендлер для отображения каталога товаров
-@dp.message_handler(lambda message: message.text == "🔍Каталог")
+@handlers.message_handler(lambda message: message.text == "🔍Каталог")
 async def show_catalog(message: types.Message):
-    await message.answer("🔍Каталог товаров:")
+    text, markup = await render_catalog_page()
+    await message.answer(text, reply_markup=markup)
+
+# Хендлер для листания каталога (редактирует сообщение на месте)
+@router.route(CB_CATALOG)
+async def paginate_catalog(callback_query: types.CallbackQuery, state: FSMContext, forward, cursor):
+    text, markup = await render_catalog_page('next' if forward else 'prev', cursor)
 
+    try:
+        await callback_query.message.edit_text(text, reply_markup=markup)
+    except MessageNotModified:
+        pass
+    await callback_query.answer()
+
+# Размер страницы результатов inline-поиска (Telegram принимает до 50)
+SEARCH_PAGE_SIZE = 20
+
+# Кэш результатов поиска: (нормализованный запрос, курсор) -> (результаты, next_offset).
+# Не сбрасывается по goods_changed (он приходит на каждый резерв), остаток в результатах устаревает не больше чем на TTL
+search_cache = TTLCache('search', maxsize=5000, ttl=int(os.getenv('SEARCH_CACHE_TTL', 30)))
+
+# Запрос в нижнем регистре из не более чем 8 слов
+def normalize_query(text):
+    return ' '.join(re.findall(r'\w+', text.lower())[:8])
+
+# Запрос для to_tsquery: все слова, кроме последнего, целиком, последнее (его ещё набирают) — по началу.
+# Префиксы во всех словах планировщик оценивает плохо и выбирает медленный план
+def search_tsquery(query):
+    words = query.split()
+    return ' & '.join(words[:-1] + [words[-1] + ':*'])
+
+# Ищет товары по словам в названии и описании (индекс goods_search_idx), keyset-пагинация по id
+async def search_goods(query, after_id=0):
+    async with db_pool.acquire() as conn:
+        return await db.search_goods(conn, search_tsquery(query) if query else None, after_id, SEARCH_PAGE_SIZE + 1)
+
+# file_id фото сохраняет админ-бот, а Telegram принимает file_id только от бота, который его получил.
+# Если боты работают с разными токенами, после первого отказа результаты строятся по ссылкам
+cached_photos_accepted = True
+
+# Результат inline-поиска: фото по сохранённому file_id (если cached_photo), по ссылке или текст, если фото нет
+def search_result(product, cached_photo=True):
+    product_id, name, quantity, price, image_url, file_id = product
+    caption = f"📦 {name}\nЦена: {price} руб.\nВ наличии: {quantity}"
+    markup = InlineKeyboardMarkup().add(InlineKeyboardButton("Купить 💵", callback_data=callbacks.encode(CB_BUY, product_id)))
+    if file_id and cached_photo:
+        return types.InlineQueryResultCachedPhoto(id=str(product_id), photo_file_id=file_id, caption=caption, reply_markup=markup)
+    if image_url:
+        return types.InlineQueryResultPhoto(id=str(product_id), photo_url=image_url, thumb_url=image_url,
+                                            caption=caption, reply_markup=markup)
+    return types.InlineQueryResultArticle(id=str(product_id), title=name, description=f"{price} руб.",
+                                          input_message_content=types.InputTextMessageContent(caption), reply_markup=markup)
+
+# Inline-режим: @бот запрос
+@handlers.inline_handler()
+async def search_products(inline_query: types.InlineQuery):
+    query = normalize_query(inline_query.query)
+    after_id = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+
+    async def load(cached_photos):
+        goods = await search_goods(query, after_id)
+        next_offset = str(goods[SEARCH_PAGE_SIZE - 1]["id"]) if len(goods) > SEARCH_PAGE_SIZE else ""
+        return [search_result(product, cached_photos) for product in goods[:SEARCH_PAGE_SIZE]], next_offset
+
+    global cached_photos_accepted
+    cached_photos = cached_photos_accepted
+    results, next_offset = await search_cache.get_or_load((query, after_id, cached_photos), lambda: load(cached_photos))
+    try:
+        await inline_query.answer(results, cache_time=search_cache.ttl, next_offset=next_offset)
+    except BadRequest as e:
+        if not any(isinstance(result, types.InlineQueryResultCachedPhoto) for result in results):
+            raise
+        # Один непринятый file_id отклоняет весь ответ: отвечаем фото по ссылкам
+        logging.warning("Telegram не принял file_id фото в результатах поиска (%s), используем ссылки", e)
+        cached_photos_accepted = False
+        results, next_offset = await search_cache.get_or_load((query, after_id, False), lambda: load(False))
+        await inline_query.answer(results, cache_time=search_cache.ttl, next_offset=next_offset)
+
+# Время, на которое товар резервируется в корзине (в секундах)
+CART_RESERVATION_TTL = int(os.getenv('CART_RESERVATION_TTL', 30 * 60))
+
+# Сколько просроченных резервов освобождается одной транзакцией
+RELEASE_BATCH_SIZE = 500
+
+# Не хватило товара на складе при резервировании или оформлении заказа
+class OutOfStock(Exception):
+    pass
+
+# Атомарно списывает товар со склада и добавляет его в корзину (одна строка на товар) с резервом
+# до истечения TTL. Цена позиции обновляется до текущей. Возвращает (цену, количество в корзине)
+# или выбрасывает OutOfStock с фактическим остатком
+async def reserve_product(user_id, product_id, quantity):
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            item = await db.reserve(conn, user_id, product_id, quantity, CART_RESERVATION_TTL)
+
+            if item["reserved_price"] is None:
+                raise OutOfStock(await db.product_quantity(conn, product_id) or 0)
+
+            if item["quantity"] is None:
+                # В корзине уже есть позиция без резерва (добавленная до появления резервов):
+                # списываем со склада и её, чтобы вся позиция стала зарезервированной
+                item = await db.reserve_legacy(conn, user_id, product_id, quantity, CART_RESERVATION_TTL)
+                if item is None:
+                    raise OutOfStock(await db.product_quantity(conn, product_id) or 0)
+
+            await db.notify_goods_changed(conn, [product_id])
+    return item["price"], item["quantity"]
+
+# Убирает из корзины quantity единиц товара (None — позицию целиком) и возвращает
+# зарезервированное на склад. Если в позиции остаётся меньше одной единицы, она удаляется.
+# Строка товара блокируется до строки корзины в том же порядке, что и при резерве,
+# иначе встречные резерв и возврат могли бы взаимно заблокироваться
+async def release_from_cart(user_id, product_id, quantity=None):
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            await db.lock_goods(conn, [product_id])
+            item = await db.decrease_cart_item(conn, user_id, product_id, quantity) if quantity is not None else None
+            if item is None:
+                item = await db.delete_cart_item(conn, user_id, product_id)
+            if item and item["reserved"]:
+                await restock_goods(conn, [product_id], [item["released"]])
+
+# Возвращает на склад до RELEASE_BATCH_SIZE резервов с истёкшим сроком. Строки,
+# заблокированные оформляющимся заказом, пропускаются и будут обработаны в следующий раз
+async def release_expired_reservations():
     async with db_pool.acquire() as conn:
-        goods = await conn.fetch("SELECT id, name, description, quantity, price, image_url FROM goods")
+        async with conn.transaction():
+            released = await db.release_expired(conn, RELEASE_BATCH_SIZE)
+            if not released:
+                return 0
+
+            await restock_goods(conn, [item["product_id"] for item in released], [item["quantity"] for item in released])
+    return len(released)
+
+# Возвращает товары на склад одним запросом (строки goods уже заблокированы)
+async def restock_goods(conn, product_ids, quantities):
+    await db.restock(conn, product_ids, quantities)
+    await db.notify_goods_changed(conn, product_ids)
+
+# Фоновая задача освобождения просроченных резервов
+async def reservations_sweeper(interval=60):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # Освобождаем пачками, пока не кончатся просроченные резервы
+            while await release_expired_reservations() == RELEASE_BATCH_SIZE:
+                pass
+        except Exception:
+            logging.exception("Не удалось освободить просроченные резервы")
 
-    if goods:
-        for product in goods:
-            product_id, name, description, quantity, price, image_url = product
-            product_message = f"Название: {name}\nОписание: {description}\nКоличество: {quantity}\nЦена: {price} руб."
+# Хендлер для кнопки "Купить"
+@router.route(CB_BUY)
+async def buy_product(callback_query: types.CallbackQuery, state: FSMContext, product_id):
+    # В callback_data только id: остаток и цена берутся на момент нажатия
+    product = await get_product(product_id)
 
-            # Создаем inline кнопку "Купить"
-            markup = InlineKeyboardMarkup()
-            buy_button = InlineKeyboardButton("Купить 💵", callback_data=f"buy_{product_id}_{quantity}_{price}")
-            markup.add(buy_button)
+    if not product or not product["quantity"]:
+        await callback_query.answer("Товар закончился.", show_alert=True)
+        return
 
-            # Отправляем товар с кнопкой
-            await message.answer_photo(image_url, caption=product_message, reply_markup=markup)
-    else:
-        await message.answer("В каталоге нет товаров.")
+    # Запрашиваем количество товара в личном чате: у кнопки из inline-поиска нет callback_query.message
+    try:
+        await bot.send_message(callback_query.from_user.id, f"Сколько товара вы хотите купить? Доступно на складе: {product['quantity']}")
+    except (BotBlocked, CantInitiateConversation):
+        await callback_query.answer("Чтобы купить товар, откройте бота и нажмите /start.", show_alert=True)
+        return
 
-# Хендлер для кнопки "Купить"
-@dp.callback_query_handler(lambda c: c.data.startswith('buy_'))
-async def buy_product(callback_query: types.CallbackQuery, state: FSMContext):
-    # Извлекаем данные из callback_data
-    product_id, product_quantity, product_price = callback_query.data.split('_')[1:]
-    product_id = int(product_id)
-    product_quantity = int(product_quantity)
-    product_price = float(product_price)
-
-    # Запрашиваем количество товара
-    await callback_query.message.answer(f"Сколько товара вы хотите купить? Доступно на складе: {product_quantity}")
-    
     # Сохраняем данные о товаре в состоянии
-    await state.update_data(product_id=product_id, product_quantity=product_quantity, product_price=product_price)
-    
-    await PurchaseStates.waiting_for_quantity.set()
+    await state.update_data(product_id=product_id)
+
+    await state.set_state(PurchaseStates.waiting_for_quantity)
+    await callback_query.answer()
 
 # Хендлер для получения количества товара
-@dp.message_handler(state=PurchaseStates.waiting_for_quantity)
+@handlers.message_handler(state=PurchaseStates.waiting_for_quantity)
 async def get_product_quantity(message: types.Message, state: FSMContext):
     # Проверяем, ввёл ли пользователь "отмена"
     if message.text.lower() == "отмена":
@@ -120,150 +411,165 @@ async def get_product_quantity(message: types.Message, state: FSMContext):
 
     try:
         quantity = int(message.text)
-        user_data = await state.get_data()
-        product_id = user_data['product_id']
-        product_quantity = user_data['product_quantity']
-        product_price = user_data['product_price']
-
-        # Проверяем, достаточно ли товара на складе
-        if quantity > product_quantity:
-            await message.answer(f"На складе нет такого количества товара. Доступно всего: {product_quantity}. Введите количество заново или напишите 'отмена'.")
-        else:
-            # Добавляем товар в корзину с указанным количеством
-            async with db_pool.acquire() as conn:
-                await conn.execute("""
-                    INSERT INTO carts (user_id, product_id, price, quantity) 
-                    VALUES ($1, $2, $3, $4)
-                """, message.from_user.id, product_id, product_price, quantity)
-
-            await message.answer(f"Товар успешно добавлен в корзину! {quantity} шт. по цене {product_price} руб. за штуку.")
-            await state.finish()  # Завершаем процесс
     except ValueError:
         await message.answer("Пожалуйста, введите количество числом.")
+        return
 
-# Хендлер для отображения корзины
-@dp.message_handler(lambda message: message.text == "🛒Корзина")
-async def show_cart(message: types.Message):
-    user_id = message.from_user.id
-
-    # Получаем товары из корзины с image_url
-    async with db_pool.acquire() as conn:
-        cart_items = await conn.fetch("""
-            SELECT g.name, g.price, g.image_url, c.id, c.quantity
-            FROM carts c
-            JOIN goods g ON c.product_id = g.id
-            WHERE c.user_id = $1
-        """, user_id)
-
-    if cart_items:
-        await message.answer("🛒 Ваша корзина:")
-
-        total_sum = 0  # Переменная для итоговой суммы
-
-        # Добавляем товары в сообщение и создаем кнопки для удаления
-        for item in cart_items:
-            name, price, image_url, cart_item_id, quantity = item
-
-            # Вычисляем итоговую цену товара
-            total_price = price * quantity
-            total_sum += total_price  # Добавляем к общей сумме
-
-            # Создаем inline кнопку "Удалить"
-            remove_button = InlineKeyboardButton("Удалить ❌", callback_data=f"remove_{cart_item_id}")
-            markup = InlineKeyboardMarkup().add(remove_button)
-
-            # Отправляем изображение товара с описанием и кнопкой удаления
-            await message.answer_photo(
-                image_url, 
-                caption=f"{name} - {price} руб. (Количество: {quantity})\nИтоговая цена: {total_price} руб.",
-                reply_markup=markup
-            )
+    if quantity <= 0:
+        await message.answer("Введите положительное число.")
+        return
 
+    user_data = await state.get_data()
 
-        # Кнопка "Оформить заказ ✅"
-        checkout_button = InlineKeyboardButton("Оформить заказ ✅", callback_data="checkout_order")
-        checkout_markup = InlineKeyboardMarkup().add(checkout_button)
+    # Резервируем товар: проверка остатка и списание происходят одним запросом
+    try:
+        product_price, _ = await reserve_product(message.from_user.id, user_data['product_id'], quantity)
+    except OutOfStock as e:
+        await message.answer(f"На складе нет такого количества товара. Доступно всего: {e.args[0]}. Введите количество заново или напишите 'отмена'.")
+        return
 
-        # Отправляем итоговую сумму с кнопкой
-        await message.answer(f"💰 Общая сумма заказа: {total_sum} руб.", reply_markup=checkout_markup)
-    else:
-        await message.answer("🛒 Ваша корзина пуста.")
+    await message.answer(
+        f"Товар успешно добавлен в корзину! {quantity} шт. по цене {product_price} руб. за штуку.\n"
+        f"Товар зарезервирован на {CART_RESERVATION_TTL // 60} мин."
+    )
+    await state.finish()  # Завершаем процесс
 
-# Хендлер для удаления товара из корзины
-@dp.callback_query_handler(lambda call: call.data.startswith("remove_"))
-async def remove_from_cart(call: types.CallbackQuery):
-    cart_item_id = int(call.data.split("_")[1])  # Преобразуем в целое число
+# Telegram принимает не больше 100 кнопок в сообщении: по 3 кнопки на позицию и "Оформить заказ"
+CART_BUTTON_ITEMS = 33
 
-    # Удаляем товар из корзины
+# Формирует текст и клавиатуру корзины одним запросом. Цена зарезервированных позиций —
+# цена резерва, остальных — текущая (как при оформлении заказа)
+async def render_cart(user_id):
     async with db_pool.acquire() as conn:
-        await conn.execute("DELETE FROM carts WHERE id = $1", cart_item_id)
+        cart_items = await db.cart_items(conn, user_id)
+
+    if not cart_items:
+        return "🛒 Ваша корзина пуста.", None
+
+    lines = ["🛒 Ваша корзина:\n"]
+    markup = InlineKeyboardMarkup()
+    total_sum = 0
+    for number, (product_id, name, quantity, price) in enumerate(cart_items, 1):
+        total_price = price * quantity
+        total_sum += total_price
+        lines.append(f"{number}. {name} — {price} руб. × {quantity} = {total_price} руб.")
+
+        # Кнопки изменения количества и удаления позиции (товар определяется по id, а не по строке корзины)
+        if number <= CART_BUTTON_ITEMS:
+            markup.row(
+                InlineKeyboardButton(f"{number}. ➖", callback_data=callbacks.encode(CB_CART_DECREASE, product_id)),
+                InlineKeyboardButton(f"{number}. ➕", callback_data=callbacks.encode(CB_CART_INCREASE, product_id)),
+                InlineKeyboardButton(f"{number}. ❌", callback_data=callbacks.encode(CB_CART_DELETE, product_id)),
+            )
 
-    await call.message.answer("Товар удален из корзины.")
-    # Обновляем корзину
-    await show_cart(call.message)
+    lines.append(f"\n💰 Общая сумма заказа: {total_sum} руб.")
+    markup.add(InlineKeyboardButton("Оформить заказ ✅", callback_data=callbacks.encode(CB_CHECKOUT)))
+    return "\n".join(lines), markup
 
+# Хендлер для отображения корзины
+@handlers.message_handler(lambda message: message.text == "🛒Корзина")
+async def show_cart(message: types.Message):
+    text, markup = await render_cart(message.from_user.id)
+    await message.answer(text, reply_markup=markup)
 
-# Хендлер для кнопки "Оформить заказ"
-@dp.callback_query_handler(lambda c: c.data == "checkout_order")
-async def process_checkout(callback_query: types.CallbackQuery):
-    user_id = callback_query.from_user.id
+# Перерисовывает сообщение корзины на месте после изменения
+async def update_cart_message(callback_query: types.CallbackQuery, notice=None, alert=False):
+    text, markup = await render_cart(callback_query.from_user.id)
+    try:
+        await callback_query.message.edit_text(text, reply_markup=markup)
+    except MessageNotModified:
+        pass
+    await callback_query.answer(notice, show_alert=alert)
+
+# Хендлер для кнопки "➕" в корзине: резервирует ещё одну единицу товара
+@router.route(CB_CART_INCREASE)
+async def increase_cart_item(callback_query: types.CallbackQuery, state: FSMContext, product_id):
+    try:
+        await reserve_product(callback_query.from_user.id, product_id, 1)
+    except OutOfStock:
+        await update_cart_message(callback_query, "Больше этого товара на складе нет.", alert=True)
+        return
+    await update_cart_message(callback_query)
 
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():  # Открываем транзакцию
-            
-            # Получаем баланс пользователя
-            balance_row = await conn.fetchrow("SELECT balance FROM users WHERE telegram_id = $1", user_id)
-            balance = balance_row["balance"] if balance_row else 0
-
-            # Получаем товары из корзины
-            cart_items = await conn.fetch("""
-                SELECT g.id, g.name, g.price, c.quantity
-                FROM carts c
-                JOIN goods g ON c.product_id = g.id
-                WHERE c.user_id = $1
-            """, user_id)
-
-            if not cart_items:
-                await callback_query.answer("Ваша корзина пуста!")
-                return
-
-            # Рассчитываем общую сумму заказа
-            total_price = sum(item["price"] * item["quantity"] for item in cart_items)
-
-            # Проверяем, хватает ли баланса
-            if balance < total_price:
-                await callback_query.message.answer("❌ Недостаточно средств! Пополните баланс.")
-                await callback_query.answer("❌ Недостаточно средств! Пополните баланс.")
-                return
-
-            # Уменьшаем баланс пользователя
-            await conn.execute(
-                "UPDATE users SET balance = balance - $1 WHERE telegram_id = $2", total_price, user_id
-            )
+# Хендлер для кнопки "➖" в корзине: убирает одну единицу (последнюю — вместе с позицией)
+@router.route(CB_CART_DECREASE)
+async def decrease_cart_item(callback_query: types.CallbackQuery, state: FSMContext, product_id):
+    await release_from_cart(callback_query.from_user.id, product_id, 1)
+    await update_cart_message(callback_query)
 
-            # Создаём заказ и получаем его ID
-            order_row = await conn.fetchrow(
-                "INSERT INTO orders (user_id, total_price) VALUES ($1, $2) RETURNING id",
-                user_id, total_price
-            )
-            order_id = order_row["id"]
+# Хендлер для кнопки "❌" в корзине: удаляет позицию целиком
+@router.route(CB_CART_DELETE)
+async def remove_from_cart(callback_query: types.CallbackQuery, state: FSMContext, product_id):
+    await release_from_cart(callback_query.from_user.id, product_id)
+    await update_cart_message(callback_query, "Товар удален из корзины.")
 
-            # Добавляем товары в order_items
-            await conn.executemany(
-                "INSERT INTO order_items (order_id, product_name, quantity, price, total_price) VALUES ($1, $2, $3, $4, $5)",
-                [(order_id, item["name"], item["quantity"], item["price"], item["price"] * item["quantity"]) for item in cart_items]
-            )
 
-            # Уменьшаем количество товаров в таблице goods
-            await conn.executemany(
-                "UPDATE goods SET quantity = GREATEST(quantity - $1, 0) WHERE id = $2",
-                [(item["quantity"], item["id"]) for item in cart_items]
-            )
+# Хендлер для кнопки "Оформить заказ"
+@router.route(CB_CHECKOUT)
+async def process_checkout(callback_query: types.CallbackQuery, state: FSMContext):
+    user_id = callback_query.from_user.id
 
-            # Очищаем корзину пользователя
-            await conn.execute("DELETE FROM carts WHERE user_id = $1", user_id)
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():  # Открываем транзакцию
+
+                # Блокируем пользователя: параллельные оформления одного пользователя и свёртка журнала
+                # идут по очереди. Баланс читаем отдельным запросом уже после блокировки, чтобы увидеть
+                # результат свёртки, завершившейся, пока мы её ждали
+                await db.lock_user(conn, user_id)
+                balance = await db.fetch_balance(conn, user_id) or 0
+
+                # Позиции без резерва (добавленные до появления резервов) ещё не списаны со склада.
+                # Их строки goods блокируем по возрастанию id до корзины, в том же порядке, что
+                # резерв и возврат: иначе встречный "➕" по такой позиции мог бы взаимно заблокироваться
+                locked_goods = await db.unreserved_cart_products(conn, user_id)
+                if locked_goods:
+                    await db.lock_goods(conn, locked_goods)
+
+                # Получаем товары из корзины. Зарезервированные позиции уже списаны со склада по цене резерва
+                cart_items = await db.lock_cart(conn, user_id)
+
+                if not cart_items:
+                    await callback_query.answer("Ваша корзина пуста!")
+                    return
+
+                # Рассчитываем общую сумму заказа
+                total_price = sum(item["price"] * item["quantity"] for item in cart_items)
+
+                # Проверяем, хватает ли баланса
+                if balance < total_price:
+                    await callback_query.message.answer("❌ Недостаточно средств! Пополните баланс.")
+                    await callback_query.answer("❌ Недостаточно средств! Пополните баланс.")
+                    return
+
+                # Списываем со склада позиции без резерва (их строки goods уже заблокированы),
+                # уменьшение проходит только при достаточном остатке
+                unreserved = [item for item in cart_items if not item["reserved"]]
+                if unreserved:
+                    product_ids = [item["id"] for item in unreserved]
+                    quantities = [item["quantity"] for item in unreserved]
+                    if await db.take_stock(conn, product_ids, quantities) < len(set(product_ids)):
+                        raise OutOfStock()
+                    await db.notify_goods_changed(conn, product_ids)
+
+                # Создаём заказ и получаем его ID
+                order_id = await db.create_order(conn, user_id, total_price)
+
+                # Списываем сумму с баланса записью в журнал (в той же транзакции, что и проверка баланса)
+                await db.add_purchase(conn, user_id, total_price, order_id)
+
+                # Добавляем товары в order_items одним запросом
+                await db.add_order_items(conn, order_id, cart_items)
+
+                # Очищаем оформленные позиции корзины
+                await db.delete_cart_rows(conn, [item["cart_item_id"] for item in cart_items])
+    except OutOfStock:
+        await callback_query.message.answer("❌ Некоторых товаров из корзины уже нет в нужном количестве. Удалите их из корзины и попробуйте снова.")
+        await callback_query.answer("❌ Недостаточно товара на складе.")
+        return
 
-    await callback_query.answer("✅ Заказ оформлен!")
+    user_cache.invalidate(user_id)  # Баланс изменился (сбрасываем после коммита)
+    await update_cart_message(callback_query, "✅ Заказ оформлен!")
     await callback_query.message.answer(
         "Ваш заказ успешно оформлен! Спасибо за покупку.\n"
         "С вами скоро свяжется наш менеджер.\n"
@@ -271,107 +577,165 @@ async def process_checkout(callback_query: types.CallbackQuery):
     )
 
 
-# Хендлер для кнопки "Мои заказы"
-@dp.message_handler(lambda message: message.text == "📖Мои заказы")
-async def show_orders(message: types.Message):
-    await message.answer("📖Ваши заказы:")
+# Размер страницы истории заказов
+ORDERS_PAGE_SIZE = int(os.getenv('ORDERS_PAGE_SIZE', 5))
 
-    user_id = message.from_user.id
+# Курсор истории заказов: created_at передаётся в callback_data в микросекундах
+EPOCH = datetime(1970, 1, 1)
 
+# Загружает страницу заказов пользователя вместе с их позициями одним запросом
+async def fetch_orders_page(user_id, before_created_at=datetime.max, before_id=0):
     async with db_pool.acquire() as conn:
-        # Получаем заказы пользователя
-        orders = await conn.fetch(
-            "SELECT id, total_price, created_at FROM orders WHERE user_id = $1 ORDER BY created_at ASC",
-            user_id
-        )
-
-        if not orders:
-            await message.answer("❌ У вас пока нет заказов.")
-            return
+        return await db.orders_page(conn, user_id, before_created_at, before_id, ORDERS_PAGE_SIZE + 1)
+
+# Отправляет страницу заказов: одно сообщение на заказ, кнопка "Показать ещё" у последнего
+async def send_orders_page(message: types.Message, orders):
+    has_more = len(orders) > ORDERS_PAGE_SIZE
+    orders = orders[:ORDERS_PAGE_SIZE]
+
+    for number, order in enumerate(orders, 1):
+        created_at = order["created_at"].strftime("%d.%m.%Y %H:%M")
+        lines = [f"📋 Заказ №{order['id']} от {created_at}\n"]
+        for name, quantity, price in zip(order["names"], order["quantities"], order["prices"]):
+            lines.append(f"📦 {name} (x{quantity}) - {price} руб за 1шт.")
+        lines.append(f"\n💰 Итоговая сумма: {order['total_price']} руб.")
+
+        markup = None
+        if has_more and number == len(orders):
+            cursor = (order["created_at"] - EPOCH) // timedelta(microseconds=1)
+            markup = InlineKeyboardMarkup().add(
+                InlineKeyboardButton("Показать ещё ⬇️", callback_data=callbacks.encode(CB_ORDERS, cursor, order['id']))
+            )
 
-        for order in orders:
-            order_id = order["id"]
-            total_price = order["total_price"]
-            created_at = order["created_at"].strftime("%d.%m.%Y %H:%M")
+        await message.answer("\n".join(lines), reply_markup=markup)
 
-            # Получаем товары для этого заказа + image_url
-            items = await conn.fetch("""
-                SELECT oi.product_name, oi.quantity, oi.price, g.image_url
-                FROM order_items oi
-                JOIN goods g ON oi.product_name = g.name
-                WHERE oi.order_id = $1
-            """, order_id)
+# Хендлер для кнопки "Мои заказы"
+@handlers.message_handler(lambda message: message.text == "📖Мои заказы")
+async def show_orders(message: types.Message):
+    orders = await fetch_orders_page(message.from_user.id)
 
-            # Формируем сообщения
-            for item in items:
-                product_name = item["product_name"]
-                quantity = item["quantity"]
-                price = item["price"]
-                image_url = item["image_url"]
+    if not orders:
+        await message.answer("❌ У вас пока нет заказов.")
+        return
 
-                text = (
-                    f"📋 Заказ №{order_id} от {created_at}\n\n"
-                    f"📦 {product_name} (x{quantity}) - {price} руб за 1шт.\n\n"
-                )
+    await message.answer("📖Ваши заказы:")
+    await send_orders_page(message, orders)
 
-                # Отправляем изображение + текст
-                await message.answer_photo(photo=image_url, caption=text)
+    await message.answer("👨🏻‍💻 ***По поводу срока выполнения заказа и доставки с вами свяжется менеджер\!***", parse_mode="MarkdownV2")
 
-            await message.answer(f"💰 Итоговая сумма: {total_price} руб.")
+# Хендлер для кнопки "Показать ещё" в истории заказов
+@router.route(CB_ORDERS)
+async def show_more_orders(callback_query: types.CallbackQuery, state: FSMContext, cursor, order_id):
+    created_at = EPOCH + timedelta(microseconds=cursor)
 
-    await message.answer("👨🏻‍💻 ***По поводу срока выполнения заказа и доставки с вами свяжется менеджер\!***", parse_mode="MarkdownV2")
+    # Убираем кнопку, чтобы одну и ту же страницу не запросили дважды
+    await callback_query.message.edit_reply_markup(reply_markup=None)
+
+    orders = await fetch_orders_page(callback_query.from_user.id, created_at, order_id)
+    await send_orders_page(callback_query.message, orders)
+    await callback_query.answer()
 
 # Хендлер для кнопки "Мой баланс"
-@dp.message_handler(lambda message: message.text == "💰Мой баланс")
+@handlers.message_handler(lambda message: message.text == "💰Мой баланс")
 async def show_balance(message: types.Message):
-    user_id = message.from_user.id
-
-    # Получаем баланс пользователя
-    async with db_pool.acquire() as conn:
-        balance = await conn.fetchrow("SELECT COALESCE(balance, 0) FROM users WHERE telegram_id = $1", user_id)
-
-    balance_value = balance[0] if balance else 0
+    user = await get_user(message.from_user.id)
+    balance_value = (user["balance"] if user else None) or 0
 
     # Создаем inline-кнопку для пополнения
-    markup = InlineKeyboardMarkup().add(InlineKeyboardButton("Пополнить баланс", callback_data="top_up_balance"))
+    markup = InlineKeyboardMarkup().add(InlineKeyboardButton("Пополнить баланс", callback_data=callbacks.encode(CB_TOP_UP)))
 
     await message.answer(f"Ваш баланс: {balance_value} руб.", reply_markup=markup)
 
 # Хендлер для нажатия на кнопку "Пополнить баланс"
-@dp.callback_query_handler(lambda call: call.data == "top_up_balance")
-async def top_up_balance(call: types.CallbackQuery):
+@router.route(CB_TOP_UP)
+async def top_up_balance(call: types.CallbackQuery, state: FSMContext):
     await call.message.answer("Введите сумму для пополнения или напишите 'отмена':")
     await BalanceStates.waiting_for_amount.set()
 
+# Максимальная сумма одного пополнения (не включительно)
+MAX_TOP_UP = Decimal(1000000)
+
 # Хендлер для ввода суммы пополнения
-@dp.message_handler(state=BalanceStates.waiting_for_amount)
+@handlers.message_handler(state=BalanceStates.waiting_for_amount)
 async def process_top_up_amount(message: types.Message, state: FSMContext):
     if message.text.lower() == "отмена":
         await message.answer("Операция пополнения отменена.")
         await state.finish()
         return
     try:
-        amount = float(message.text)
+        amount = Decimal(message.text)
+        if not amount.is_finite() or amount >= MAX_TOP_UP:
+            raise InvalidOperation
         if amount <= 0:
             await message.answer("Введите положительное число.")
             return
 
         user_id = message.from_user.id
 
-        # Обновляем баланс
-        async with db_pool.acquire() as conn:
-            await conn.execute("UPDATE users SET balance = balance + $1 WHERE telegram_id = $2", amount, user_id)
+        # Запись журнала ссылается на users: без строки пользователя (например, /start
+        # не дошёл до базы) вставка нарушила бы внешний ключ и развалила пачку соседей
+        if await get_user(user_id) is None:
+            async with db_pool.acquire() as conn:
+                await db.add_user(conn, user_id, message.from_user.username)
+
+        # Пополнение — запись в журнал баланса; записи разных пользователей пишутся пачками
+        await ledger_writer.append(user_id, amount.quantize(Decimal('0.01')), 'top_up')
+        user_cache.invalidate(user_id)
 
         await message.answer(f"Баланс успешно пополнен на {amount} руб.")
         await state.finish()
 
-    except ValueError:
+    except InvalidOperation:
         await message.answer("Введите корректное число.")
 
 
+sweeper_task = None
+folder_task = None
+prewarm_task = None
+ledger_writer = None
+metrics_runner = None
+
+# Подготовка процесса к обработке апдейтов (и при polling, и в воркере webhook)
+async def on_startup():
+    global db_pool, sweeper_task, folder_task, prewarm_task, ledger_writer, metrics_runner
+    setup()
+    metrics_runner = await metrics.start_server()  # /metrics для Prometheus
+    db_pool = await db.create_pool()
+    await storage.start(db_pool)  # Подключаем хранилище состояний к базе
+    await listen_goods_changes()  # Подписываемся на изменения каталога
+    sweeper_task = asyncio.create_task(reservations_sweeper())  # Освобождаем просроченные резервы
+    ledger_writer = ledger.LedgerWriter(db_pool)  # Пачечная запись пополнений в журнал баланса
+    ledger_writer.start()
+    folder_task = asyncio.create_task(ledger.balance_folder(db_pool))  # Сворачиваем журнал в снимок баланса
+    # Горячие запросы готовим в фоне, когда соединения для запуска уже взяты: запуск их не ждёт
+    prewarm_task = asyncio.create_task(db.prewarm_pool(db_pool))
+
+async def on_shutdown():
+    sweeper_task.cancel()
+    folder_task.cancel()
+    prewarm_task.cancel()
+    await ledger_writer.close()  # Дописываем накопленные пополнения
+    await storage.close()  # Сохраняем несброшенные состояния
+    if relisten_task:
+        relisten_task.cancel()
+    if goods_listener:
+        goods_listener.remove_termination_listener(goods_listener_lost)
+        await goods_listener.remove_listener(db.GOODS_CHANNEL, invalidate_goods)
+        await db_pool.release(goods_listener)
+    await db_pool.close()
+    await (await bot.get_session()).close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
 async def main():
-    await create_db_pool()  # Запускаем пул соединений
-    await dp.start_polling()  # Запускаем бота
+    await on_startup()
+    try:
+        await dp.start_polling()  # Запускаем бота
+    finally:
+        await on_shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())  # Асинхронно запускаем бота
+    if os.getenv('WEBHOOK_URL'):
+        webhook.run('bot')  # Webhook и несколько процессов-обработчиков
+    else:
+        asyncio.run(main())  # Асинхронно запускаем бота
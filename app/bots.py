@@ -0,0 +1,53 @@
+import os
+
+from aiogram import Dispatcher
+
+import metrics
+from pg_storage import PostgresStorage
+from sender import ThrottledBot
+
+
+class Handlers:
+    """
+    Хендлеры бота, объявленные до создания диспетчера.
+
+    Декораторы повторяют декораторы Dispatcher и только запоминают вызовы
+    register_*, а register(dp) выполняет их по порядку объявления. Поэтому
+    модуль бота импортируется без токена и без создания Bot и Dispatcher
+    (бенчмарки, сервисные скрипты, основной процесс webhook), а объекты
+    создаются при запуске.
+    """
+
+    def __init__(self):
+        self._registrations = []
+
+    def _handler(self, method, filters, kwargs):
+        def decorator(callback):
+            self._registrations.append((method, callback, filters, kwargs))
+            return callback
+        return decorator
+
+    def message_handler(self, *filters, **kwargs):
+        return self._handler('register_message_handler', filters, kwargs)
+
+    def inline_handler(self, *filters, **kwargs):
+        return self._handler('register_inline_handler', filters, kwargs)
+
+    def register(self, dp):
+        for method, callback, filters, kwargs in self._registrations:
+            getattr(dp, method)(callback, *filters, **kwargs)
+
+
+def create(namespace, handlers, token=None):
+    """
+    Создаёт бота с токеном token, по умолчанию BOT_TOKEN (все отправки — через
+    очередь с учётом лимитов Telegram), хранилище состояний в PostgreSQL
+    (подключается в on_startup) и диспетчер с хендлерами handlers. Возвращает
+    (bot, storage, dp).
+    """
+    bot = ThrottledBot(token=token or os.getenv('BOT_TOKEN'))
+    storage = PostgresStorage(namespace=namespace, ttl=int(os.getenv('FSM_TTL', 24 * 60 * 60)))
+    dp = Dispatcher(bot, storage=storage)
+    metrics.setup_dispatcher(dp)  # Время работы и ошибки хендлеров
+    handlers.register(dp)
+    return bot, storage, dp
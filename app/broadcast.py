@@ -0,0 +1,284 @@
+import json
+import time
+import asyncio
+import logging
+import contextlib
+
+import aiohttp
+from aiogram.utils.exceptions import (
+    TelegramAPIError, BotBlocked, BotKicked, UserDeactivated, ChatNotFound, CantInitiateConversation, CantTalkWithBots,
+)
+
+import metrics
+from sender import TokenBucket, bulk_sends
+
+log = logging.getLogger(__name__)
+
+broadcast_messages = metrics.register(metrics.Counter(
+    'broadcast_messages_total', 'Отправки массовых рассылок', ('status',)))
+
+# Ошибки, после которых писать пользователю бесполезно
+UNREACHABLE = (BotBlocked, BotKicked, UserDeactivated, ChatNotFound, CantInitiateConversation, CantTalkWithBots)
+
+# Сколько получателей берётся в работу за раз. При падении бота (в отличие от
+# остановки) взятые, но не отправленные получатели рассылку не получат, поэтому
+# пачка небольшая
+CLAIM_BATCH = 100
+
+# Как часто результаты отправок записываются в базу (в секундах)
+FLUSH_INTERVAL = 3.0
+
+# Первая часть ключа advisory-блокировки рассылки (вторая — id рассылки)
+LOCK_KEY = 0x5140_0002
+
+
+async def create_job(pool, text, photo=None, reply_markup=None, created_by=None):
+    """Создаёт рассылку всем пользователям и возвращает её id. reply_markup — словарь клавиатуры Bot API."""
+    async with pool.acquire() as conn:
+        return await conn.fetchval("""
+            INSERT INTO broadcast_jobs (text, photo, reply_markup, created_by, total)
+            SELECT $1, $2, $3, $4, COUNT(*) FROM users
+            RETURNING id
+        """, text, photo, json.dumps(reply_markup) if reply_markup else None, created_by)
+
+
+async def get_job(pool, job_id):
+    async with pool.acquire() as conn:
+        return await conn.fetchrow("SELECT * FROM broadcast_jobs WHERE id = $1", job_id)
+
+
+async def recent_jobs(pool, limit=5):
+    async with pool.acquire() as conn:
+        return await conn.fetch("SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT $1", limit)
+
+
+async def running_jobs(pool):
+    """Рассылки, прерванные остановкой бота."""
+    async with pool.acquire() as conn:
+        return await conn.fetch("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+
+
+async def cancel_job(pool, job_id):
+    """Останавливает рассылку: уже взятые в работу получатели ещё получат сообщение. False, если она не идёт."""
+    async with pool.acquire() as conn:
+        return await conn.fetchval("""
+            UPDATE broadcast_jobs SET status = 'cancelled', finished_at = now()
+            WHERE id = $1 AND status = 'running'
+            RETURNING true
+        """, job_id) or False
+
+
+@contextlib.asynccontextmanager
+async def job_lock(pool, job_id):
+    """
+    Advisory-блокировка рассылки на время отправки: при нескольких процессах
+    (webhook) каждую рассылку отправляет только один из них. Возвращает False,
+    если рассылку уже отправляет другой процесс. Блокировка держит соединение
+    пула и снимается при выходе или при обрыве соединения.
+    """
+    async with pool.acquire() as conn:
+        locked = await conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", LOCK_KEY, job_id)
+        try:
+            yield locked
+        finally:
+            if locked:
+                await conn.execute("SELECT pg_advisory_unlock($1, $2)", LOCK_KEY, job_id)
+
+
+def unknown(job):
+    """Получатели, взятые в работу, но без подтверждённого результата (бот остановился во время отправки)."""
+    return job["claimed"] - job["sent"] - job["failed"] - job["blocked"]
+
+
+async def claim_recipients(conn, job_id, limit=CLAIM_BATCH):
+    """
+    Берёт в работу получателей, возвращённых при остановке (return_recipients),
+    и следующих limit получателей по возрастанию telegram_id, сдвигая курсор
+    рассылки в той же команде. Одновременные вызовы (несколько процессов)
+    получают разные пачки. Пустой список — получатели кончились или рассылка
+    остановлена.
+    """
+    rows = await conn.fetch("""
+        WITH job AS (
+            SELECT last_user_id FROM broadcast_jobs WHERE id = $1 AND status = 'running' FOR UPDATE
+        ), returned AS (
+            DELETE FROM broadcast_pending p USING job
+            WHERE p.job_id = $1
+            RETURNING p.user_id
+        ), batch AS (
+            SELECT u.telegram_id FROM users u, job
+            WHERE u.telegram_id > job.last_user_id
+            ORDER BY u.telegram_id
+            LIMIT $2
+        ), claimed AS (
+            UPDATE broadcast_jobs
+            SET last_user_id = COALESCE((SELECT MAX(telegram_id) FROM batch), last_user_id),
+                claimed = claimed + (SELECT COUNT(*) FROM batch) + (SELECT COUNT(*) FROM returned)
+            WHERE id = $1 AND (EXISTS (SELECT 1 FROM batch) OR EXISTS (SELECT 1 FROM returned))
+        )
+        SELECT user_id FROM returned
+        UNION ALL
+        SELECT telegram_id FROM batch
+    """, job_id, limit)
+    return [row["user_id"] for row in rows]
+
+
+async def return_recipients(conn, job_id, user_ids):
+    """Возвращает взятых в работу, но не получивших сообщение получателей: их возьмёт следующий запуск рассылки."""
+    await conn.execute("""
+        WITH returned AS (
+            INSERT INTO broadcast_pending (job_id, user_id)
+            SELECT $1, unnest($2::bigint[])
+            ON CONFLICT DO NOTHING
+            RETURNING user_id
+        )
+        UPDATE broadcast_jobs SET claimed = claimed - (SELECT COUNT(*) FROM returned)
+        WHERE id = $1
+    """, job_id, user_ids)
+
+
+async def record_results(conn, job_id, sent, failures):
+    """Добавляет к счётчикам рассылки sent доставленных и failures — список (user_id, blocked, текст ошибки)."""
+    await conn.execute("""
+        WITH failed AS (
+            INSERT INTO broadcast_failures (job_id, user_id, blocked, error)
+            SELECT $1, * FROM unnest($3::bigint[], $4::bool[], $5::text[])
+            ON CONFLICT DO NOTHING
+            RETURNING blocked
+        )
+        UPDATE broadcast_jobs
+        SET sent = sent + $2,
+            failed = failed + (SELECT COUNT(*) FROM failed WHERE NOT blocked),
+            blocked = blocked + (SELECT COUNT(*) FROM failed WHERE blocked)
+        WHERE id = $1
+    """, job_id, sent, [item[0] for item in failures], [item[1] for item in failures], [item[2] for item in failures])
+
+
+async def run_job(pool, bot, job_id, concurrency=50, rate=25.0, progress=None):
+    """
+    Отправляет рассылку job_id всем ещё не взятым в работу получателям.
+
+    Получатели читаются из users пачками по курсору рассылки, а не загружаются
+    целиком. Сообщения отправляют concurrency задач через очередь бота в режиме
+    bulk_sends (лимиты Telegram на бота и на чат, ответы пользователям идут
+    вперёд), не чаще rate в секунду, чтобы часть общего лимита оставалась
+    пользовательскому боту. Получатель считается взятым до отправки, поэтому
+    после падения рассылка продолжается без повторных сообщений; те, чья отправка
+    не успела подтвердиться, считаются неизвестными (unknown). При остановке
+    (отмене задачи) взятые получатели, чьё сообщение ещё не передано боту,
+    возвращаются в рассылку.
+
+    progress(job) вызывается после каждой записи результатов. Возвращает итоговую
+    запись broadcast_jobs.
+    """
+    job = await get_job(pool, job_id)
+    markup = json.loads(job["reply_markup"]) if job["reply_markup"] else None
+    photo = job["photo"]
+    bucket = TokenBucket(rate, max(rate, 1))
+    queue = asyncio.Queue(concurrency)
+    sent = 0
+    failures = []
+    unsent = set()  # Взятые получатели, чьё сообщение ещё не передано боту
+
+    async def send(user_id):
+        nonlocal sent, photo
+        # Лимит скорости рассылки
+        wait = bucket.delay(time.monotonic())
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = bucket.delay(time.monotonic())
+        bucket.consume()
+        unsent.discard(user_id)
+        try:
+            if photo:
+                message = await bot.send_photo(user_id, photo, caption=job["text"], reply_markup=markup)
+                if photo.startswith(('http://', 'https://')):
+                    # Фото по ссылке Telegram скачивает один раз: дальше отправляем его file_id
+                    photo = message.photo[-1].file_id
+            else:
+                await bot.send_message(user_id, job["text"], reply_markup=markup)
+        except UNREACHABLE as e:
+            failures.append((user_id, True, str(e)))
+            broadcast_messages.inc('blocked')
+        except (TelegramAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            failures.append((user_id, False, str(e) or type(e).__name__))
+            broadcast_messages.inc('failed')
+        else:
+            sent += 1
+            broadcast_messages.inc('sent')
+
+    async def worker():
+        with bulk_sends():
+            while True:
+                user_id = await queue.get()
+                if user_id is None:
+                    return
+                await send(user_id)
+
+    async def flush():
+        # Записанное вычитается только после успешной записи: если запись не удалась,
+        # результаты запишет следующий вызов
+        nonlocal sent
+        if not sent and not failures:
+            return
+        batch_sent, batch_failures = sent, failures[:]
+        async with pool.acquire() as conn:
+            await record_results(conn, job_id, batch_sent, batch_failures)
+            sent -= batch_sent
+            del failures[:len(batch_failures)]
+
+    async def flusher():
+        nonlocal flushing
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                # Запись не прерывается остановкой: её дожидаются перед последней записью
+                flushing = asyncio.ensure_future(flush())
+                await asyncio.shield(flushing)
+                if progress:
+                    await progress(await get_job(pool, job_id))
+            except Exception:
+                log.exception("Не удалось записать результаты рассылки %s", job_id)
+
+    async def claim():
+        async with pool.acquire() as conn:
+            user_ids = await claim_recipients(conn, job_id)
+        unsent.update(user_ids)
+        return user_ids
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    flush_task = asyncio.create_task(flusher())
+    claiming = flushing = None
+    try:
+        while True:
+            # Взятие пачки не прерывается остановкой: иначе получатели были бы взяты, но не учтены в unsent
+            claiming = asyncio.ensure_future(claim())
+            user_ids = await asyncio.shield(claiming)
+            if not user_ids:
+                break
+            for user_id in user_ids:
+                await queue.put(user_id)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        flush_task.cancel()
+        for task in workers:
+            task.cancel()
+        await asyncio.wait([flush_task])
+        for task in (claiming, flushing):
+            if task is not None:
+                await asyncio.wait([task])
+        if unsent:
+            async with pool.acquire() as conn:
+                await return_recipients(conn, job_id, list(unsent))
+        # Подтверждённые отправки записываем и при остановке, иначе они останутся неизвестными
+        await flush()
+
+    async with pool.acquire() as conn:
+        finished = await conn.fetchrow("""
+            UPDATE broadcast_jobs SET status = 'done', finished_at = now()
+            WHERE id = $1 AND status = 'running'
+            RETURNING *
+        """, job_id)
+    return finished or await get_job(pool, job_id)
@@ -0,0 +1,72 @@
+import time
+import asyncio
+from collections import OrderedDict
+
+import metrics
+
+cache_hits = metrics.register(metrics.Counter('cache_hits_total', 'Попадания в кэш', ('cache',)))
+cache_misses = metrics.register(metrics.Counter('cache_misses_total', 'Промахи кэша', ('cache',)))
+
+
+class TTLCache:
+    """
+    Кэш в памяти процесса: не больше maxsize записей (вытесняются давно
+    использованные), каждая запись живёт ttl секунд.
+
+    get_or_load загружает отсутствующее значение корутиной loader; одновременные
+    запросы одного ключа ждут одну загрузку.
+    """
+
+    def __init__(self, name, maxsize=10000, ttl=60.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # ключ -> (момент устаревания, значение)
+        self._loading = {}  # ключ -> задача загрузки
+
+    def get(self, key, default=None):
+        """Неустаревшее значение из кэша без загрузки или default."""
+        entry = self._data.get(key)
+        return entry[1] if entry is not None and entry[0] > time.monotonic() else default
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+        # Загрузка, начатая до изменения, могла прочитать старое значение: её результат не сохраняем
+        self._loading.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._loading.clear()
+
+    def drop_loading(self):
+        """Результаты начатых загрузок не сохраняются: они могли прочитать данные до изменения."""
+        self._loading.clear()
+
+    async def get_or_load(self, key, loader):
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                cache_hits.inc(self.name)
+                return entry[1]
+            del self._data[key]
+        cache_misses.inc(self.name)
+
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.ensure_future(loader())
+            task.add_done_callback(lambda done: self._loaded(key, done))
+        return await asyncio.shield(task)
+
+    def _loaded(self, key, task):
+        if self._loading.get(key) is not task:
+            return  # Ключ сброшен во время загрузки
+        del self._loading[key]
+        if not task.cancelled() and task.exception() is None:
+            self.set(key, task.result())
@@ -0,0 +1,135 @@
+import os
+import hmac
+import base64
+import hashlib
+import logging
+
+from aiogram import types
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Версия формата: кнопки старого формата отклоняются, а не разбираются неправильно
+VERSION = 1
+
+# Длина подписи в байтах (HMAC-SHA256, усечённый)
+MAC_SIZE = 8
+
+# Лимит Telegram на callback_data
+MAX_LENGTH = 64
+
+
+class InvalidCallback(Exception):
+    pass
+
+
+def _secret():
+    secret = os.getenv('CALLBACK_SECRET')
+    if secret:
+        return secret.encode()
+    token = os.getenv('BOT_TOKEN')
+    if not token:
+        raise RuntimeError("Не заданы CALLBACK_SECRET и BOT_TOKEN: нечем подписывать callback_data")
+    # Ключ по умолчанию выводится из токена: у всех процессов бота он одинаковый
+    return hashlib.sha256(b'callback-data:' + token.encode()).digest()
+
+
+# Ключ подписи вычисляется при первом использовании, а не при импорте: модуль
+# импортируется раньше, чем load_dotenv() загрузит переменные из .env
+_key = None
+
+
+def key():
+    """Ключ подписи callback_data; RuntimeError, если ни CALLBACK_SECRET, ни BOT_TOKEN не заданы."""
+    global _key
+    if _key is None:
+        _key = _secret()
+    return _key
+
+
+def _sign(payload):
+    return hmac.new(key(), payload, hashlib.sha256).digest()[:MAC_SIZE]
+
+
+def _write_varint(buffer, value):
+    value = value * 2 if value >= 0 else -value * 2 - 1  # zigzag: отрицательные числа тоже короткие
+    while value >= 0x80:
+        buffer.append(value & 0x7F | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varints(payload):
+    values = []
+    value = shift = 0
+    for byte in payload:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value >> 1 if not value & 1 else -(value >> 1) - 1)
+            value = shift = 0
+    if shift:
+        raise InvalidCallback("обрезанное число")
+    return values
+
+
+def encode(tag, *values):
+    """callback_data из тега действия (0–255) и целых чисел: base64 от версии, тега, чисел и подписи."""
+    payload = bytearray((VERSION, tag))
+    for value in values:
+        _write_varint(payload, value)
+    data = base64.urlsafe_b64encode(bytes(payload) + _sign(bytes(payload))).rstrip(b'=').decode()
+    if len(data) > MAX_LENGTH:
+        raise ValueError(f"callback_data длиннее {MAX_LENGTH} символов")
+    return data
+
+
+def decode(data):
+    """Возвращает (тег, [числа]) или выбрасывает InvalidCallback."""
+    try:
+        raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    except (ValueError, TypeError):
+        raise InvalidCallback("не base64")
+    payload, mac = raw[:-MAC_SIZE], raw[-MAC_SIZE:]
+    if len(payload) < 2 or not hmac.compare_digest(mac, _sign(payload)):
+        raise InvalidCallback("неверная подпись")
+    if payload[0] != VERSION:
+        raise InvalidCallback(f"версия {payload[0]}")
+    return payload[1], _read_varints(payload[2:])
+
+
+class CallbackRouter:
+    """
+    Маршрутизация нажатий на кнопки по тегу из callback_data.
+
+    Вместо цепочки фильтров, которые aiogram проверяет по очереди, на все
+    нажатия регистрируется один хендлер, который находит обработчик в словаре.
+    Обработчик получает нажатие, FSMContext и числа из callback_data.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+
+    def route(self, tag):
+        def decorator(handler):
+            if tag in self.handlers:
+                raise ValueError(f"Тег {tag} уже занят обработчиком {self.handlers[tag].__name__}")
+            self.handlers[tag] = handler
+            return handler
+        return decorator
+
+    def register(self, dp, **filters):
+        key()  # Без ключа подписи бот не запускается
+        dp.register_callback_query_handler(self.dispatch, **filters)
+
+    async def dispatch(self, callback_query: types.CallbackQuery, state):
+        try:
+            tag, values = decode(callback_query.data or '')
+            handler = self.handlers[tag]
+        except (InvalidCallback, KeyError) as e:
+            log.info("Отклонено нажатие %r: %s", callback_query.data, e)
+            await callback_query.answer("Кнопка устарела, откройте раздел заново.", show_alert=True)
+            return
+        metrics.set_handler_name(handler.__name__)
+        return await handler(callback_query, state, *values)
@@ -0,0 +1,519 @@
+import os
+import asyncio
+import logging
+from datetime import datetime
+from decimal import Decimal
+from typing import List, Optional, Sequence
+
+import asyncpg
+
+import metrics
+from migrate import migrate
+
+log = logging.getLogger(__name__)
+
+# Канал PostgreSQL, по которому пользовательский бот сбрасывает кэш каталога
+GOODS_CHANNEL = 'goods_changed'
+
+# Запросы, которые готовятся на каждом соединении сразу после подключения
+_prewarm_queries = []
+# Хуки init пула: вызываются для каждого нового соединения
+_init_hooks = [metrics.init_connection]  # Замер времени запросов
+
+
+def prewarm(query):
+    """Добавляет запрос к готовящимся при подключении и возвращает его текст."""
+    _prewarm_queries.append(query)
+    return query
+
+
+def on_connect(hook):
+    """Добавляет хук (корутина от соединения), который вызывается для каждого нового соединения пула."""
+    _init_hooks.append(hook)
+    return hook
+
+
+class Connection(asyncpg.Connection):
+    """Соединение, заранее прогревающее серверный процесс под горячие запросы."""
+
+    async def prewarm(self, queries):
+        """
+        Готовит запросы и кладёт их в кэш подготовленных запросов соединения тем
+        же путём, что fetch() и execute() с параметрами (prepare() кэш не
+        заполняет), поэтому первое выполнение уже не разбирает запрос. Заодно
+        серверный процесс нового соединения загружает в свои кэши описания
+        таблиц, индексов и типов. Запросы к ещё не созданным столбцам и таблицам
+        (до миграции) пропускаются. Возвращает число подготовленных запросов.
+        """
+        prepared = 0
+        for query in queries:
+            try:
+                await self._get_statement(query, None)
+            except asyncpg.PostgresError as e:
+                log.debug("Запрос не подготовлен при подключении: %s", e)
+            else:
+                prepared += 1
+        # Подготовка не завершает неявную транзакцию: без синхронизации соединение
+        # до первого запроса держало бы блокировки таблиц (и мешало autovacuum и миграциям)
+        await self.execute("SELECT 1")
+        return prepared
+
+
+async def create_pool(min_size=10, max_size=10, prepare=True):
+    """
+    Создаёт пул соединений для бота и доводит схему базы до актуальной версии.
+
+    Параметры подключения берутся из DB_*, размер пула — из DB_POOL_MIN_SIZE и
+    DB_POOL_MAX_SIZE (по умолчанию min_size и max_size). min_size соединений
+    открываются сразу; горячие запросы на них готовит prewarm_pool(), которую
+    бот запускает в фоне в конце своего запуска, а соединения, открытые позже,
+    готовят их при подключении. Подготовленные запросы лежат в кэше соединения,
+    поэтому первые апдейты не ждут их разбора и загрузки описаний таблиц и
+    типов. Простаивающие соединения по умолчанию не закрываются
+    (DB_POOL_IDLE_LIFETIME, секунд; 0 — никогда): вместе с соединением пропал
+    бы и его кэш. prepare=False — без подготовки (пулу не нужны запросы
+    покупателей).
+    """
+    warm = False  # До миграций запросы к новым таблицам не подготовить
+
+    async def init(conn):
+        for hook in _init_hooks:
+            await hook(conn)
+        if warm:
+            await conn.prewarm(_prewarm_queries)
+
+    pool = await asyncpg.create_pool(
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        database=os.getenv('DB_NAME'),
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT'),
+        min_size=int(os.getenv('DB_POOL_MIN_SIZE', min_size)),
+        max_size=int(os.getenv('DB_POOL_MAX_SIZE', max_size)),
+        max_inactive_connection_lifetime=float(os.getenv('DB_POOL_IDLE_LIFETIME', 0)),
+        statement_cache_size=int(os.getenv('DB_STATEMENT_CACHE_SIZE', 200)),
+        connection_class=Connection,
+        init=init,
+    )
+    pool = metrics.InstrumentedPool(pool)
+    await migrate(pool)
+    warm = prepare
+    return pool
+
+
+async def prewarm_pool(pool):
+    """
+    Готовит горячие запросы на свободных соединениях пула, открытых при запуске.
+
+    Подготовка занимает соединения на время разбора запросов (в основном
+    загрузка типов массивов asyncpg), поэтому бот вызывает её в фоне после
+    того, как сам взял нужные ему при запуске соединения. Апдейты, пришедшие
+    раньше, ждут соединение не дольше подготовки одного соединения.
+    Возвращает число подготовленных соединений.
+    """
+    async def prewarm_one():
+        async with pool.acquire() as conn:
+            await conn.prewarm(_prewarm_queries)
+
+    results = await asyncio.gather(*(prewarm_one() for _ in range(pool.get_idle_size())), return_exceptions=True)
+    failed = [result for result in results if isinstance(result, Exception)]
+    if failed:
+        log.warning("Горячие запросы не подготовлены на %d соединениях: %s", len(failed), failed[0])
+    return len(results) - len(failed)
+
+
+async def notify_goods_changed(conn, product_ids: Optional[Sequence[int]] = None) -> None:
+    """
+    Сообщает пользовательским ботам (после коммита), что изменились остатки
+    товаров product_ids, а без них — каталог целиком (товары добавлены,
+    удалены или изменены). Payload — id товаров через запятую или пустая
+    строка; слишком длинный список заменяется сбросом всего каталога.
+    """
+    payload = ','.join(map(str, sorted(set(product_ids)))) if product_ids else ''
+    if len(payload) > NOTIFY_PAYLOAD_LIMIT:
+        payload = ''
+    await conn.execute(NOTIFY_GOODS, GOODS_CHANNEL, payload)
+
+
+# Наибольшая длина payload NOTIFY (лимит PostgreSQL — 8000 байт)
+NOTIFY_PAYLOAD_LIMIT = 7900
+
+NOTIFY_GOODS = prewarm("SELECT pg_notify($1, $2)")
+
+
+# Пользователи и баланс
+
+ADD_USER = prewarm("""
+    INSERT INTO users (telegram_id, username, balance)
+    VALUES ($1, $2, 0)
+    ON CONFLICT (telegram_id) DO NOTHING
+""")
+
+# Баланс — снимок из users плюс несвёрнутые записи журнала balance_ledger
+USER = prewarm("""
+    SELECT u.telegram_id, u.username, u.balance + COALESCE((
+        SELECT SUM(amount) FROM balance_ledger WHERE user_id = u.telegram_id AND NOT folded
+    ), 0) AS balance
+    FROM users u
+    WHERE u.telegram_id = $1
+""")
+
+# Текущий баланс: снимок в users плюс ещё не свёрнутые записи журнала
+BALANCE = prewarm("""
+    SELECT u.balance + COALESCE((
+        SELECT SUM(amount) FROM balance_ledger WHERE user_id = u.telegram_id AND NOT folded
+    ), 0)
+    FROM users u
+    WHERE u.telegram_id = $1
+""")
+
+LOCK_USER = prewarm("SELECT 1 FROM users WHERE telegram_id = $1 FOR UPDATE")
+
+ADD_PURCHASE = prewarm(
+    "INSERT INTO balance_ledger (user_id, amount, kind, order_id) VALUES ($1, $2, 'purchase', $3)")
+
+
+async def add_user(conn, telegram_id: int, username: Optional[str]) -> None:
+    """Добавляет пользователя с нулевым балансом; повторный вызов ничего не меняет."""
+    await conn.execute(ADD_USER, telegram_id, username)
+
+
+async def fetch_user(conn, telegram_id: int) -> Optional[asyncpg.Record]:
+    """(telegram_id, username, balance) или None."""
+    return await conn.fetchrow(USER, telegram_id)
+
+
+async def fetch_balance(conn, telegram_id: int) -> Optional[Decimal]:
+    return await conn.fetchval(BALANCE, telegram_id)
+
+
+async def lock_user(conn, telegram_id: int) -> None:
+    """Блокирует строку пользователя до конца транзакции."""
+    await conn.execute(LOCK_USER, telegram_id)
+
+
+async def add_purchase(conn, telegram_id: int, amount: Decimal, order_id: int) -> None:
+    """Списывает сумму заказа с баланса записью в журнал."""
+    await conn.execute(ADD_PURCHASE, telegram_id, -amount, order_id)
+
+
+# Каталог и поиск
+
+CATALOG_NEXT = prewarm("""
+    SELECT id, name, description, quantity, price, image_url FROM goods
+    WHERE id > $1 ORDER BY id LIMIT $2
+""")
+
+CATALOG_PREV = prewarm("""
+    SELECT id, name, description, quantity, price, image_url FROM goods
+    WHERE id < $1 ORDER BY id DESC LIMIT $2
+""")
+
+PRODUCT = prewarm("SELECT id, name, quantity, price FROM goods WHERE id = $1")
+
+PRODUCT_QUANTITY = prewarm("SELECT quantity FROM goods WHERE id = $1")
+
+SEARCH_ALL = prewarm("""
+    SELECT id, name, quantity, price, image_url, telegram_file_id FROM goods
+    WHERE id > $1 ORDER BY id LIMIT $2
+""")
+
+SEARCH = prewarm("""
+    SELECT id, name, quantity, price, image_url, telegram_file_id FROM goods
+    WHERE search_vector @@ to_tsquery('simple', $1) AND id > $2
+    ORDER BY id LIMIT $3
+""")
+
+
+async def catalog_page(conn, cursor: int, limit: int, forward: bool = True) -> List[asyncpg.Record]:
+    """
+    До limit товаров после товара cursor (forward) или перед ним; keyset-пагинация
+    по id. Товары перед курсором возвращаются по убыванию id.
+    """
+    return await conn.fetch(CATALOG_NEXT if forward else CATALOG_PREV, cursor, limit)
+
+
+async def fetch_product(conn, product_id: int) -> Optional[asyncpg.Record]:
+    """(id, name, quantity, price) или None."""
+    return await conn.fetchrow(PRODUCT, product_id)
+
+
+async def product_quantity(conn, product_id: int) -> Optional[int]:
+    return await conn.fetchval(PRODUCT_QUANTITY, product_id)
+
+
+async def search_goods(conn, tsquery: Optional[str], after_id: int, limit: int) -> List[asyncpg.Record]:
+    """Товары по запросу to_tsquery (индекс goods_search_idx), без запроса — все; по возрастанию id после after_id."""
+    if not tsquery:
+        return await conn.fetch(SEARCH_ALL, after_id, limit)
+    return await conn.fetch(SEARCH, tsquery, after_id, limit)
+
+
+# Корзина и резервы
+
+# Списывает товар со склада и добавляет его в корзину одной командой. reserved_price
+# пустой — товара не хватило, quantity пустой — в корзине позиция без резерва
+RESERVE = prewarm("""
+    WITH reserved AS (
+        UPDATE goods SET quantity = quantity - $3
+        WHERE id = $2 AND quantity >= $3
+        RETURNING price
+    ), added AS (
+        INSERT INTO carts (user_id, product_id, price, quantity, reserved_until)
+        SELECT $1, $2, price, $3, now() + $4::float8 * interval '1 second' FROM reserved
+        ON CONFLICT (user_id, product_id) DO UPDATE
+        SET quantity = carts.quantity + EXCLUDED.quantity, price = EXCLUDED.price, reserved_until = EXCLUDED.reserved_until
+        WHERE carts.reserved_until IS NOT NULL
+        RETURNING price, quantity
+    )
+    SELECT (SELECT price FROM reserved) AS reserved_price, price, quantity FROM added
+    RIGHT JOIN (SELECT 1) AS one ON true
+""")
+
+RESERVE_LEGACY = """
+    WITH legacy AS (
+        SELECT quantity FROM carts WHERE user_id = $1 AND product_id = $2 FOR UPDATE
+    ), reserved AS (
+        UPDATE goods g SET quantity = g.quantity - legacy.quantity
+        FROM legacy
+        WHERE g.id = $2 AND g.quantity >= legacy.quantity
+        RETURNING g.price
+    )
+    UPDATE carts c SET quantity = c.quantity + $3, price = reserved.price,
+                       reserved_until = now() + $4::float8 * interval '1 second'
+    FROM reserved
+    WHERE c.user_id = $1 AND c.product_id = $2
+    RETURNING c.price, c.quantity
+"""
+
+DECREASE_CART_ITEM = prewarm("""
+    UPDATE carts SET quantity = quantity - $3
+    WHERE user_id = $1 AND product_id = $2 AND quantity > $3
+    RETURNING $3 AS released, reserved_until IS NOT NULL AS reserved
+""")
+
+DELETE_CART_ITEM = prewarm("""
+    DELETE FROM carts WHERE user_id = $1 AND product_id = $2
+    RETURNING quantity AS released, reserved_until IS NOT NULL AS reserved
+""")
+
+# Строки goods блокируются раньше строк carts (как в RESERVE), поэтому просроченные
+# резервы сначала выбираются без блокировки, а удаляются после блокировки их товаров
+EXPIRED_RESERVATIONS = prewarm("""
+    SELECT id, product_id FROM carts
+    WHERE reserved_until < now()
+    ORDER BY id
+    LIMIT $1
+""")
+
+# ANY(ARRAY(...)) вместо IN: удаление идёт по первичному ключу, без чтения всей таблицы.
+# Срок проверяется заново: резерв могли продлить, пока ждали блокировки товаров
+RELEASE_EXPIRED = prewarm("""
+    DELETE FROM carts
+    WHERE id = ANY(ARRAY(
+        SELECT id FROM carts
+        WHERE id = ANY($1::int[]) AND reserved_until < now()
+        FOR UPDATE SKIP LOCKED
+    ))
+    RETURNING product_id, quantity
+""")
+
+LOCK_GOODS = prewarm("SELECT id FROM goods WHERE id = ANY($1::int[]) ORDER BY id FOR UPDATE")
+
+RESTOCK = prewarm("""
+    UPDATE goods g SET quantity = g.quantity + r.quantity
+    FROM (
+        SELECT product_id, SUM(quantity) AS quantity
+        FROM unnest($1::int[], $2::int[]) AS t(product_id, quantity)
+        GROUP BY product_id
+    ) r
+    WHERE g.id = r.product_id
+""")
+
+# Цена зарезервированных позиций — цена резерва, остальных — текущая
+CART = prewarm("""
+    SELECT c.product_id, g.name, c.quantity,
+           CASE WHEN c.reserved_until IS NULL THEN g.price ELSE c.price END AS price
+    FROM carts c
+    JOIN goods g ON c.product_id = g.id
+    WHERE c.user_id = $1
+    ORDER BY c.id
+""")
+
+
+async def reserve(conn, user_id: int, product_id: int, quantity: int, ttl: float) -> asyncpg.Record:
+    """(reserved_price, price, quantity), см. RESERVE."""
+    return await conn.fetchrow(RESERVE, user_id, product_id, quantity, ttl)
+
+
+async def reserve_legacy(conn, user_id: int, product_id: int, quantity: int, ttl: float) -> Optional[asyncpg.Record]:
+    """
+    Резервирует позицию без резерва (добавленную до появления резервов) целиком
+    вместе с quantity новыми единицами. (price, quantity) или None, если товара не хватило.
+    """
+    return await conn.fetchrow(RESERVE_LEGACY, user_id, product_id, quantity, ttl)
+
+
+async def decrease_cart_item(conn, user_id: int, product_id: int, quantity: int) -> Optional[asyncpg.Record]:
+    """Уменьшает позицию, если в ней останется хотя бы одна единица. (released, reserved) или None."""
+    return await conn.fetchrow(DECREASE_CART_ITEM, user_id, product_id, quantity)
+
+
+async def delete_cart_item(conn, user_id: int, product_id: int) -> Optional[asyncpg.Record]:
+    """Удаляет позицию. (released, reserved) или None, если её не было."""
+    return await conn.fetchrow(DELETE_CART_ITEM, user_id, product_id)
+
+
+async def release_expired(conn, limit: int) -> List[asyncpg.Record]:
+    """
+    Удаляет до limit просроченных резервов и возвращает их (product_id, quantity).
+    Вызывается в транзакции: строки goods их товаров остаются заблокированными для
+    restock. Строки, заблокированные оформляющимся заказом, пропускаются.
+    """
+    expired = await conn.fetch(EXPIRED_RESERVATIONS, limit)
+    if not expired:
+        return []
+    await lock_goods(conn, [row["product_id"] for row in expired])
+    return await conn.fetch(RELEASE_EXPIRED, [row["id"] for row in expired])
+
+
+async def lock_goods(conn, product_ids: Sequence[int]) -> None:
+    """
+    Блокирует строки goods по возрастанию id, чтобы транзакции не ждали друг друга
+    крест-накрест. Изменяющие склад транзакции блокируют goods раньше carts.
+    """
+    await conn.execute(LOCK_GOODS, product_ids)
+
+
+async def restock(conn, product_ids: Sequence[int], quantities: Sequence[int]) -> None:
+    """Возвращает товары на склад одним запросом (строки goods уже заблокированы)."""
+    await conn.execute(RESTOCK, product_ids, quantities)
+
+
+async def cart_items(conn, user_id: int) -> List[asyncpg.Record]:
+    """Позиции корзины (product_id, name, quantity, price) в порядке добавления."""
+    return await conn.fetch(CART, user_id)
+
+
+# Оформление заказа
+
+UNRESERVED_CART_PRODUCTS = prewarm("""
+    SELECT DISTINCT product_id FROM carts WHERE user_id = $1 AND reserved_until IS NULL
+""")
+
+CHECKOUT_CART = prewarm("""
+    SELECT c.id AS cart_item_id, g.id, g.name, c.quantity, c.reserved_until IS NOT NULL AS reserved,
+           CASE WHEN c.reserved_until IS NULL THEN g.price ELSE c.price END AS price
+    FROM carts c
+    JOIN goods g ON c.product_id = g.id
+    WHERE c.user_id = $1
+    ORDER BY c.id
+    FOR UPDATE OF c
+""")
+
+TAKE_STOCK = prewarm("""
+    UPDATE goods g SET quantity = g.quantity - r.quantity
+    FROM (
+        SELECT product_id, SUM(quantity) AS quantity
+        FROM unnest($1::int[], $2::int[]) AS t(product_id, quantity)
+        GROUP BY product_id
+    ) r
+    WHERE g.id = r.product_id AND g.quantity >= r.quantity
+    RETURNING g.id
+""")
+
+CREATE_ORDER = prewarm("INSERT INTO orders (user_id, total_price) VALUES ($1, $2) RETURNING id")
+
+ADD_ORDER_ITEMS = prewarm("""
+    INSERT INTO order_items (order_id, product_id, product_name, quantity, price, total_price)
+    SELECT $1, product_id, product_name, quantity, price, price * quantity
+    FROM unnest($2::int[], $3::text[], $4::int[], $5::numeric[])
+        AS t(product_id, product_name, quantity, price)
+""")
+
+DELETE_CART_ROWS = prewarm("DELETE FROM carts WHERE id = ANY($1::int[])")
+
+
+async def unreserved_cart_products(conn, user_id: int) -> List[int]:
+    """
+    Товары позиций корзины без резерва, без блокировки: их строки goods
+    оформление блокирует раньше корзины. Новые позиции без резерва не
+    появляются (такие позиции только резервируются или удаляются), поэтому
+    после блокировки корзины их не станет больше.
+    """
+    return [row["product_id"] for row in await conn.fetch(UNRESERVED_CART_PRODUCTS, user_id)]
+
+
+async def lock_cart(conn, user_id: int) -> List[asyncpg.Record]:
+    """
+    Блокирует и возвращает позиции корзины для оформления: (cart_item_id, id,
+    name, quantity, reserved, price). Зарезервированные позиции уже списаны со
+    склада по цене резерва, позиции без резерва — нет.
+    """
+    return await conn.fetch(CHECKOUT_CART, user_id)
+
+
+async def take_stock(conn, product_ids: Sequence[int], quantities: Sequence[int]) -> int:
+    """
+    Списывает товары со склада там, где хватает остатка (строки goods уже
+    заблокированы), и возвращает число списанных товаров.
+    """
+    return len(await conn.fetch(TAKE_STOCK, product_ids, quantities))
+
+
+async def create_order(conn, user_id: int, total_price: Decimal) -> int:
+    return await conn.fetchval(CREATE_ORDER, user_id, total_price)
+
+
+async def add_order_items(conn, order_id: int, items: Sequence[asyncpg.Record]) -> None:
+    """Добавляет позиции заказа одним запросом из записей lock_cart."""
+    await conn.execute(ADD_ORDER_ITEMS, order_id,
+                       [item["id"] for item in items], [item["name"] for item in items],
+                       [item["quantity"] for item in items], [item["price"] for item in items])
+
+
+async def delete_cart_rows(conn, cart_item_ids: Sequence[int]) -> None:
+    await conn.execute(DELETE_CART_ROWS, cart_item_ids)
+
+
+# История заказов
+
+ORDERS_PAGE = prewarm("""
+    WITH page AS (
+        SELECT id, total_price, created_at
+        FROM orders
+        WHERE user_id = $1 AND (created_at, id) < ($2, $3)
+        ORDER BY created_at DESC, id DESC
+        LIMIT $4
+    )
+    SELECT p.id, p.total_price, p.created_at,
+           array_agg(oi.product_name ORDER BY oi.id) AS names,
+           array_agg(oi.quantity ORDER BY oi.id) AS quantities,
+           array_agg(oi.price ORDER BY oi.id) AS prices
+    FROM page p
+    JOIN order_items oi ON oi.order_id = p.id
+    GROUP BY p.id, p.total_price, p.created_at
+    ORDER BY p.created_at DESC, p.id DESC
+""")
+
+
+async def orders_page(conn, user_id: int, before_created_at: datetime, before_id: int, limit: int) -> List[asyncpg.Record]:
+    """
+    До limit заказов пользователя, оформленных раньше (before_created_at,
+    before_id), с позициями: (id, total_price, created_at, names, quantities, prices).
+    """
+    return await conn.fetch(ORDERS_PAGE, user_id, before_created_at, before_id, limit)
+
+
+# Товары (админ-бот)
+
+ADD_PRODUCT = """
+    INSERT INTO goods (name, description, quantity, price, image_url, telegram_file_id)
+    VALUES ($1, $2, $3, $4, $5, $6)
+    RETURNING id
+"""
+
+
+async def add_product(conn, name: str, description: str, quantity: int, price: Decimal,
+                      image_url: Optional[str], telegram_file_id: Optional[str] = None) -> int:
+    return await conn.fetchval(ADD_PRODUCT, name, description, quantity, price, image_url, telegram_file_id)
@@ -0,0 +1,226 @@
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+
+import aiohttp
+from aiohttp import web
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+image_upload_latency = metrics.register(metrics.Histogram(
+    'image_upload_latency_seconds', 'Время загрузки изображения в хранилище', ('backend',)))
+image_upload_errors = metrics.register(metrics.Counter(
+    'image_upload_errors_total', 'Неудачные попытки загрузки изображения', ('backend',)))
+image_dedupe_hits = metrics.register(metrics.Counter(
+    'image_dedupe_hits_total', 'Изображения, уже загруженные ранее (загрузка пропущена)'))
+
+# Расширения, которые сохраняются как есть; остальные файлы считаются JPEG
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+
+
+class UploadError(Exception):
+    """Хранилище не приняло изображение. retryable — имеет ли смысл повторить попытку."""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class CircuitOpen(UploadError):
+    def __init__(self):
+        super().__init__("хранилище изображений временно недоступно", retryable=False)
+
+
+class CircuitBreaker:
+    """
+    После failure_threshold ошибок подряд перестаёт пропускать запросы на
+    reset_timeout секунд, затем пропускает один пробный запрос. Ошибкой
+    считается только недоступность хранилища (5xx, таймаут, сетевая ошибка).
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self.probing = True  # Пробный запрос после паузы
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Запрос завершился, ничего не сказав о доступности хранилища (отменён, 4xx): следующий снова пробный."""
+        self.probing = False
+
+
+def _extension(filename):
+    extension = os.path.splitext(filename or '')[1].lower()
+    return extension if extension in IMAGE_EXTENSIONS else '.jpg'
+
+
+class ImgbbBackend:
+    name = 'imgbb'
+
+    def __init__(self, session, upload_url, api_key):
+        self.session = session
+        self.upload_url = upload_url
+        self.api_key = api_key
+
+    async def upload(self, data, digest, filename):
+        form = aiohttp.FormData()
+        form.add_field("key", self.api_key or '')
+        form.add_field("image", data, filename=digest + _extension(filename))
+        async with self.session.post(self.upload_url, data=form) as response:
+            if response.status != 200:
+                # 4xx — ошибка в запросе (ключ, формат), повтор не поможет
+                raise UploadError(f"imgbb ответил {response.status}", retryable=response.status >= 500 or response.status == 429)
+            result = await response.json()
+            return result["data"]["image"]["url"]
+
+
+class LocalBackend:
+    """Файлы в каталоге directory по адресу содержимого: <первые 2 символа хэша>/<хэш>.<расширение>."""
+
+    name = 'local'
+
+    def __init__(self, directory, public_url):
+        self.directory = directory
+        self.public_url = public_url.rstrip('/')
+
+    def _write(self, data, path):
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Запись во временный файл и переименование: читатели не увидят недописанный файл
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+    async def upload(self, data, digest, filename):
+        relative = f"{digest[:2]}/{digest}{_extension(filename)}"
+        await asyncio.to_thread(self._write, data, os.path.join(self.directory, relative))
+        return f"{self.public_url}/{relative}"
+
+
+class ImageStore:
+    """
+    Сохраняет изображения в backend без повторных загрузок.
+
+    Изображение идентифицируется SHA-256 содержимого: ссылки на уже загруженные
+    изображения берутся из таблицы images, одновременные загрузки одного и того
+    же изображения выполняются один раз. Неудачные загрузки повторяются с
+    экспоненциальной паузой, а при серии ошибок backend отключается на время
+    (CircuitBreaker), чтобы импорт не ждал таймаутов на каждой строке.
+    """
+
+    def __init__(self, pool, backend, max_retries=3, retry_delay=0.5, breaker=None):
+        self.pool = pool
+        self.backend = backend
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.breaker = breaker or CircuitBreaker()
+        self._in_flight = {}  # хэш -> задача загрузки
+
+    async def store(self, data, filename=None):
+        """Возвращает ссылку на изображение data (bytes, bytearray или memoryview)."""
+        digest = hashlib.sha256(data).hexdigest()
+        async with self.pool.acquire() as conn:
+            url = await conn.fetchval("SELECT url FROM images WHERE backend = $1 AND sha256 = $2", self.backend.name, digest)
+        if url:
+            image_dedupe_hits.inc()
+            return url
+
+        task = self._in_flight.get(digest)
+        if task is None:
+            task = self._in_flight[digest] = asyncio.ensure_future(self._upload(data, digest, filename))
+            task.add_done_callback(lambda done: self._in_flight.pop(digest, None))
+        else:
+            image_dedupe_hits.inc()
+        return await asyncio.shield(task)
+
+    async def _upload(self, data, digest, filename):
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpen()
+            try:
+                async with metrics.timed(image_upload_latency, self.backend.name):
+                    url = await self.backend.upload(data, digest, filename)
+                self.breaker.record_success()
+                break
+            except (UploadError, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                error = e
+                image_upload_errors.inc(self.backend.name)
+                if not isinstance(e, UploadError) or e.retryable:
+                    self.breaker.record_failure()
+            finally:
+                # Иначе отменённый пробный запрос навсегда оставил бы backend отключённым
+                self.breaker.release()
+            if isinstance(error, UploadError) and not error.retryable or attempt == self.max_retries:
+                raise UploadError(str(error) or type(error).__name__, retryable=False) from error
+            log.warning("Загрузка изображения %s не удалась (%s), повтор", digest, error)
+            await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+        async with self.pool.acquire() as conn:
+            # Если то же изображение одновременно загрузил другой процесс, используем его ссылку
+            return await conn.fetchval("""
+                WITH inserted AS (
+                    INSERT INTO images (sha256, backend, url, size) VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (backend, sha256) DO NOTHING
+                    RETURNING url
+                )
+                SELECT url FROM inserted
+                UNION ALL
+                SELECT url FROM images WHERE backend = $2 AND sha256 = $1
+                LIMIT 1
+            """, digest, self.backend.name, url, len(data))
+
+
+def create_store(pool, session):
+    """ImageStore с backend из IMAGE_BACKEND: imgbb (по умолчанию) или local."""
+    backend = os.getenv('IMAGE_BACKEND', 'imgbb')
+    if backend == 'local':
+        return ImageStore(pool, LocalBackend(image_dir(), os.environ['IMAGE_PUBLIC_URL']))
+    if backend == 'imgbb':
+        upload_url = os.getenv('IMGBB_UPLOAD_URL', 'https://api.imgbb.com/1/upload')
+        return ImageStore(pool, ImgbbBackend(session, upload_url, os.getenv('IMGBB_API_KEY')))
+    raise ValueError(f"Неизвестный IMAGE_BACKEND: {backend}")
+
+
+def image_dir():
+    return os.getenv('IMAGE_DIR', os.path.join('images', 'goods'))
+
+
+async def start_server():
+    """Раздаёт каталог локального хранилища на IMAGE_HTTP_PORT, если выбран backend local и порт задан."""
+    port = os.getenv('IMAGE_HTTP_PORT')
+    if os.getenv('IMAGE_BACKEND') != 'local' or not port:
+        return None
+    os.makedirs(image_dir(), exist_ok=True)
+    app = web.Application()
+    app.router.add_static('/', image_dir())
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, os.getenv('IMAGE_HTTP_HOST', '0.0.0.0'), int(port)).start()
+    return runner
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+
+import asyncpg
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+ledger_batch_size = metrics.register(metrics.Histogram(
+    'balance_ledger_batch_size', 'Записей журнала баланса в одной транзакции', buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500)))
+ledger_folded = metrics.register(metrics.Counter('balance_ledger_folded_total', 'Записей журнала, свёрнутых в снимок баланса'))
+
+class LedgerWriter:
+    """
+    Запись в журнал баланса пачками.
+
+    append() ставит запись в очередь и ждёт её коммита. Фоновая задача
+    забирает из очереди до max_batch записей, подождав новые не дольше
+    max_delay секунд, и вставляет их одним запросом. Если пачка не вставилась
+    (например, из-за записи для несуществующего пользователя), записи
+    вставляются по одной, чтобы ошибка досталась только виновнику.
+    """
+
+    def __init__(self, pool, max_batch=500, max_delay=0.005):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Дописывает накопленные записи и останавливает фоновую задачу."""
+        await self._queue.put(None)
+        await self._task
+
+    async def append(self, user_id, amount, kind):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((user_id, amount, kind, future))
+        return await future
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = asyncio.get_running_loop().time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - asyncio.get_running_loop().time()
+                try:
+                    item = self._queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self._queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch):
+        ledger_batch_size.observe(len(batch))
+        try:
+            async with self.pool.acquire() as conn:
+                ids = await conn.fetch("""
+                    INSERT INTO balance_ledger (user_id, amount, kind)
+                    SELECT * FROM unnest($1::bigint[], $2::numeric[], $3::text[])
+                    RETURNING id
+                """, [item[0] for item in batch], [item[1] for item in batch], [item[2] for item in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][3].done():
+                    batch[0][3].set_exception(e)
+                return
+            log.warning("Пачка из %d записей журнала не вставилась (%s), вставляем по одной", len(batch), e)
+            for item in batch:
+                await self._write([item])
+            return
+
+        for item, row in zip(batch, ids):
+            if not item[3].done():
+                item[3].set_result(row["id"])
+
+
+# Свёртка несвёрнутых записей журнала выбранных пользователей в снимок users.balance
+FOLD = """
+    WITH folded AS (
+        UPDATE balance_ledger SET folded = true
+        WHERE NOT folded AND user_id = ANY($1::bigint[])
+        RETURNING user_id, amount
+    ), totals AS (
+        SELECT user_id, SUM(amount) AS amount, COUNT(*) AS entries FROM folded GROUP BY user_id
+    ), updated AS (
+        UPDATE users u SET balance = u.balance + t.amount
+        FROM totals t
+        WHERE u.telegram_id = t.user_id
+    )
+    SELECT COALESCE(SUM(entries), 0)::int FROM totals
+"""
+
+
+async def fold_balances(pool, max_users=1000):
+    """
+    Переносит несвёрнутые записи журнала в снимок users.balance.
+
+    Пользователи блокируются по возрастанию id так же, как при оформлении
+    заказа, поэтому снимок и отметка folded меняются атомарно относительно
+    чтения баланса. Записи из ещё не завершённых транзакций не видны и будут
+    свёрнуты в следующий раз. Если пачка не свернулась (например, снимок
+    кого-то из пользователей не помещается в NUMERIC(10,2)), пользователи
+    сворачиваются по одному в точках сохранения, а виновник пропускается:
+    его записи остаются в журнале и по-прежнему учитываются в балансе.
+    Возвращает число выбранных пользователей.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            user_ids = await conn.fetch("""
+                SELECT telegram_id FROM users
+                WHERE telegram_id = ANY(ARRAY(SELECT DISTINCT user_id FROM balance_ledger WHERE NOT folded LIMIT $1))
+                ORDER BY telegram_id
+                FOR UPDATE
+            """, max_users)
+            if not user_ids:
+                return 0
+            user_ids = [row["telegram_id"] for row in user_ids]
+            try:
+                async with conn.transaction():
+                    folded = await conn.fetchval(FOLD, user_ids)
+            except asyncpg.DataError as e:
+                log.warning("Пачка из %d пользователей не свернулась (%s), сворачиваем по одному", len(user_ids), e)
+                folded = 0
+                for user_id in user_ids:
+                    try:
+                        async with conn.transaction():
+                            folded += await conn.fetchval(FOLD, [user_id])
+                    except asyncpg.DataError as e:
+                        log.error("Журнал баланса пользователя %s не свёрнут: %s", user_id, e)
+    ledger_folded.inc(amount=folded)
+    return len(user_ids)
+
+
+async def balance_folder(pool, interval=10, max_users=1000):
+    """Фоновая задача свёртки журнала."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # Пока за проход сворачивается полная пачка пользователей, продолжаем
+            while await fold_balances(pool, max_users) == max_users:
+                pass
+        except Exception:
+            log.exception("Не удалось свернуть журнал баланса")
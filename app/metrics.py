@@ -0,0 +1,261 @@
+import os
+import re
+import time
+import bisect
+import functools
+import contextvars
+
+from aiohttp import web
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# Границы корзин гистограмм задержек (в секундах)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self.values.items():
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+class Gauge:
+    """Значение считывается функцией в момент запроса /metrics."""
+
+    def __init__(self, name, help_text, func):
+        self.name = name
+        self.help = help_text
+        self.func = func
+
+    def render(self):
+        value = self.func()
+        if value is None:
+            return
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # значения меток -> [счётчики по корзинам, сумма, количество]
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _labels(self.labels + ('le',), label_values + (bound,))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _labels(self.labels + ('le',), label_values + ('+Inf',))
+            yield f"{self.name}_bucket{labels} {count}"
+            yield f"{self.name}_sum{_labels(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, label_values)} {count}"
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+handler_latency = register(Histogram('bot_handler_latency_seconds', 'Время работы хендлера', ('handler',)))
+handler_errors = register(Counter('bot_handler_errors_total', 'Исключения в хендлерах', ('handler',)))
+query_latency = register(Histogram('db_query_latency_seconds', 'Время выполнения запроса к базе', ('statement',)))
+query_errors = register(Counter('db_query_errors_total', 'Ошибки запросов к базе', ('statement',)))
+pool_acquire_wait = register(Histogram('db_pool_acquire_wait_seconds', 'Ожидание свободного соединения в пуле'))
+bot_api_latency = register(Histogram('bot_api_latency_seconds', 'Время вызова Bot API', ('method',)))
+bot_api_errors = register(Counter('bot_api_errors_total', 'Ошибки вызовов Bot API', ('method',)))
+
+
+# Хендлер, который обрабатывает текущий апдейт (для подсчёта ошибок в errors_handler)
+_handler_name = contextvars.ContextVar('metrics_handler_name', default='unhandled')
+
+
+def set_handler_name(name):
+    """Уточняет имя хендлера, если апдейт передан дальше (например, маршрутизатором нажатий)."""
+    _handler_name.set(name)
+
+
+def current_handler_name():
+    return _handler_name.get()
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замеряет время каждого хендлера Dispatcher."""
+
+    async def _start(self, data):
+        handler = current_handler.get()
+        name = getattr(handler, '__name__', 'unknown')
+        _handler_name.set(name)
+        data['_metrics'] = time.perf_counter()
+
+    async def _finish(self, data):
+        started = data.get('_metrics')
+        if started:
+            handler_latency.observe(time.perf_counter() - started, _handler_name.get())
+
+    async def on_process_message(self, message, data):
+        await self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        await self._finish(data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        await self._start(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        await self._finish(data)
+
+    async def on_process_inline_query(self, inline_query, data):
+        await self._start(data)
+
+    async def on_post_process_inline_query(self, inline_query, results, data):
+        await self._finish(data)
+
+
+def setup_dispatcher(dp):
+    dp.middleware.setup(MetricsMiddleware())
+
+    @dp.errors_handler()
+    async def count_handler_error(update, exception):
+        handler_errors.inc(_handler_name.get())
+
+
+# Текст запроса как метка: без лишних пробелов и не длиннее 200 символов.
+# Запросы — константы модулей, поэтому метка считается один раз на текст
+_whitespace = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=1024)
+def _statement(query):
+    return _whitespace.sub(' ', query).strip()[:200]
+
+
+def _log_query(record):
+    statement = _statement(record.query)
+    query_latency.observe(record.elapsed, statement)
+    if record.exception is not None:
+        query_errors.inc(statement)
+
+
+async def init_connection(conn):
+    """Передаётся в asyncpg.create_pool(init=...): включает замер запросов соединения."""
+    conn.add_query_logger(_log_query)
+
+
+class _TimedAcquire:
+    def __init__(self, pool, timeout):
+        self._pool = pool
+        self._timeout = timeout
+        self._conn = None
+
+    async def _acquire(self):
+        started = time.perf_counter()
+        conn = await self._pool.acquire(timeout=self._timeout)
+        pool_acquire_wait.observe(time.perf_counter() - started)
+        return conn
+
+    def __await__(self):
+        return self._acquire().__await__()
+
+    async def __aenter__(self):
+        self._conn = await self._acquire()
+        return self._conn
+
+    async def __aexit__(self, *exc):
+        await self._pool.release(self._conn)
+
+
+class InstrumentedPool:
+    """Обёртка над пулом asyncpg, замеряющая ожидание соединения."""
+
+    def __init__(self, pool):
+        self._pool = pool
+        register(Gauge('db_pool_size', 'Открытых соединений в пуле', pool.get_size))
+        register(Gauge('db_pool_idle', 'Свободных соединений в пуле', pool.get_idle_size))
+        register(Gauge('db_pool_max_size', 'Максимальный размер пула', pool.get_max_size))
+
+    def acquire(self, *, timeout=None):
+        return _TimedAcquire(self._pool, timeout)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+class timed:
+    """Замеряет время блока или корутины в гистограмме: `async with timed(histogram):`."""
+
+    def __init__(self, histogram, *label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    async def __aenter__(self):
+        self.started = time.perf_counter()
+
+    async def __aexit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+async def start_server():
+    """Поднимает /metrics на METRICS_PORT, если порт задан."""
+    port = os.getenv('METRICS_PORT')
+    if not port:
+        return None
+
+    async def handle_metrics(request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, os.getenv('METRICS_HOST', '127.0.0.1'), int(port)).start()
+    return runner
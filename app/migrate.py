@@ -0,0 +1,47 @@
+import os
+import re
+import logging
+
+log = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# Ключ advisory-блокировки: миграции не выполняются одновременно из нескольких процессов
+LOCK_KEY = 0x5140_0001
+
+
+def load_migrations():
+    """Список (версия, имя, SQL) из файлов вида 0001_name.sql, по возрастанию версии."""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.fullmatch(r'(\d+)_(\w+)\.sql', filename)
+        if not match:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, filename), encoding='utf-8') as file:
+            migrations.append((int(match.group(1)), match.group(2), file.read()))
+    return migrations
+
+
+async def migrate(pool):
+    """Применяет ещё не выполненные миграции, каждую в своей транзакции."""
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1)", LOCK_KEY)
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            applied = {row['version'] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+
+            for version, name, sql in load_migrations():
+                if version in applied:
+                    continue
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+                log.info("Применена миграция %04d_%s", version, name)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", LOCK_KEY)
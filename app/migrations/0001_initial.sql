@@ -0,0 +1,56 @@
+-- Исходная схема из README.MD. Колонки, появившиеся позже, добавляются
+-- через ADD COLUMN IF NOT EXISTS, чтобы миграция подходила и для уже созданных баз.
+
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    telegram_id BIGINT UNIQUE NOT NULL,
+    username TEXT,
+    balance NUMERIC(10, 2) DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS goods (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    description TEXT,
+    quantity INT NOT NULL DEFAULT 0,
+    price NUMERIC(10, 2) NOT NULL,
+    image_url TEXT
+);
+ALTER TABLE goods ADD COLUMN IF NOT EXISTS telegram_file_id TEXT;
+
+CREATE TABLE IF NOT EXISTS carts (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+    product_id INT NOT NULL REFERENCES goods(id) ON DELETE CASCADE,
+    price NUMERIC(10, 2) NOT NULL,
+    quantity INT NOT NULL CHECK (quantity > 0)
+);
+ALTER TABLE carts ADD COLUMN IF NOT EXISTS reserved_until TIMESTAMPTZ;
+
+CREATE TABLE IF NOT EXISTS orders (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+    total_price NUMERIC(10, 2) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS order_items (
+    id SERIAL PRIMARY KEY,
+    order_id INT NOT NULL REFERENCES orders(id) ON DELETE CASCADE,
+    product_name TEXT NOT NULL,
+    quantity INT NOT NULL CHECK (quantity > 0),
+    price NUMERIC(10, 2) NOT NULL,
+    total_price NUMERIC(10, 2) NOT NULL
+);
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS product_id INT REFERENCES goods(id) ON DELETE SET NULL;
+
+CREATE TABLE IF NOT EXISTS fsm_storage (
+    namespace TEXT NOT NULL,
+    chat BIGINT NOT NULL,
+    "user" BIGINT NOT NULL,
+    state TEXT,
+    data JSONB NOT NULL DEFAULT '{}',
+    bucket JSONB NOT NULL DEFAULT '{}',
+    expires_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (namespace, chat, "user")
+);
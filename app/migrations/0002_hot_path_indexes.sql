@@ -0,0 +1,26 @@
+-- Индексы и ограничения, на которые рассчитывают хендлеры
+
+-- Корзина пользователя (show_cart, process_checkout) и освобождение просроченных резервов
+CREATE INDEX IF NOT EXISTS carts_user_id_idx ON carts (user_id);
+CREATE INDEX IF NOT EXISTS carts_reserved_until_idx ON carts (reserved_until) WHERE reserved_until IS NOT NULL;
+-- Каскадное удаление товара
+CREATE INDEX IF NOT EXISTS carts_product_id_idx ON carts (product_id);
+
+-- История заказов: keyset-пагинация по (created_at, id)
+UPDATE orders SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE orders ALTER COLUMN created_at SET NOT NULL;
+CREATE INDEX IF NOT EXISTS orders_user_created_idx ON orders (user_id, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS order_items_order_id_idx ON order_items (order_id);
+CREATE INDEX IF NOT EXISTS order_items_product_id_idx ON order_items (product_id);
+
+CREATE INDEX IF NOT EXISTS goods_name_idx ON goods (name);
+
+-- Удаление брошенных состояний FSM
+CREATE INDEX IF NOT EXISTS fsm_storage_expires_at_idx ON fsm_storage (expires_at);
+
+-- Остаток списывается условным UPDATE и не должен уходить в минус;
+-- NOT VALID: проверяются только новые и изменённые строки
+ALTER TABLE goods ADD CONSTRAINT goods_quantity_non_negative CHECK (quantity >= 0) NOT VALID;
+ALTER TABLE goods ADD CONSTRAINT goods_price_non_negative CHECK (price >= 0) NOT VALID;
+ALTER TABLE users ADD CONSTRAINT users_balance_non_negative CHECK (balance >= 0) NOT VALID;
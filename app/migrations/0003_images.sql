@@ -0,0 +1,9 @@
+-- Загруженные изображения по хэшу содержимого: одно и то же фото не загружается дважды
+CREATE TABLE images (
+    backend TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    url TEXT NOT NULL,
+    size INT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (backend, sha256)
+);
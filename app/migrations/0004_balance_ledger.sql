@@ -0,0 +1,22 @@
+-- Журнал изменений баланса. Записи только добавляются; users.balance — снимок
+-- суммы свёрнутых (folded) записей, текущий баланс = снимок + несвёрнутые записи
+CREATE TABLE balance_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+    amount NUMERIC(10, 2) NOT NULL,
+    kind TEXT NOT NULL CHECK (kind IN ('opening', 'top_up', 'purchase')),
+    order_id INT REFERENCES orders(id) ON DELETE SET NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    folded BOOLEAN NOT NULL DEFAULT false
+);
+
+-- Чтение баланса и свёртка обращаются только к несвёрнутым записям
+CREATE INDEX balance_ledger_unfolded_idx ON balance_ledger (user_id) WHERE NOT folded;
+CREATE INDEX balance_ledger_user_idx ON balance_ledger (user_id, id);
+
+-- Балансы на момент миграции: начальные записи, уже учтённые в снимке
+INSERT INTO balance_ledger (user_id, amount, kind, folded)
+SELECT telegram_id, balance, 'opening', true FROM users WHERE balance <> 0;
+
+UPDATE users SET balance = 0 WHERE balance IS NULL;
+ALTER TABLE users ALTER COLUMN balance SET NOT NULL;
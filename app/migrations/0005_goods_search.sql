@@ -0,0 +1,7 @@
+-- Полнотекстовый поиск товаров для inline-режима. Конфигурация simple не
+-- приводит слова к основе, поэтому поиск по началу слова ('тел:*') работает
+-- для любого введённого префикса
+ALTER TABLE goods ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', name || ' ' || COALESCE(description, ''))) STORED;
+
+CREATE INDEX goods_search_idx ON goods USING gin (search_vector);
@@ -0,0 +1,33 @@
+-- Одна строка корзины на товар: повторные добавления увеличивают количество.
+-- Дубликаты сливаются в строку с наименьшим id. Резерв сохраняется, если все
+-- строки товара зарезервированы по одной цене; иначе зарезервированное
+-- возвращается на склад, а позиция списывается при оформлении по текущей цене
+CREATE TEMP TABLE cart_duplicates ON COMMIT DROP AS
+SELECT user_id, product_id, MIN(id) AS keep_id, SUM(quantity) AS quantity, MAX(reserved_until) AS reserved_until,
+       bool_and(reserved_until IS NOT NULL) AND COUNT(DISTINCT price) = 1 AS keep_reserve
+FROM carts
+GROUP BY user_id, product_id
+HAVING COUNT(*) > 1;
+
+UPDATE goods g SET quantity = g.quantity + r.quantity
+FROM (
+    SELECT c.product_id, SUM(c.quantity) AS quantity
+    FROM carts c
+    JOIN cart_duplicates d USING (user_id, product_id)
+    WHERE NOT d.keep_reserve AND c.reserved_until IS NOT NULL
+    GROUP BY c.product_id
+) r
+WHERE g.id = r.product_id;
+
+DELETE FROM carts c
+USING cart_duplicates d
+WHERE c.user_id = d.user_id AND c.product_id = d.product_id AND c.id <> d.keep_id;
+
+UPDATE carts c SET quantity = d.quantity, reserved_until = CASE WHEN d.keep_reserve THEN d.reserved_until END
+FROM cart_duplicates d
+WHERE c.id = d.keep_id;
+
+CREATE UNIQUE INDEX carts_user_product_idx ON carts (user_id, product_id);
+
+-- Поиск корзины пользователя теперь идёт по началу уникального индекса
+DROP INDEX carts_user_id_idx;
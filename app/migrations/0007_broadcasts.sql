@@ -0,0 +1,31 @@
+-- Массовые рассылки. Получатели берутся в работу пачками по возрастанию telegram_id;
+-- last_user_id — курсор: все, у кого id не больше, уже взяты и повторно сообщение не получат.
+-- claimed — сколько получателей взято, sent/failed/blocked — сколько отправок подтверждено
+CREATE TABLE broadcast_jobs (
+    id SERIAL PRIMARY KEY,
+    text TEXT NOT NULL,
+    photo TEXT,
+    reply_markup TEXT,
+    status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'done', 'cancelled')),
+    created_by BIGINT,
+    total INT NOT NULL DEFAULT 0,
+    last_user_id BIGINT NOT NULL DEFAULT 0,
+    claimed INT NOT NULL DEFAULT 0,
+    sent INT NOT NULL DEFAULT 0,
+    failed INT NOT NULL DEFAULT 0,
+    blocked INT NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ
+);
+
+-- Незавершённые рассылки, которые возобновляются при запуске админ-бота
+CREATE INDEX broadcast_jobs_running_idx ON broadcast_jobs (id) WHERE status = 'running';
+
+-- Получатели, которым сообщение не доставлено. blocked — бот заблокирован или чат недоступен
+CREATE TABLE broadcast_failures (
+    job_id INT NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+    user_id BIGINT NOT NULL,
+    blocked BOOLEAN NOT NULL,
+    error TEXT NOT NULL,
+    PRIMARY KEY (job_id, user_id)
+);
@@ -0,0 +1,39 @@
+-- Статистика продаж для /stats. Заказы сворачиваются в сводные таблицы фоновой
+-- задачей (orders.aggregated); точная статистика = сводки + ещё не свёрнутые заказы.
+-- День — created_at::date заказа, product_id = 0 — позиции без ссылки на товар
+CREATE TABLE sales_daily (
+    day DATE NOT NULL,
+    product_id INT NOT NULL,
+    product_name TEXT NOT NULL,
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, product_id)
+);
+
+-- Итоги по дням: заказ с несколькими товарами считается один раз
+CREATE TABLE sales_daily_totals (
+    day DATE PRIMARY KEY,
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue NUMERIC(14, 2) NOT NULL DEFAULT 0
+);
+
+-- Существующие заказы учитываются ниже в этой же миграции, новые — свёрткой.
+-- DEFAULT true при добавлении не переписывает таблицу
+ALTER TABLE orders ADD COLUMN aggregated BOOLEAN NOT NULL DEFAULT true;
+ALTER TABLE orders ALTER COLUMN aggregated SET DEFAULT false;
+CREATE INDEX orders_not_aggregated_idx ON orders (id) WHERE NOT aggregated;
+
+INSERT INTO sales_daily (day, product_id, product_name, orders, units, revenue)
+SELECT o.created_at::date, COALESCE(oi.product_id, 0), MAX(oi.product_name),
+       COUNT(DISTINCT o.id), SUM(oi.quantity), SUM(oi.total_price)
+FROM orders o
+JOIN order_items oi ON oi.order_id = o.id
+GROUP BY 1, 2;
+
+INSERT INTO sales_daily_totals (day, orders, units, revenue)
+SELECT o.created_at::date, COUNT(*), COALESCE(SUM(i.units), 0), SUM(o.total_price)
+FROM orders o
+LEFT JOIN LATERAL (SELECT SUM(quantity) AS units FROM order_items WHERE order_id = o.id) i ON true
+GROUP BY 1;
@@ -0,0 +1,7 @@
+-- Получатели, взятые в работу, но не переданные в Telegram до остановки бота.
+-- Следующий запуск рассылки берёт их раньше получателей после курсора
+CREATE TABLE broadcast_pending (
+    job_id INT NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+    user_id BIGINT NOT NULL,
+    PRIMARY KEY (job_id, user_id)
+);
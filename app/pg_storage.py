@@ -0,0 +1,240 @@
+import copy
+import json
+import time
+import typing
+import asyncio
+import logging
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+
+log = logging.getLogger(__name__)
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в PostgreSQL (таблица fsm_storage).
+
+    Перед базой стоит LRU-кэш: чтения обслуживаются из памяти, изменения сразу
+    попадают в кэш и раз в flush_interval секунд пачкой записываются в базу.
+    Запись, которая не менялась дольше ttl секунд, считается брошенной диалогом
+    и удаляется. Кэш согласован, пока апдейты одного пользователя обрабатывает
+    один процесс (см. распределение по воркерам в режиме webhook).
+    """
+
+    def __init__(self, namespace: str, ttl: int = 24 * 60 * 60, cache_size: int = 10000,
+                 flush_interval: float = 1.0, purge_interval: float = 10 * 60):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+
+        self.pool = None
+        self._cache = OrderedDict()  # (chat, user) -> запись
+        self._dirty = set()
+        self._tasks = []
+
+    async def start(self, pool):
+        self.pool = pool
+        # Таблица fsm_storage создаётся миграцией 0001_initial
+        self._tasks = [
+            asyncio.create_task(self._periodic(self.flush, self.flush_interval)),
+            asyncio.create_task(self._periodic(self.purge, self.purge_interval)),
+        ]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.pool is not None:
+            await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def _periodic(self, func, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await func()
+            except Exception:
+                log.exception("Ошибка фоновой задачи хранилища FSM")
+
+    @staticmethod
+    def _empty_record():
+        return {'state': None, 'data': {}, 'bucket': {}, 'expires': time.monotonic()}
+
+    async def _get_record(self, chat, user):
+        key = tuple(map(int, self.check_address(chat=chat, user=user)))
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            if record['expires'] < time.monotonic() and key not in self._dirty:
+                record.update(self._empty_record())
+            return key, record
+
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT state, data::text, bucket::text, EXTRACT(EPOCH FROM expires_at - now()) AS ttl
+                FROM fsm_storage
+                WHERE namespace = $1 AND chat = $2 AND "user" = $3 AND expires_at > now()
+            """, self.namespace, *key)
+
+        # Пока шёл запрос, запись могли загрузить или изменить
+        if key in self._cache:
+            return key, self._cache[key]
+
+        record = self._empty_record()
+        if row:
+            record.update(state=row['state'], data=json.loads(row['data']), bucket=json.loads(row['bucket']),
+                          expires=time.monotonic() + float(row['ttl']))
+        self._cache[key] = record
+        self._trim()
+        return key, record
+
+    def _mark_dirty(self, key, record):
+        record['expires'] = time.monotonic() + self.ttl
+        # Если кэш заполнен несохранёнными записями, только что загруженная запись
+        # вытесняется сразу: возвращаем её, иначе сброс не нашёл бы изменение
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        self._dirty.add(key)
+
+    def _trim(self):
+        # Вытесняем самые старые записи, кроме ещё не сохранённых в базу
+        if len(self._cache) <= self.cache_size:
+            return
+        for key in list(self._cache):
+            if len(self._cache) <= self.cache_size:
+                break
+            if key not in self._dirty:
+                del self._cache[key]
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+
+        upserts, deletes = [], []
+        for key in keys:
+            record = self._cache.get(key)
+            if record is None:
+                continue
+            if record['state'] is None and not record['data'] and not record['bucket']:
+                deletes.append(key)
+            else:
+                upserts.append((key, record['state'], json.dumps(record['data']), json.dumps(record['bucket'])))
+
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    if upserts:
+                        await conn.execute("""
+                            INSERT INTO fsm_storage (namespace, chat, "user", state, data, bucket, expires_at)
+                            SELECT $1, r.chat, r.usr, r.state, r.data::jsonb, r.bucket::jsonb,
+                                   now() + $7::float8 * interval '1 second'
+                            FROM unnest($2::bigint[], $3::bigint[], $4::text[], $5::text[], $6::text[])
+                                AS r(chat, usr, state, data, bucket)
+                            ON CONFLICT (namespace, chat, "user") DO UPDATE
+                            SET state = EXCLUDED.state, data = EXCLUDED.data,
+                                bucket = EXCLUDED.bucket, expires_at = EXCLUDED.expires_at
+                        """, self.namespace,
+                            [item[0][0] for item in upserts], [item[0][1] for item in upserts],
+                            [item[1] for item in upserts], [item[2] for item in upserts],
+                            [item[3] for item in upserts], float(self.ttl))
+                    if deletes:
+                        await conn.execute("""
+                            DELETE FROM fsm_storage
+                            WHERE namespace = $1
+                              AND (chat, "user") IN (SELECT * FROM unnest($2::bigint[], $3::bigint[]))
+                        """, self.namespace, [key[0] for key in deletes], [key[1] for key in deletes])
+        except BaseException:
+            # Не удалось записать (или сброс отменён при закрытии) — повторим при следующем сбросе
+            self._dirty |= keys
+            raise
+        self._trim()
+
+    async def purge(self):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM fsm_storage WHERE expires_at < now()")
+        now = time.monotonic()
+        for key in [key for key, record in self._cache.items() if record['expires'] < now and key not in self._dirty]:
+            del self._cache[key]
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        key, record = await self._get_record(chat, user)
+        return record['state'] or self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        key, record = await self._get_record(chat, user)
+        return copy.deepcopy(record['data'] or default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        key, record = await self._get_record(chat, user)
+        record['state'] = self.resolve_state(state)
+        self._mark_dirty(key, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._get_record(chat, user)
+        record['data'] = copy.deepcopy(data or {})
+        self._mark_dirty(key, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        key, record = await self._get_record(chat, user)
+        record['data'].update(copy.deepcopy(data or {}), **kwargs)
+        self._mark_dirty(key, record)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        key, record = await self._get_record(chat, user)
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        self._mark_dirty(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        key, record = await self._get_record(chat, user)
+        return copy.deepcopy(record['bucket'] or default or {})
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = await self._get_record(chat, user)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        self._mark_dirty(key, record)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None,
+                            **kwargs):
+        key, record = await self._get_record(chat, user)
+        record['bucket'].update(copy.deepcopy(bucket or {}), **kwargs)
+        self._mark_dirty(key, record)
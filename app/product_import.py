@@ -0,0 +1,238 @@
+import io
+import os
+import csv
+import asyncio
+import zipfile
+from decimal import Decimal, InvalidOperation
+
+try:
+    import openpyxl  # Нужен только для импорта из XLSX
+except ImportError:
+    openpyxl = None
+
+# Колонки файла импорта. image — имя файла в zip-архиве с фото или ссылка на изображение
+COLUMNS = ('name', 'description', 'quantity', 'price', 'image')
+REQUIRED_COLUMNS = ('name', 'quantity', 'price')
+
+# Колонки goods, которые заполняет импорт
+GOODS_COLUMNS = ('name', 'description', 'quantity', 'price', 'image_url')
+
+# Пределы типов колонок goods: quantity INT, price NUMERIC(10, 2)
+MAX_QUANTITY = 2 ** 31 - 1
+MAX_PRICE = Decimal('99999999.99')
+
+# Кодировки CSV по порядку попыток: Excel под Windows сохраняет CSV в cp1251
+CSV_ENCODINGS = ('utf-8-sig', 'cp1251')
+
+
+class ImportFileError(Exception):
+    """Файл нельзя импортировать целиком (неизвестный формат, нет нужных колонок)."""
+
+
+class ImportReport:
+    def __init__(self):
+        self.total = 0  # прочитано строк
+        self.processed = 0  # обработано строк (фото загружено или найдена ошибка)
+        self.imported = 0  # записано в базу
+        self.errors = []  # (номер строки, описание ошибки)
+
+
+def _read_csv(data):
+    for encoding in CSV_ENCODINGS:
+        try:
+            text = data.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            pass
+    else:
+        raise ImportFileError("Не удалось прочитать CSV: сохраните файл в кодировке UTF-8.")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    yield from csv.reader(io.StringIO(text), dialect)
+
+
+def _read_xlsx(data):
+    if openpyxl is None:
+        raise ImportFileError("Для импорта XLSX установите пакет openpyxl или сохраните таблицу в CSV.")
+    try:
+        workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    except Exception:
+        raise ImportFileError("Файл .xlsx повреждён или сохранён в другом формате.")
+    try:
+        for values in workbook.active.iter_rows(values_only=True):
+            yield ['' if value is None else str(value) for value in values]
+    finally:
+        workbook.close()
+
+
+def read_rows(filename, data):
+    """
+    Строки таблицы товаров как (номер строки, {колонка: значение}).
+
+    Первая строка — заголовок с названиями колонок из COLUMNS в любом порядке.
+    """
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension == '.csv':
+        lines = _read_csv(data)
+    elif extension == '.xlsx':
+        lines = _read_xlsx(data)
+    else:
+        raise ImportFileError("Поддерживаются файлы .csv и .xlsx.")
+
+    header = next(lines, None)
+    if header is None:
+        raise ImportFileError("Файл пуст.")
+    header = [column.strip().lower() for column in header]
+    missing = [column for column in REQUIRED_COLUMNS if column not in header]
+    if missing:
+        raise ImportFileError(f"Нет колонок: {', '.join(missing)}.")
+
+    # Заголовок проверен сразу, остальные строки читаются по мере импорта
+    def rows():
+        for line_number, values in enumerate(lines, start=2):
+            if not any(value.strip() for value in values):
+                continue
+            yield line_number, {column: value.strip() for column, value in zip(header, values) if column in COLUMNS}
+
+    return rows()
+
+
+def parse_row(row):
+    """Проверяет строку и возвращает (name, description, quantity, price, image) или выбрасывает ValueError."""
+    name = row.get('name', '')
+    if not name:
+        raise ValueError("пустое название")
+    try:
+        quantity = int(row.get('quantity', ''))
+    except ValueError:
+        raise ValueError(f"количество «{row.get('quantity', '')}» не целое число")
+    try:
+        price = Decimal(row.get('price', '').replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f"цена «{row.get('price', '')}» не число")
+    if not price.is_finite():
+        raise ValueError(f"цена «{row.get('price', '')}» не число")
+    if quantity < 0 or price < 0:
+        raise ValueError("количество и цена не могут быть отрицательными")
+    if quantity > MAX_QUANTITY:
+        raise ValueError(f"количество {quantity} больше {MAX_QUANTITY}")
+    price = price.quantize(Decimal('0.01'))
+    if price > MAX_PRICE:
+        raise ValueError(f"цена {price} больше {MAX_PRICE}")
+    return name, row.get('description') or None, quantity, price, row.get('image') or None
+
+
+class ImageArchive:
+    """Фото из zip-архива по имени файла (без учёта каталогов внутри архива)."""
+
+    def __init__(self, data):
+        self.zip = zipfile.ZipFile(io.BytesIO(data)) if data else None
+        self.names = {}
+        if self.zip:
+            for info in self.zip.infolist():
+                if not info.is_dir():
+                    self.names[os.path.basename(info.filename)] = info.filename
+
+    async def read(self, name):
+        member = self.names.get(os.path.basename(name))
+        if member is None:
+            return None
+        return await asyncio.to_thread(self.zip.read, member)
+
+
+async def import_products(pool, rows, images, upload, concurrency=8, batch_size=500, progress=None):
+    """
+    Импортирует товары из строк read_rows.
+
+    Фото загружаются функцией upload(data, filename) -> url | None в concurrency
+    параллельных воркерах; строки с загруженными фото записываются в goods через
+    COPY пачками по batch_size. Если пачка не записалась, её строки записываются
+    по одной, чтобы ошибка досталась только виновным строкам. Ошибки отдельных
+    строк не прерывают импорт и попадают в отчёт. progress(report) вызывается после каждой обработанной строки.
+    """
+    report = ImportReport()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    batch = []  # (номер строки, запись для goods)
+    write_lock = asyncio.Lock()
+
+    async def notify():
+        report.processed += 1
+        if progress:
+            await progress(report)
+
+    async def write(conn, pending):
+        try:
+            await conn.copy_records_to_table('goods', records=[record for _, record in pending], columns=GOODS_COLUMNS)
+        except Exception as e:
+            if len(pending) == 1:
+                report.errors.append((pending[0][0], f"ошибка записи в базу: {e}"))
+                return
+            for item in pending:
+                await write(conn, [item])
+        else:
+            report.imported += len(pending)
+
+    async def flush():
+        async with write_lock:
+            if not batch:
+                return
+            pending = batch[:]
+            batch.clear()
+            try:
+                async with pool.acquire() as conn:
+                    await write(conn, pending)
+            except Exception as e:
+                # Соединение недоступно: не записана вся пачка
+                report.errors.extend((line_number, f"ошибка записи в базу: {e}") for line_number, _ in pending)
+
+    async def resolve_image(image):
+        if image is None:
+            return None
+        if image.startswith(('http://', 'https://')):
+            return image
+        data = await images.read(image)
+        if data is None:
+            raise ValueError(f"файла {image} нет в архиве")
+        url = await upload(data, os.path.basename(image))
+        if not url:
+            raise ValueError(f"не удалось загрузить {image}")
+        return url
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            line_number, (name, description, quantity, price, image) = item
+            try:
+                image_url = await resolve_image(image)
+            except Exception as e:
+                report.errors.append((line_number, str(e)))
+            else:
+                batch.append((line_number, (name, description, quantity, price, image_url)))
+                if len(batch) >= batch_size:
+                    await flush()
+            await notify()
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        for line_number, row in rows:
+            report.total += 1
+            try:
+                parsed = parse_row(row)
+            except ValueError as e:
+                report.errors.append((line_number, str(e)))
+                await notify()
+                continue
+            await queue.put((line_number, parsed))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+    await flush()
+    report.errors.sort()
+    return report
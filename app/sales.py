@@ -0,0 +1,210 @@
+import asyncio
+import logging
+from datetime import date, timedelta
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+sales_folded = metrics.register(metrics.Counter('sales_orders_folded_total', 'Заказов, свёрнутых в статистику продаж'))
+sales_mismatches = metrics.register(metrics.Counter(
+    'sales_reconcile_mismatches_total', 'Строк статистики продаж, исправленных сверкой с заказами'))
+
+# Ещё не свёрнутые заказы: статистика по ним считается по сырым таблицам
+PENDING_ITEMS = """
+    SELECT o.created_at::date AS day, COALESCE(oi.product_id, 0) AS product_id, oi.product_name,
+           o.id AS order_id, oi.quantity, oi.total_price
+    FROM orders o
+    JOIN order_items oi ON oi.order_id = o.id
+    WHERE NOT o.aggregated AND o.created_at >= $1
+"""
+
+DAILY_QUERY = """
+    SELECT day, SUM(orders)::int AS orders, SUM(units)::int AS units, SUM(revenue) AS revenue
+    FROM (
+        SELECT day, orders, units, revenue FROM sales_daily_totals WHERE day >= $1
+        UNION ALL
+        SELECT o.created_at::date, 1,
+               COALESCE((SELECT SUM(quantity) FROM order_items WHERE order_id = o.id), 0), o.total_price
+        FROM orders o
+        WHERE NOT o.aggregated AND o.created_at >= $1
+    ) s
+    GROUP BY day
+    ORDER BY day
+"""
+
+# Названия ищутся только для найденных товаров: текущее из каталога, для
+# удалённого из каталога — последнее из сводок
+TOP_PRODUCTS_QUERY = f"""
+    WITH top AS (
+        SELECT product_id, SUM(orders)::int AS orders, SUM(units)::int AS units, SUM(revenue) AS revenue
+        FROM (
+            SELECT product_id, orders, units, revenue FROM sales_daily WHERE day >= $1
+            UNION ALL
+            SELECT product_id, COUNT(DISTINCT order_id), SUM(quantity), SUM(total_price)
+            FROM ({PENDING_ITEMS}) p
+            GROUP BY day, product_id
+        ) s
+        GROUP BY product_id
+        ORDER BY revenue DESC, product_id
+        LIMIT $2
+    )
+    SELECT t.product_id, COALESCE(g.name, (
+               SELECT product_name FROM sales_daily d
+               WHERE d.product_id = t.product_id AND d.day >= $1
+               ORDER BY d.day DESC
+               LIMIT 1
+           )) AS product_name, t.orders, t.units, t.revenue
+    FROM top t
+    LEFT JOIN goods g ON g.id = t.product_id
+    ORDER BY t.revenue DESC, t.product_id
+"""
+
+# Сводки с нуля по свёрнутым заказам (сверка и миграция считают одинаково)
+REBUILT_DAILY = """
+    SELECT o.created_at::date AS day, COALESCE(oi.product_id, 0) AS product_id, MAX(oi.product_name) AS product_name,
+           COUNT(DISTINCT o.id)::int AS orders, SUM(oi.quantity)::int AS units, SUM(oi.total_price) AS revenue
+    FROM orders o
+    JOIN order_items oi ON oi.order_id = o.id
+    WHERE o.aggregated
+    GROUP BY 1, 2
+"""
+
+REBUILT_TOTALS = """
+    SELECT o.created_at::date AS day, COUNT(*)::int AS orders, COALESCE(SUM(i.units), 0)::int AS units,
+           SUM(o.total_price) AS revenue
+    FROM orders o
+    LEFT JOIN LATERAL (SELECT SUM(quantity) AS units FROM order_items WHERE order_id = o.id) i ON true
+    WHERE o.aggregated
+    GROUP BY 1
+"""
+
+
+# Свёртка пачки заказов: отметка aggregated и добавление к сводкам одной командой
+FOLD_QUERY = """
+    WITH batch AS (
+        UPDATE orders SET aggregated = true
+        WHERE id = ANY(ARRAY(
+            SELECT id FROM orders WHERE NOT aggregated ORDER BY id LIMIT $1 FOR UPDATE SKIP LOCKED
+        ))
+        RETURNING id, created_at::date AS day, total_price
+    ), items AS (
+        SELECT b.day, COALESCE(oi.product_id, 0) AS product_id, MAX(oi.product_name) AS product_name,
+               COUNT(DISTINCT b.id) AS orders, SUM(oi.quantity) AS units, SUM(oi.total_price) AS revenue
+        FROM batch b
+        JOIN order_items oi ON oi.order_id = b.id
+        GROUP BY 1, 2
+    ), per_product AS (
+        INSERT INTO sales_daily (day, product_id, product_name, orders, units, revenue)
+        SELECT * FROM items ORDER BY day, product_id
+        ON CONFLICT (day, product_id) DO UPDATE
+        SET product_name = EXCLUDED.product_name,
+            orders = sales_daily.orders + EXCLUDED.orders,
+            units = sales_daily.units + EXCLUDED.units,
+            revenue = sales_daily.revenue + EXCLUDED.revenue
+    ), per_day AS (
+        INSERT INTO sales_daily_totals (day, orders, units, revenue)
+        SELECT b.day, COUNT(*), COALESCE(MAX(u.units), 0), SUM(b.total_price)
+        FROM batch b
+        LEFT JOIN (SELECT day, SUM(units) AS units FROM items GROUP BY day) u ON u.day = b.day
+        GROUP BY b.day
+        ORDER BY b.day
+        ON CONFLICT (day) DO UPDATE
+        SET orders = sales_daily_totals.orders + EXCLUDED.orders,
+            units = sales_daily_totals.units + EXCLUDED.units,
+            revenue = sales_daily_totals.revenue + EXCLUDED.revenue
+    )
+    SELECT COUNT(*)::int FROM batch
+"""
+
+
+def period_start(days, today=None):
+    """Первый день периода из days последних дней, включая сегодня."""
+    return (today or date.today()) - timedelta(days=days - 1)
+
+
+async def daily_sales(pool, days):
+    """Заказы, проданные штуки и выручка по дням за последние days дней."""
+    async with pool.acquire() as conn:
+        return await conn.fetch(DAILY_QUERY, period_start(days))
+
+
+async def top_products(pool, days, limit=10):
+    """Товары с наибольшей выручкой за последние days дней."""
+    async with pool.acquire() as conn:
+        return await conn.fetch(TOP_PRODUCTS_QUERY, period_start(days), limit)
+
+
+async def fold_sales(pool, max_orders=1000):
+    """
+    Добавляет ещё не свёрнутые заказы в сводные таблицы.
+
+    Заказы отмечаются aggregated в той же команде, что и обновление сводок, а
+    SKIP LOCKED разводит одновременные свёртки по разным заказам. Заказы из ещё
+    не завершённых транзакций не видны и будут свёрнуты в следующий раз; строки
+    сводок обновляются по возрастанию ключа, чтобы свёртки не блокировали друг
+    друга крест-накрест. Возвращает число свёрнутых заказов.
+    """
+    async with pool.acquire() as conn:
+        folded = await conn.fetchval(FOLD_QUERY, max_orders)
+    sales_folded.inc(amount=folded)
+    return folded
+
+
+async def sales_folder(pool, interval=10, max_orders=1000):
+    """Фоновая задача свёртки заказов в статистику продаж."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # Пока за проход сворачивается полная пачка заказов, продолжаем
+            while await fold_sales(pool, max_orders) == max_orders:
+                pass
+        except Exception:
+            log.exception("Не удалось свернуть заказы в статистику продаж")
+
+
+async def rebuild_sales(pool):
+    """
+    Пересчитывает сводные таблицы по orders и order_items и возвращает число
+    исправленных строк (0 — сводки сходились с заказами).
+
+    Блокировка сводок пропускает чтение /stats, но ждёт идущие свёртки и не
+    даёт начаться новым до конца пересчёта, поэтому каждый заказ учитывается
+    ровно один раз: либо пересчётом, либо свёрткой после него. Расхождения
+    бывают и после удаления товаров: их продажи переходят в product_id = 0.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("LOCK TABLE sales_daily, sales_daily_totals IN SHARE ROW EXCLUSIVE MODE")
+            await conn.execute(f"""
+                CREATE TEMP TABLE rebuilt_daily ON COMMIT DROP AS {REBUILT_DAILY};
+                CREATE TEMP TABLE rebuilt_totals ON COMMIT DROP AS {REBUILT_TOTALS};
+            """)
+            mismatches = await conn.fetchval("""
+                SELECT
+                    (SELECT COUNT(*) FROM rebuilt_daily r FULL JOIN sales_daily s USING (day, product_id)
+                     WHERE (r.orders, r.units, r.revenue) IS DISTINCT FROM (s.orders, s.units, s.revenue))
+                  + (SELECT COUNT(*) FROM rebuilt_totals r FULL JOIN sales_daily_totals s USING (day)
+                     WHERE (r.orders, r.units, r.revenue) IS DISTINCT FROM (s.orders, s.units, s.revenue))
+            """)
+            if mismatches:
+                await conn.execute("""
+                    DELETE FROM sales_daily;
+                    INSERT INTO sales_daily SELECT * FROM rebuilt_daily;
+                    DELETE FROM sales_daily_totals;
+                    INSERT INTO sales_daily_totals SELECT * FROM rebuilt_totals;
+                """)
+    sales_mismatches.inc(amount=mismatches)
+    return mismatches
+
+
+async def sales_reconciler(pool, interval=24 * 60 * 60):
+    """Фоновая сверка сводок с заказами раз в interval секунд."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            mismatches = await rebuild_sales(pool)
+            if mismatches:
+                log.warning("Статистика продаж расходилась с заказами в %d строках и пересчитана", mismatches)
+        except Exception:
+            log.exception("Не удалось сверить статистику продаж")
@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+from aiogram import Bot
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.utils.exceptions import RetryAfter, TelegramAPIError
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Приоритеты очереди: ответы пользователю отправляются раньше массовых рассылок
+INTERACTIVE = 0
+BULK = 1
+
+send_priority = contextvars.ContextVar('send_priority', default=INTERACTIVE)
+
+# Методы Bot API, которые проходят через очередь (остальные, например getUpdates
+# и answerCallbackQuery, отправляются напрямую)
+QUEUED_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendMediaGroup', 'sendDocument', 'copyMessage', 'forwardMessage',
+    'editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup',
+}
+
+# Не больше 10 фото в одном альбоме
+ALBUM_SIZE = 10
+
+# Как часто удалять лимиты чатов, в которые давно ничего не отправлялось
+PRUNE_INTERVAL = 60
+
+
+@contextmanager
+def bulk_sends():
+    """Отправки внутри блока идут в очередь массовых рассылок."""
+    token = send_priority.set(BULK)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now):
+        """Сколько секунд ждать до появления жетона."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(self.blocked_until - now, 0.0)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def consume(self):
+        self.tokens -= 1
+
+    def block(self, seconds, now):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def idle(self, now):
+        return self.delay(now) == 0 and self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('method', 'data', 'files', 'kwargs', 'priority', 'seq', 'created', 'future', 'attempts')
+
+    def __init__(self, method, data, files, kwargs, priority, seq, future):
+        self.method = method
+        self.data = data
+        self.files = files
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.created = time.monotonic()
+        self.future = future
+        self.attempts = 0
+
+    @property
+    def album_item(self):
+        # В альбом можно объединить массовую отправку фото по file_id или ссылке без клавиатуры
+        return (self.priority == BULK and self.method == 'sendPhoto' and not self.files
+                and isinstance(self.data.get('photo'), str) and 'reply_markup' not in self.data)
+
+
+class SendScheduler:
+    """
+    Очередь исходящих вызовов Bot API.
+
+    Соблюдает общий лимит бота (global_rate в секунду) и лимит на чат (chat_rate
+    в секунду с запасом chat_burst), отправляет сообщения одного чата по порядку,
+    пропускает интерактивные ответы вперёд массовых рассылок, при RetryAfter
+    ставит вызов обратно в очередь после паузы, а подряд идущие массовые фото
+    в один чат объединяет в альбомы sendMediaGroup.
+    """
+
+    def __init__(self, request, global_rate=30, chat_rate=1, chat_burst=5, album_window=0.05, max_retries=5):
+        self._request = request
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.album_window = album_window
+        self.max_retries = max_retries
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}  # chat_id -> TokenBucket
+        self._queues = {}  # chat_id -> deque заданий
+        self._busy = set()  # чаты, у которых вызов уже выполняется или запланирован
+        self._ready = []  # куча (приоритет, seq, chat_id)
+        self._delayed = []  # куча (момент готовности, chat_id)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._worker = None
+        self._tasks = set()  # выполняющиеся вызовы: цикл событий держит на задачи только слабые ссылки
+        self._pruned = time.monotonic()
+
+    async def submit(self, method, data, files, kwargs):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+
+        job = _Job(method, data, files, kwargs, send_priority.get(), next(self._seq), loop.create_future())
+        chat_id = data['chat_id']
+        self._queues.setdefault(chat_id, deque()).append(job)
+        if chat_id not in self._busy:
+            self._busy.add(chat_id)
+            self._schedule(chat_id, time.monotonic())
+        return await job.future
+
+    def set_global_rate(self, rate):
+        self.global_rate = rate
+        self._global = TokenBucket(rate, max(rate, 1))
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _schedule(self, chat_id, now):
+        head = self._queues[chat_id][0]
+        ready_at = now + self._bucket(chat_id).delay(now)
+        # Ждём немного, чтобы собрать пачку фото в один альбом
+        if head.album_item and len(self._queues[chat_id]) < ALBUM_SIZE:
+            ready_at = max(ready_at, head.created + self.album_window)
+
+        if ready_at > now:
+            heapq.heappush(self._delayed, (ready_at, chat_id))
+        else:
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            if now - self._pruned > PRUNE_INTERVAL:
+                self._prune(now)
+            while self._delayed and self._delayed[0][0] <= now:
+                _, chat_id = heapq.heappop(self._delayed)
+                head = self._queues[chat_id][0]
+                heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            wait = self._global.delay(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            bucket = self._bucket(chat_id)
+            if bucket.delay(now) > 0:
+                # Чат заблокирован RetryAfter, пока ждал своей очереди
+                self._schedule(chat_id, now)
+                continue
+
+            queue = self._queues[chat_id]
+            jobs = [queue.popleft()]
+            if jobs[0].album_item:
+                while queue and queue[0].album_item and len(jobs) < ALBUM_SIZE:
+                    jobs.append(queue.popleft())
+
+            self._global.consume()
+            bucket.consume()
+            task = asyncio.create_task(self._execute(chat_id, jobs))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, chat_id, jobs):
+        try:
+            if len(jobs) > 1:
+                media = [{'type': 'photo', 'media': job.data['photo'],
+                          **{key: job.data[key] for key in ('caption', 'parse_mode') if key in job.data}}
+                         for job in jobs]
+                results = await self._request('sendMediaGroup', {'chat_id': chat_id, 'media': json.dumps(media)})
+                for job, result in zip(jobs, results):
+                    if not job.future.done():
+                        job.future.set_result(result)
+                # Telegram вернул меньше сообщений, чем фото в альбоме: остальные не ждут вечно
+                for job in jobs[len(results):]:
+                    if not job.future.done():
+                        job.future.set_exception(TelegramAPIError(
+                            f"sendMediaGroup вернул {len(results)} сообщений на {len(jobs)} фото"))
+            else:
+                job = jobs[0]
+                result = await self._request(job.method, job.data, job.files, **job.kwargs)
+                if not job.future.done():
+                    job.future.set_result(result)
+        except RetryAfter as e:
+            now = time.monotonic()
+            self._bucket(chat_id).block(e.timeout, now)
+            retry = []
+            for job in jobs:
+                job.attempts += 1
+                if job.future.done():
+                    continue
+                if job.attempts > self.max_retries:
+                    job.future.set_exception(e)
+                else:
+                    retry.append(job)
+            log.warning("RetryAfter %s с для чата %s, повторяем %d вызовов", e.timeout, chat_id, len(retry))
+            self._queues[chat_id].extendleft(reversed(retry))
+        except Exception as e:
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
+        finally:
+            self._release(chat_id)
+
+    def _release(self, chat_id):
+        now = time.monotonic()
+        if self._queues[chat_id]:
+            self._schedule(chat_id, now)
+            return
+
+        del self._queues[chat_id]
+        self._busy.discard(chat_id)
+
+    def _prune(self, now):
+        self._pruned = now
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                        if chat_id not in self._busy and bucket.idle(now)]:
+            del self._buckets[chat_id]
+
+
+class ThrottledBot(Bot):
+    """
+    Bot, все отправки которого проходят через SendScheduler.
+
+    Лимиты по умолчанию берутся из SEND_GLOBAL_RATE, SEND_CHAT_RATE и SEND_CHAT_BURST,
+    адрес Bot API можно заменить через TELEGRAM_API_URL (локальный Bot API сервер).
+    """
+
+    def __init__(self, *args, global_rate=None, chat_rate=None, chat_burst=None, **kwargs):
+        if os.getenv('TELEGRAM_API_URL'):
+            kwargs.setdefault('server', TelegramAPIServer.from_base(os.environ['TELEGRAM_API_URL']))
+        super().__init__(*args, **kwargs)
+        self.scheduler = SendScheduler(
+            self._api_request,
+            global_rate=global_rate or float(os.getenv('SEND_GLOBAL_RATE', 30)),
+            chat_rate=chat_rate or float(os.getenv('SEND_CHAT_RATE', 1)),
+            chat_burst=chat_burst or float(os.getenv('SEND_CHAT_BURST', 5)),
+        )
+
+    # Сам вызов Bot API (без ожидания в очереди) с замером времени
+    async def _api_request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception:
+            metrics.bot_api_errors.inc(method)
+            raise
+        finally:
+            metrics.bot_api_latency.observe(time.perf_counter() - started, method)
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if method not in QUEUED_METHODS or not data or 'chat_id' not in data:
+            return await self._api_request(method, data, files, **kwargs)
+        return await self.scheduler.submit(method, data, files, kwargs)
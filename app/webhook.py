@@ -0,0 +1,135 @@
+import os
+import asyncio
+import logging
+import importlib
+import multiprocessing
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+log = logging.getLogger(__name__)
+
+# Заголовок, которым Telegram подписывает запросы webhook (secret_token из setWebhook)
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Разделы апдейта, в которых есть отправитель
+USER_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request',
+)
+
+
+# Ключ распределения апдейта по воркерам: id пользователя, а если его нет — id чата
+def user_key(update: dict) -> int:
+    for field in USER_FIELDS:
+        event = update.get(field)
+        if event:
+            if 'from' in event:
+                return event['from']['id']
+            if 'chat' in event:
+                return event['chat']['id']
+    for field in ('channel_post', 'edited_channel_post'):
+        if update.get(field):
+            return update[field]['chat']['id']
+    return update.get('update_id', 0)
+
+
+# Обрабатывает апдейт после предыдущего апдейта того же пользователя
+async def _process(dp: Dispatcher, data: dict, previous: asyncio.Task):
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        await dp.process_update(types.Update(**data))
+    except Exception:
+        log.exception("Ошибка обработки апдейта %s", data.get('update_id'))
+
+
+async def _worker(module_name: str, queue, workers: int, index: int):
+    # У каждого процесса свой порт /metrics
+    if os.getenv('METRICS_PORT'):
+        os.environ['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + index)
+
+    module = importlib.import_module(module_name)
+    module.setup()
+    Bot.set_current(module.bot)
+    Dispatcher.set_current(module.dp)
+
+    # Общий лимит Telegram делится между процессами
+    module.bot.scheduler.set_global_rate(module.bot.scheduler.global_rate / workers)
+    await module.on_startup()
+
+    loop = asyncio.get_running_loop()
+    chains = {}  # пользователь -> последний апдейт в обработке
+
+    def forget(key, task):
+        if chains.get(key) is task:
+            del chains[key]
+
+    try:
+        while True:
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+            key, data = item
+            task = asyncio.create_task(_process(module.dp, data, chains.get(key)))
+            chains[key] = task
+            task.add_done_callback(lambda done, key=key: forget(key, done))
+
+        if chains:
+            await asyncio.wait(list(chains.values()))
+    finally:
+        await module.on_shutdown()
+
+
+def _worker_main(module_name: str, queue, workers: int, index: int):
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_worker(module_name, queue, workers, index))
+
+
+def run(module_name: str):
+    """
+    Запускает бота из модуля module_name (bot или admin) в режиме webhook.
+
+    Основной процесс принимает апдейты aiohttp-сервером и раскладывает их по
+    WEBHOOK_WORKERS процессам по id пользователя, поэтому апдейты одного
+    пользователя всегда обрабатываются одним процессом и по порядку. У каждого
+    процесса свой пул соединений с базой.
+    """
+    url = os.environ['WEBHOOK_URL']
+    path = os.getenv('WEBHOOK_PATH', '/webhook')
+    host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    port = int(os.getenv('WEBHOOK_PORT', 8080))
+    secret = os.getenv('WEBHOOK_SECRET')
+    workers = int(os.getenv('WEBHOOK_WORKERS', os.cpu_count() or 1))
+
+    queues = [multiprocessing.Queue() for _ in range(workers)]
+    processes = [multiprocessing.Process(target=_worker_main, args=(module_name, queue, workers, index), daemon=True)
+                 for index, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+
+    async def handle_update(request: web.Request):
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=403)
+        data = await request.json()
+        key = user_key(data)
+        queues[key % workers].put((key, data))
+        return web.Response()
+
+    async def on_startup(app):
+        module = importlib.import_module(module_name)
+        module.setup()
+        await module.bot.set_webhook(url + path, secret_token=secret)
+        await (await module.bot.get_session()).close()
+
+    async def on_cleanup(app):
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            await asyncio.get_running_loop().run_in_executor(None, process.join)
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    web.run_app(app, host=host, port=port)
@@ -0,0 +1,114 @@
+"""
+Бенчмарк массовой рассылки админ-бота.
+
+Заполняет базу --recipients пользователями (каждый --blocked-every-й
+заблокировал бота), создаёт рассылку и отправляет её через broadcast.run_job
+против локальной замены Bot API с задержкой --api-latency на вызов. У
+админ-бота свой токен, а писать пользователям может только пользовательский
+бот, как в Telegram. С
+--crash-after N рассылка прерывается после N доставленных сообщений и
+запускается заново, как после перезапуска бота. Завершается с ошибкой, если
+кто-то получил сообщение дважды, не заблокировавший бота получатель не получил
+его вовсе или получатели не сходятся со статистикой.
+
+Пример:
+    python bench/broadcast.py --recipients 100000 --crash-after 30000
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+
+from fake_telegram import FakeTelegram
+from postgres import throwaway_postgres, prepare_database
+from run import BOT_TOKEN, bot_env
+
+FIRST_USER_ID = 1001
+ADMIN_BOT_TOKEN = '2:admin'
+
+
+async def run(args):
+    fake = FakeTelegram(latency=args.api_latency)
+    fake_url = await fake.start()
+    delivered = Counter()
+    fake.on_message = lambda chat_id, message: delivered.update((chat_id,))
+    fake.users_token = BOT_TOKEN  # Пользователи писали только пользовательскому боту
+    fake.blocked = {FIRST_USER_ID + i for i in range(0, args.recipients, args.blocked_every)} if args.blocked_every else set()
+
+    with throwaway_postgres() as dsn:
+        await prepare_database(dsn, 0, 0, args.recipients, 0)
+        os.environ.update(bot_env(args, dsn, fake_url), ADMIN_BOT_TOKEN=ADMIN_BOT_TOKEN)
+        import admin
+        import broadcast
+        await admin.on_startup()
+
+        job_id = await broadcast.create_job(admin.db_pool, "Новые поступления в каталоге!")
+        rate = args.rate or 1000000  # Без --rate меряем саму рассылку, а не лимит
+
+        async def crash_when_delivered(task):
+            while sum(delivered.values()) < args.crash_after and not task.done():
+                await asyncio.sleep(0.01)
+            task.cancel()
+
+        started = time.perf_counter()
+        runs = 0
+        while True:
+            runs += 1
+            task = asyncio.create_task(broadcast.run_job(admin.db_pool, admin.shop_bot, job_id, args.concurrency, rate))
+            if args.crash_after and runs == 1:
+                asyncio.create_task(crash_when_delivered(task))
+            try:
+                job = await task
+                break
+            except asyncio.CancelledError:
+                pass  # "Падение": запускаем рассылку заново
+        duration = time.perf_counter() - started
+        job = await broadcast.get_job(admin.db_pool, job_id)
+        await admin.on_shutdown()
+
+    await fake.stop()
+    processed = job['sent'] + job['failed'] + job['blocked']
+    return {
+        'config': vars(args),
+        'runs': runs,
+        'duration_s': round(duration, 3),
+        'messages_per_s': round(processed / duration, 1),
+        'status': job['status'],
+        'sent': job['sent'],
+        'blocked': job['blocked'],
+        'failed': job['failed'],
+        'unknown': broadcast.unknown(job),
+        'delivered_chats': len(delivered),
+        'duplicates': sum(1 for count in delivered.values() if count > 1),
+        'missed': args.recipients - len(fake.blocked) - len(delivered),
+        'all_accounted': job['claimed'] == args.recipients and processed + broadcast.unknown(job) == args.recipients,
+        'api_calls': dict(fake.calls),
+        'foreign_bot_sends': sum(fake.foreign_sends.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recipients', type=int, default=100000)
+    parser.add_argument('--blocked-every', type=int, default=20, help='каждый N-й пользователь заблокировал бота (0 — никто)')
+    parser.add_argument('--concurrency', type=int, default=50, help='одновременных отправок (BROADCAST_CONCURRENCY)')
+    parser.add_argument('--rate', type=float, default=0, help='лимит рассылки в секунду (BROADCAST_RATE), 0 — без лимита')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='задержка ответа Bot API, с')
+    parser.add_argument('--crash-after', type=int, default=0, help='прервать рассылку после N доставленных сообщений')
+    parser.add_argument('--respect-limits', action='store_true', help='соблюдать лимиты Telegram (30 сообщений/с на бота)')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result['duplicates'] or result['missed'] or result['foreign_bot_sends'] or not result['all_accounted']:
+        raise SystemExit("Повторные сообщения, пропущенные или неучтённые получатели или отправки не тем ботом")
+
+
+if __name__ == '__main__':
+    main()
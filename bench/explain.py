@@ -0,0 +1,206 @@
+"""
+Проверка планов горячих запросов.
+
+Заполняет базу данными реалистичного объёма, выполняет EXPLAIN для запросов,
+которые бот делает на каждое действие пользователя, и завершается с ошибкой,
+если в каком-либо плане есть Seq Scan по таблице.
+
+Пример:
+    BENCH_DSN=postgresql://bench@127.0.0.1:5432/bench python bench/explain.py --users 100000
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+from datetime import datetime
+
+import asyncpg
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+
+import db
+import sales
+
+from postgres import throwaway_postgres, prepare_database
+
+# Горячие запросы с параметрами для проверки. Запросы, которых нет в app/db.py
+# и app/sales.py (app/ledger.py, app/broadcast.py, app/pg_storage.py), при
+# изменении нужно поменять и здесь
+HOT_QUERIES = {
+    'start: поиск пользователя': ("SELECT id FROM users WHERE telegram_id = $1", (1500,)),
+    # Запросы покупателей берутся из app/db.py как есть
+    'catalog: следующая страница': (db.CATALOG_NEXT, (5000, 6)),
+    'catalog: предыдущая страница': (db.CATALOG_PREV, (5000, 6)),
+    'search: inline-поиск': (db.SEARCH, ('1234:*', 0, 21)),
+    'buy: остаток товара': (db.PRODUCT_QUANTITY, (42,)),
+    'quantity: резерв товара': (db.RESERVE, (1500, 42, 1, 1800)),
+    'cart: товары корзины': (db.CART, (1500,)),
+    'cart: изменение позиции': (db.DECREASE_CART_ITEM, (1500, 42, 1)),
+    'checkout: товары без резерва': (db.UNRESERVED_CART_PRODUCTS, (1500,)),
+    'checkout: блокировка корзины': (db.CHECKOUT_CART, (1500,)),
+    'checkout: блокировка товаров': (db.LOCK_GOODS, ([1, 2, 3],)),
+    'checkout: очистка корзины': (db.DELETE_CART_ROWS, ([1, 2, 3],)),
+    'orders: страница заказов': (db.ORDERS_PAGE, (1500, datetime.max, 0, 6)),
+    'balance: баланс': (db.USER, (1500,)),
+    'ledger: пользователи для свёртки': ("""
+        SELECT telegram_id FROM users
+        WHERE telegram_id = ANY(ARRAY(SELECT DISTINCT user_id FROM balance_ledger WHERE NOT folded LIMIT $1))
+        ORDER BY telegram_id
+        FOR UPDATE
+    """, (1000,)),
+    'ledger: свёртка': ("UPDATE balance_ledger SET folded = true WHERE NOT folded AND user_id = ANY($1::bigint[])",
+                        ([1500, 1501, 1502],)),
+    'sweeper: просроченные резервы': (db.EXPIRED_RESERVATIONS, (500,)),
+    'sweeper: удаление резервов': (db.RELEASE_EXPIRED, ([1, 2, 3],)),
+    'broadcast: получатели': ("""
+        WITH job AS (
+            SELECT last_user_id FROM broadcast_jobs WHERE id = $1 AND status = 'running' FOR UPDATE
+        ), returned AS (
+            DELETE FROM broadcast_pending p USING job
+            WHERE p.job_id = $1
+            RETURNING p.user_id
+        ), batch AS (
+            SELECT u.telegram_id FROM users u, job
+            WHERE u.telegram_id > job.last_user_id
+            ORDER BY u.telegram_id
+            LIMIT $2
+        ), claimed AS (
+            UPDATE broadcast_jobs
+            SET last_user_id = COALESCE((SELECT MAX(telegram_id) FROM batch), last_user_id),
+                claimed = claimed + (SELECT COUNT(*) FROM batch) + (SELECT COUNT(*) FROM returned)
+            WHERE id = $1 AND (EXISTS (SELECT 1 FROM batch) OR EXISTS (SELECT 1 FROM returned))
+        )
+        SELECT user_id FROM returned
+        UNION ALL
+        SELECT telegram_id FROM batch
+    """, (1, 100)),
+    # Запросы статистики продаж берутся из app/sales.py как есть
+    'stats: продажи по дням': (sales.DAILY_QUERY, (sales.period_start(7, datetime.now().date()),)),
+    'stats: товары с наибольшей выручкой': (
+        sales.TOP_PRODUCTS_QUERY, (sales.period_start(7, datetime.now().date()), 10)),
+    'sales: свёртка заказов': (sales.FOLD_QUERY, (1000,)),
+    'fsm: чтение состояния': ("""
+        SELECT state, data::text, bucket::text, EXTRACT(EPOCH FROM expires_at - now()) AS ttl
+        FROM fsm_storage
+        WHERE namespace = $1 AND chat = $2 AND "user" = $3 AND expires_at > now()
+    """, ('shop', 1500, 1500)),
+    'fsm: удаление устаревших': ("DELETE FROM fsm_storage WHERE expires_at < now()", ()),
+}
+
+
+async def seed(conn, users, orders_per_user, items_per_order, carts_per_user):
+    """Добавляет заказы, корзины и состояния FSM поверх товаров и пользователей из prepare_database."""
+    await conn.execute("""
+        INSERT INTO orders (user_id, total_price, created_at)
+        SELECT 1000 + u, 100, now() - (n || ' days')::interval
+        FROM generate_series(1, $1) AS u, generate_series(1, $2) AS n
+    """, users, orders_per_user)
+    await conn.execute("""
+        INSERT INTO order_items (order_id, product_id, product_name, quantity, price, total_price)
+        SELECT o.id, 1 + (o.id * 7 + n) % g.count, 'Товар', 1, 100, 100
+        FROM orders o, generate_series(1, $1) AS n, (SELECT COUNT(*) AS count FROM goods) AS g
+    """, items_per_order)
+    # Резервы: часть уже просрочена
+    await conn.execute("""
+        INSERT INTO carts (user_id, product_id, price, quantity, reserved_until)
+        SELECT 1000 + u, 1 + (u * 13 + n) % g.count, 100, 1,
+               CASE WHEN u % 100 = 0 THEN now() - interval '1 minute' ELSE now() + interval '30 minutes' END
+        FROM generate_series(1, $1) AS u, generate_series(1, $2) AS n, (SELECT COUNT(*) AS count FROM goods) AS g
+    """, users, carts_per_user)
+    # Журнал баланса: почти всё уже свёрнуто в снимок
+    await conn.execute("""
+        INSERT INTO balance_ledger (user_id, amount, kind, folded)
+        SELECT 1000 + u, 100, 'top_up', n > 1 OR u % 100 <> 0
+        FROM generate_series(1, $1) AS u, generate_series(1, $2) AS n
+    """, users, orders_per_user + 1)
+    # Рассылки: несколько в день за несколько лет, одна идёт сейчас; часть остановлена
+    # вместе с ботом и отменена, не дождавшись возвращённых получателей
+    await conn.execute("""
+        INSERT INTO broadcast_jobs (text, status, total, last_user_id, claimed, sent, finished_at)
+        SELECT 'Рассылка ' || n, CASE WHEN n = 1 THEN 'running' WHEN n % 10 = 0 THEN 'cancelled' ELSE 'done' END, $1,
+               CASE WHEN n = 1 THEN 1000 + $1 / 2 ELSE 1000 + $1 END, $1, $1, now()
+        FROM generate_series(1, 5000) AS n
+    """, users)
+    await conn.execute("""
+        INSERT INTO broadcast_pending (job_id, user_id)
+        SELECT n, 1000 + u FROM generate_series(10, 5000, 10) AS n, generate_series(1, 100) AS u
+    """)
+    # Статистика продаж: свёрнуто всё, кроме части последних заказов, плюс
+    # несколько лет более ранних продаж
+    await conn.execute("UPDATE orders SET aggregated = user_id % 100 <> 0")
+    await conn.execute(f"INSERT INTO sales_daily {sales.REBUILT_DAILY}")
+    await conn.execute(f"INSERT INTO sales_daily_totals {sales.REBUILT_TOTALS}")
+    await conn.execute("""
+        INSERT INTO sales_daily (day, product_id, product_name, orders, units, revenue)
+        SELECT current_date - 30 - d, 1 + (d * 7 + p) % g.count, 'Товар', 1, 1, 100
+        FROM generate_series(0, 1000) AS d, generate_series(1, 200) AS p, (SELECT COUNT(*) AS count FROM goods) AS g
+        ON CONFLICT DO NOTHING
+    """)
+    await conn.execute("""
+        INSERT INTO sales_daily_totals (day, orders, units, revenue)
+        SELECT day, SUM(orders), SUM(units), SUM(revenue) FROM sales_daily WHERE day < current_date - 29 GROUP BY day
+    """)
+    # Состояния FSM: устаревшие удаляются каждые 10 минут, поэтому их немного
+    await conn.execute("""
+        INSERT INTO fsm_storage (namespace, chat, "user", state, expires_at)
+        SELECT 'shop', 1000 + u, 1000 + u, NULL,
+               CASE WHEN u % 100 = 0 THEN now() - interval '1 minute' ELSE now() + interval '1 day' END
+        FROM generate_series(1, $1) AS u
+    """, users)
+    await conn.execute("ANALYZE")
+
+
+def seq_scans(plan):
+    """Таблицы, которые план читает последовательным сканированием."""
+    found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', ()):
+        found.extend(seq_scans(child))
+    return found
+
+
+async def check(dsn):
+    conn = await asyncpg.connect(dsn)
+    failed = {}
+    try:
+        for name, (query, args) in HOT_QUERIES.items():
+            # EXPLAIN без ANALYZE: изменяющие запросы не выполняются
+            plan = json.loads(await conn.fetchval("EXPLAIN (FORMAT JSON) " + query, *args))[0]['Plan']
+            tables = seq_scans(plan)
+            print(f"{'SEQ SCAN ' + ', '.join(tables) if tables else 'ok':40} {name}")
+            if tables:
+                failed[name] = tables
+    finally:
+        await conn.close()
+    return failed
+
+
+async def run(args):
+    with throwaway_postgres() as dsn:
+        await prepare_database(dsn, args.products, 0, args.users, 0)
+        conn = await asyncpg.connect(dsn)
+        try:
+            await seed(conn, args.users, args.orders_per_user, args.items_per_order, args.carts_per_user)
+        finally:
+            await conn.close()
+        return await check(dsn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--orders-per-user', type=int, default=4)
+    parser.add_argument('--items-per-order', type=int, default=3)
+    parser.add_argument('--carts-per-user', type=int, default=2)
+    args = parser.parse_args()
+
+    if asyncio.run(run(args)):
+        raise SystemExit("Горячие запросы читают таблицы последовательно")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import asyncio
+import hashlib
+
+from aiohttp import web
+
+
+class FakeImgbb:
+    """
+    Локальная замена API загрузки imgbb (https://api.imgbb.com/1/upload).
+
+    Принимает multipart-форму с полем image и отвечает ссылкой, как настоящий
+    imgbb. latency — задержка каждого ответа, fail_every — каждая такая по счёту
+    загрузка завершается ошибкой 500.
+    """
+
+    def __init__(self, latency=0.0, fail_every=0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.uploads = 0
+        self.bytes = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._runner = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post('/1/upload', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{port}/1/upload'
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def handle(self, request: web.Request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            form = await request.post()
+            image = form['image'].file.read()
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            self.uploads += 1
+            self.bytes += len(image)
+            if self.fail_every and self.uploads % self.fail_every == 0:
+                return web.json_response({'success': False, 'status': 500}, status=500)
+            digest = hashlib.sha256(image).hexdigest()[:16]
+            url = f'https://i.ibb.co/{digest}/{form["image"].filename}'
+            return web.json_response({'success': True, 'status': 200, 'data': {'image': {'url': url}}})
+        finally:
+            self.in_flight -= 1
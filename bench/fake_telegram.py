@@ -0,0 +1,178 @@
+import json
+import math
+import time
+import asyncio
+import itertools
+from collections import Counter
+
+from aiohttp import web
+
+# Пользователь, от имени которого "отвечает" бот
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Shop', 'username': 'shop_bot'}
+
+# Методы, которые возвращают отправленное или изменённое сообщение
+MESSAGE_METHODS = {
+    'sendmessage', 'sendphoto', 'senddocument', 'copymessage', 'forwardmessage',
+    'editmessagetext', 'editmessagecaption', 'editmessagemedia', 'editmessagereplymarkup',
+}
+
+# Отправки, на которые при превышении лимита чата отвечается 429
+FLOOD_METHODS = MESSAGE_METHODS | {'sendmediagroup'}
+
+
+class FakeTelegram:
+    """
+    Локальная замена Bot API.
+
+    Отвечает на вызовы бота правдоподобными объектами, отдаёт апдейты через
+    getUpdates (режим polling), передаёт каждое сообщение бота в on_message
+    и по желанию добавляет задержку latency к каждому вызову. Отправки в чаты
+    из blocked отклоняются так же, как Telegram отвечает заблокировавшим бота.
+    С flood_every каждая N-я отправка в чат получает 429 с retry_after секунд, и
+    до конца паузы 429 получают все отправки в этот чат. Без file_ids_accepted
+    ответ на inline-запрос с фото по file_id отклоняется, как file_id другого бота.
+    Если задан users_token, писать пользователям может только бот с этим токеном:
+    остальным Telegram отвечает, что бот не может начать диалог.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.updates = asyncio.Queue()
+        self.calls = Counter()
+        self.webhook_url = None
+        self.on_message = None  # callback(chat_id, message)
+        self.blocked = set()  # чаты пользователей, заблокировавших бота
+        self.flood_every = 0  # каждая N-я отправка в чат получает 429 (0 — никогда)
+        self.retry_after = 1  # пауза в ответе 429, с
+        self.flood_errors = Counter()  # ответы 429 по методам
+        self.file_ids_accepted = True  # принимать ли file_id фото в ответах на inline-запросы
+        self.rejected_answers = 0
+        self.users_token = None  # токен бота, которому пользователи написали (None — любой)
+        self.foreign_sends = Counter()  # отправки пользователям от других ботов по методам
+        self._chat_sends = Counter()
+        self._flood_until = {}  # chat_id -> момент окончания паузы
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def _message(self, params):
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        if 'caption' in params:
+            message['caption'] = params['caption']
+        if 'photo' in params:
+            message['photo'] = [{'file_id': f'photo-{message["message_id"]}', 'file_unique_id': 'u',
+                                 'width': 1, 'height': 1}]
+        if params.get('reply_markup'):
+            markup = json.loads(params['reply_markup'])
+            if 'inline_keyboard' in markup:
+                message['reply_markup'] = markup
+        return message
+
+    def _deliver(self, message):
+        if self.on_message:
+            self.on_message(message['chat']['id'], message)
+
+    def _flood_wait(self, chat_id):
+        """Сколько секунд чат ещё на паузе после 429 (0 — отправку можно принять)."""
+        now = time.monotonic()
+        until = self._flood_until.get(chat_id, 0)
+        if until <= now:
+            self._chat_sends[chat_id] += 1
+            if self._chat_sends[chat_id] % self.flood_every:
+                return 0
+            until = self._flood_until[chat_id] = now + self.retry_after
+        return max(1, math.ceil(until - now))
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method'].lower()
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if (self.users_token and method in FLOOD_METHODS and 'chat_id' in params
+                and request.match_info['token'] != self.users_token):
+            self.foreign_sends[method] += 1
+            return web.json_response({'ok': False, 'error_code': 403,
+                                      'description': "Forbidden: bot can't initiate conversation with a user"}, status=403)
+
+        if method in MESSAGE_METHODS and int(params.get('chat_id') or 0) in self.blocked:
+            return web.json_response({'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'},
+                                     status=403)
+
+        if self.flood_every and method in FLOOD_METHODS and 'chat_id' in params:
+            wait = self._flood_wait(int(params['chat_id']))
+            if wait:
+                self.flood_errors[method] += 1
+                return web.json_response({'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {wait}',
+                                          'parameters': {'retry_after': wait}}, status=429)
+
+        if method == 'answerinlinequery' and not self.file_ids_accepted and 'photo_file_id' in params.get('results', ''):
+            self.rejected_answers += 1
+            return web.json_response({'ok': False, 'error_code': 400,
+                                      'description': 'Bad Request: wrong file identifier/http url specified'}, status=400)
+
+        if method == 'getupdates':
+            result = await self._get_updates(params)
+        elif method == 'getme':
+            result = BOT_USER
+        elif method == 'getwebhookinfo':
+            result = {'url': self.webhook_url or '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        elif method == 'setwebhook':
+            self.webhook_url = params.get('url')
+            result = True
+        elif method == 'sendmediagroup':
+            result = []
+            for item in json.loads(params['media']):
+                message = self._message({'chat_id': params['chat_id'], 'photo': item['media'],
+                                         **({'caption': item['caption']} if 'caption' in item else {})})
+                self._deliver(message)
+                result.append(message)
+        elif method == 'answercallbackquery':
+            # Текст ответа на нажатие кнопки передаём пользователю как сообщение
+            # (id нажатия в сценариях имеет вид "<user_id>:<n>")
+            if params.get('text'):
+                user_id = int(params['callback_query_id'].split(':')[0])
+                self._deliver({'chat': {'id': user_id}, 'text': params['text'], 'callback_answer': True})
+            result = True
+        elif method in MESSAGE_METHODS and 'chat_id' in params:
+            result = self._message(params)
+            self._deliver(result)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _get_updates(self, params):
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        try:
+            first = await asyncio.wait_for(self.updates.get(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        batch = [first]
+        while len(batch) < limit and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
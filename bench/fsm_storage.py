@@ -0,0 +1,232 @@
+"""
+Бенчмарк хранилища состояний FSM (app/pg_storage.py) против PostgreSQL.
+
+Три прогона на одноразовой базе:
+  1. write-behind: --users диалогов по --steps шагов (set_state и update_data)
+     с --concurrency одновременно; каждый --finish-every-й диалог в конце
+     сбрасывается. Изменения пишутся в базу фоновым сбросом раз в
+     --flush-interval секунд и при закрытии. Проверяется, что в базе ровно
+     последние состояния незавершённых диалогов;
+  2. LRU: новое хранилище с кэшем на --cache-size записей читает все состояния
+     из базы (холодные чтения), затем ещё раз (вытесненные записи читаются
+     заново), затем меняет вдвое больше записей, чем помещается в кэш, без
+     сброса. Проверяется, что кэш не растёт сверх размера за счёт сохранённых
+     записей, несохранённые не вытесняются, а после сброса кэш снова в пределах;
+  3. TTL: состояния с ttl --ttl секунд; по истечении половина диалогов
+     продолжается, после чего purge удаляет остальные из базы и кэша.
+Завершается с ошибкой, если какая-либо проверка не прошла.
+
+Пример:
+    python bench/fsm_storage.py --users 5000 --steps 5 --cache-size 1000
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+
+import asyncpg
+
+from pg_storage import PostgresStorage
+from postgres import throwaway_postgres, prepare_database
+from run import percentiles
+
+FIRST_USER_ID = 1001
+
+
+class CountingStorage(PostgresStorage):
+    """PostgresStorage, запоминающий размер и время каждого сброса в базу."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.flushes = []  # (записей, секунд)
+
+    async def flush(self):
+        dirty = len(self._dirty)
+        started = time.perf_counter()
+        await super().flush()
+        if dirty:
+            self.flushes.append((dirty, time.perf_counter() - started))
+
+
+def flush_stats(storage):
+    return {
+        'flushes': len(storage.flushes),
+        'rows_written': sum(rows for rows, _ in storage.flushes),
+        'flush': percentiles([duration for _, duration in storage.flushes]),
+    }
+
+
+async def stored_states(pool, namespace):
+    """{user: (state, data)} из базы."""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch('SELECT "user", state, data::text FROM fsm_storage WHERE namespace = $1', namespace)
+    return {row['user']: (row['state'], json.loads(row['data'])) for row in rows}
+
+
+def final_state(index, args):
+    """Последнее состояние диалога index после write-behind (None — диалог завершён)."""
+    if args.finish_every and index % args.finish_every == 0:
+        return None
+    return f'Dialog:step{args.steps - 1}', {'step': args.steps - 1}
+
+
+async def write_behind(pool, args):
+    storage = CountingStorage('bench', cache_size=args.users, flush_interval=args.flush_interval)
+    await storage.start(pool)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def dialog(index):
+        user = FIRST_USER_ID + index
+        async with semaphore:
+            for step in range(args.steps):
+                started = time.perf_counter()
+                await storage.set_state(chat=user, user=user, state=f'Dialog:step{step}')
+                await storage.update_data(chat=user, user=user, step=step)
+                latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(0)  # Шаги диалога — отдельные апдейты
+            if final_state(index, args) is None:
+                await storage.reset_state(chat=user, user=user)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(dialog(index) for index in range(args.users)))
+    duration = time.perf_counter() - started
+    await storage.close()
+
+    expected = {FIRST_USER_ID + index: final_state(index, args) for index in range(args.users)}
+    expected = {user: value for user, value in expected.items() if value is not None}
+    updates = args.users * args.steps * 2
+    stats = flush_stats(storage)
+    return {
+        'duration_s': round(duration, 3),
+        'updates': updates,
+        **stats,
+        'updates_per_row_written': round(updates / max(stats['rows_written'], 1), 1),
+        'step': percentiles(latencies),
+        'ok': await stored_states(pool, 'bench') == expected,
+    }
+
+
+async def lru(pool, args):
+    storage = CountingStorage('bench', cache_size=args.cache_size, flush_interval=3600)
+    await storage.start(pool)
+    users = [FIRST_USER_ID + index for index in range(args.users)]
+    ok = True
+
+    async def read_all(samples):
+        nonlocal ok
+        for index, user in enumerate(users):
+            started = time.perf_counter()
+            state = await storage.get_state(chat=user, user=user)
+            data = await storage.get_data(chat=user, user=user)
+            samples.append(time.perf_counter() - started)
+            expected = final_state(index, args)
+            ok &= (state, data) == (expected or (None, {}))
+
+    cold, evicted, cached = [], [], []
+    await read_all(cold)
+    cache_after_reads = len(storage._cache)
+    await read_all(evicted)  # Кэш меньше числа пользователей: первые записи уже вытеснены
+    for user in users[-args.cache_size:]:
+        started = time.perf_counter()
+        await storage.get_state(chat=user, user=user)
+        cached.append(time.perf_counter() - started)
+
+    # Несохранённые записи не вытесняются, пока их не запишет сброс
+    changed = users[:2 * args.cache_size]
+    for user in changed:
+        await storage.set_state(chat=user, user=user, state='Dialog:changed')
+    cache_with_dirty = len(storage._cache)
+    ok &= cache_with_dirty >= len(changed)
+    await storage.flush()
+    cache_after_flush = len(storage._cache)
+    await storage.close()
+
+    stored = await stored_states(pool, 'bench')
+    ok &= all(stored[user][0] == 'Dialog:changed' for user in changed)
+    ok &= cache_after_reads <= args.cache_size and cache_after_flush <= args.cache_size
+    return {
+        'cold_read': percentiles(cold),
+        'evicted_read': percentiles(evicted),
+        'cached_read': percentiles(cached),
+        'cache_after_reads': cache_after_reads,
+        'cache_with_dirty': cache_with_dirty,
+        'cache_after_flush': cache_after_flush,
+        **flush_stats(storage),
+        'ok': ok,
+    }
+
+
+async def ttl_purge(pool, args):
+    storage = CountingStorage('ttl', ttl=args.ttl, cache_size=args.users, flush_interval=3600, purge_interval=3600)
+    await storage.start(pool)
+    users = [FIRST_USER_ID + index for index in range(args.users)]
+    for user in users:
+        await storage.set_state(chat=user, user=user, state='Dialog:waiting')
+    await storage.flush()
+
+    await asyncio.sleep(args.ttl + 0.5)
+    # Половина диалогов продолжается и продлевает срок
+    continued = users[::2]
+    for user in continued:
+        await storage.set_state(chat=user, user=user, state='Dialog:continued')
+    await storage.flush()
+
+    started = time.perf_counter()
+    await storage.purge()
+    purge_duration = time.perf_counter() - started
+    cache_after_purge = len(storage._cache)
+    expired_state = await storage.get_state(chat=users[1], user=users[1])
+    await storage.close()
+
+    stored = await stored_states(pool, 'ttl')
+    return {
+        'purge_ms': round(purge_duration * 1000, 3),
+        'rows_after_purge': len(stored),
+        'cache_after_purge': cache_after_purge,
+        'ok': (set(stored) == set(continued) and cache_after_purge == len(continued) and expired_state is None),
+    }
+
+
+async def run(args):
+    with throwaway_postgres() as dsn:
+        await prepare_database(dsn, 0, 0, 0, 0)
+        pool = await asyncpg.create_pool(dsn, min_size=2, max_size=10)
+        try:
+            return {
+                'config': vars(args),
+                'write_behind': await write_behind(pool, args),
+                'lru': await lru(pool, args),
+                'ttl': await ttl_purge(pool, args),
+            }
+        finally:
+            await pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--steps', type=int, default=5, help='шагов в диалоге')
+    parser.add_argument('--concurrency', type=int, default=200, help='одновременных диалогов')
+    parser.add_argument('--finish-every', type=int, default=3, help='каждый N-й диалог завершается (0 — ни один)')
+    parser.add_argument('--flush-interval', type=float, default=0.2, help='интервал сброса в базу, с')
+    parser.add_argument('--cache-size', type=int, default=1000, help='размер кэша для прогона LRU')
+    parser.add_argument('--ttl', type=int, default=2, help='срок жизни состояния для прогона TTL, с')
+    args = parser.parse_args()
+    if args.cache_size * 2 > args.users:
+        parser.error("--cache-size должен быть не больше половины --users")
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    failed = [name for name in ('write_behind', 'lru', 'ttl') if not result[name]['ok']]
+    if failed:
+        raise SystemExit(f"Проверки не прошли: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
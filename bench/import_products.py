@@ -0,0 +1,128 @@
+"""
+Бенчмарк импорта каталога админ-ботом (/import).
+
+Генерирует CSV на --rows товаров и zip с фото, загружает фото в локальную
+замену imgbb (fake_imgbb.py) через хранилище изображений админ-бота
+(images.ImageStore) и записывает товары в одноразовую базу PostgreSQL через
+product_import.import_products. --distinct-images меньше --rows означает, что
+одинаковые фото повторяются и должны загружаться один раз. Каждая --bad-every-я
+строка не проходит проверку (цена не число или не помещается в колонку), а
+каждую --reject-every-ю отвергает сама база (NUL в названии): отчёт должен
+содержать ровно эти строки, а остальные строки их пачек — попасть в базу.
+
+Пример:
+    python bench/import_products.py --rows 2000 --concurrency 8 --upload-latency 200
+"""
+import io
+import os
+import sys
+import csv
+import time
+import json
+import asyncio
+import zipfile
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+
+import asyncpg
+
+from fake_imgbb import FakeImgbb
+from postgres import throwaway_postgres, app_env, prepare_database
+
+
+def make_files(rows, bad_every, reject_every, image_size, distinct_images, encoding):
+    """
+    CSV с товарами в кодировке encoding и zip с фото. Возвращает также число
+    строк с ошибками.
+    """
+    table = io.StringIO()
+    writer = csv.writer(table)
+    writer.writerow(['name', 'description', 'quantity', 'price', 'image'])
+    archive = io.BytesIO()
+    bad = 0
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as images:
+        for i in range(1, rows + 1):
+            image = f'photos/{i}.jpg'
+            name, price = f'Товар {i}', f'{100 + i % 900}.50'
+            if bad_every and i % bad_every == 0:
+                price = 'не цена' if i // bad_every % 2 else '123456789'
+                bad += 1
+            elif reject_every and i % reject_every == 0:
+                name = f'Товар\x00{i}'
+                bad += 1
+            writer.writerow([name, f'Описание товара {i}', 10 + i % 50, price, image])
+            content = (i % distinct_images).to_bytes(4, 'big') * (image_size // 4)
+            images.writestr(image, content)
+    return table.getvalue().encode(encoding), archive.getvalue(), bad
+
+
+async def run(args):
+    fake = FakeImgbb(latency=args.upload_latency / 1000, fail_every=args.fail_every)
+    upload_url = await fake.start()
+
+    with throwaway_postgres() as dsn:
+        await prepare_database(dsn, 0, 0, 0, 0)
+        os.environ.update(app_env(dsn), BOT_TOKEN='123456:bench-token', IMGBB_UPLOAD_URL=upload_url)
+        import admin
+        from product_import import read_rows, ImageArchive, import_products
+
+        table, archive, bad = make_files(args.rows, args.bad_every, args.reject_every, args.image_size,
+                                         args.distinct_images or args.rows, args.encoding)
+        await admin.on_startup()
+        try:
+            started = time.perf_counter()
+            report = await import_products(admin.db_pool, read_rows('goods.csv', table), ImageArchive(archive),
+                                           admin.image_store.store, concurrency=args.concurrency, batch_size=args.batch_size)
+            duration = time.perf_counter() - started
+        finally:
+            await admin.on_shutdown()
+
+        conn = await asyncpg.connect(dsn)
+        try:
+            in_db = await conn.fetchval("SELECT COUNT(*) FROM goods")
+        finally:
+            await conn.close()
+
+    await fake.stop()
+    return {
+        'config': vars(args),
+        'duration_s': round(duration, 3),
+        'rows_per_s': round(args.rows / duration, 1),
+        'imported': report.imported,
+        'in_database': in_db,
+        'errors': len(report.errors),
+        'bad_rows': bad,
+        'first_errors': report.errors[:5],
+        'uploads': fake.uploads,
+        'max_parallel_uploads': fake.max_in_flight,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8, help='одновременных загрузок фото')
+    parser.add_argument('--batch-size', type=int, default=500, help='строк в одном COPY')
+    parser.add_argument('--upload-latency', type=float, default=200.0, help='задержка заглушки imgbb, мс')
+    parser.add_argument('--image-size', type=int, default=50 * 1024, help='размер фото, байт')
+    parser.add_argument('--distinct-images', type=int, default=0, help='различных фото (0 — все разные)')
+    parser.add_argument('--bad-every', type=int, default=100, help='каждая N-я строка с ошибкой (0 — без ошибок)')
+    parser.add_argument('--reject-every', type=int, default=250, help='каждую N-ю строку отвергает база (0 — ни одной)')
+    parser.add_argument('--fail-every', type=int, default=0, help='каждая N-я загрузка фото с ошибкой')
+    parser.add_argument('--encoding', default='utf-8', help='кодировка CSV (например, cp1251)')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result['imported'] != result['in_database']:
+        raise SystemExit("Число товаров в базе не совпадает с отчётом импорта")
+    if result['imported'] + result['errors'] != args.rows:
+        raise SystemExit("Не все строки попали в отчёт импорта")
+    if not args.fail_every and result['errors'] != result['bad_rows']:
+        raise SystemExit("Ошибки в отчёте не совпадают со строками с ошибками")
+
+
+if __name__ == '__main__':
+    main()
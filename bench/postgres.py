@@ -0,0 +1,107 @@
+import os
+import shutil
+import socket
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import asyncpg
+
+from migrate import migrate
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def throwaway_postgres():
+    """
+    Отдаёт DSN базы для бенчмарка.
+
+    Если задан BENCH_DSN, используется он (база должна быть пустой). Иначе во
+    временном каталоге поднимается отдельный кластер PostgreSQL (нужны initdb
+    и pg_ctl в PATH и запуск не от root), который удаляется после завершения.
+    """
+    if os.getenv('BENCH_DSN'):
+        yield os.environ['BENCH_DSN']
+        return
+
+    if not shutil.which('initdb') or not shutil.which('pg_ctl'):
+        raise SystemExit("Не найдены initdb/pg_ctl: установите PostgreSQL или задайте BENCH_DSN")
+
+    directory = tempfile.mkdtemp(prefix='shop-bench-')
+    data = os.path.join(directory, 'data')
+    port = _free_port()
+    subprocess.run(['initdb', '-D', data, '-U', 'bench', '--auth=trust', '-E', 'UTF8'],
+                   check=True, stdout=subprocess.DEVNULL)
+    subprocess.run(['pg_ctl', '-D', data, '-l', os.path.join(directory, 'log'), '-w',
+                    '-o', f'-p {port} -k {directory} -c listen_addresses=127.0.0.1 -c max_connections=300 -c fsync=off',
+                    'start'], check=True, stdout=subprocess.DEVNULL)
+    try:
+        yield f'postgresql://bench@127.0.0.1:{port}/postgres'
+    finally:
+        subprocess.run(['pg_ctl', '-D', data, '-m', 'immediate', 'stop'], stdout=subprocess.DEVNULL)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def app_env(dsn):
+    """Переменные окружения DB_*, которыми боты подключаются к базе."""
+    url = urlparse(dsn)
+    return {
+        'DB_USER': url.username or '',
+        'DB_PASSWORD': url.password or '',
+        'DB_NAME': url.path.lstrip('/') or 'postgres',
+        'DB_HOST': url.hostname or '127.0.0.1',
+        'DB_PORT': str(url.port or 5432),
+    }
+
+
+async def prepare_database(dsn, products, stock, users, balance):
+    """Применяет миграции бота и заполняет товары и пользователей с балансом."""
+    pool = await asyncpg.create_pool(dsn, min_size=1, max_size=1)
+    try:
+        await migrate(pool)
+    finally:
+        await pool.close()
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        # Вместе с данными очищаем состояния FSM от прошлых запусков
+        await conn.execute("TRUNCATE users, goods, carts, orders, order_items, fsm_storage, images, balance_ledger, broadcast_jobs, sales_daily, sales_daily_totals RESTART IDENTITY CASCADE")
+        await conn.execute("""
+            INSERT INTO goods (name, description, quantity, price, image_url)
+            SELECT 'Товар ' || i, 'Описание товара ' || i, $2, 100 + i % 900, 'https://example.com/' || i || '.jpg'
+            FROM generate_series(1, $1) AS i
+        """, products, stock)
+        await conn.execute("""
+            INSERT INTO users (telegram_id, username, balance)
+            SELECT 1000 + i, 'user' || i, $2 FROM generate_series(1, $1) AS i
+        """, users, balance)
+        await conn.execute("ANALYZE")
+    finally:
+        await conn.close()
+
+
+async def check_stock(dsn, stock):
+    """
+    Проверяет, что товар не продан сверх остатка: по каждому товару проданное,
+    лежащее в корзинах и оставшееся на складе в сумме равно начальному остатку.
+    """
+    conn = await asyncpg.connect(dsn)
+    try:
+        return await conn.fetch("""
+            SELECT g.id, g.quantity,
+                   COALESCE((SELECT SUM(quantity) FROM order_items WHERE product_id = g.id), 0) AS sold,
+                   COALESCE((SELECT SUM(quantity) FROM carts WHERE product_id = g.id), 0) AS in_carts
+            FROM goods g
+            WHERE g.quantity < 0
+               OR g.quantity
+                  + COALESCE((SELECT SUM(quantity) FROM order_items WHERE product_id = g.id), 0)
+                  + COALESCE((SELECT SUM(quantity) FROM carts WHERE product_id = g.id), 0) <> $1
+        """, stock)
+    finally:
+        await conn.close()
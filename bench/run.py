@@ -0,0 +1,297 @@
+"""
+Нагрузочный бенчмарк пользовательского бота.
+
+Тысячи смоделированных покупателей проходят сценарий /start → каталог →
+"Купить" → количество → корзина → оформление против локальной замены Bot API
+(fake_telegram.py) и одноразовой базы PostgreSQL (postgres.py).
+
+Режимы:
+    inprocess — апдейты передаются прямо в dp.process_update из app/bot.py;
+                дополнительно считаются время каждого хендлера и число запросов к базе;
+    polling   — bot.py запускается отдельным процессом и забирает апдейты через getUpdates;
+    webhook   — bot.py запускается в режиме webhook с --workers процессами.
+
+Пример:
+    python bench/run.py --users 2000 --concurrency 200 --output bench/results/base.json
+    python bench/run.py --users 2000 --compare bench/results/base.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'app')
+sys.path.insert(0, APP_DIR)
+
+from fake_telegram import FakeTelegram
+from scenario import ShopUser, StepFailed
+from postgres import throwaway_postgres, app_env, prepare_database, check_stock
+
+FIRST_USER_ID = 1001
+BOT_TOKEN = '123456:bench-token'
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def at(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+
+    return {'count': len(samples), 'p50_ms': at(0.50), 'p95_ms': at(0.95), 'p99_ms': at(0.99)}
+
+
+def bot_env(args, dsn, fake_url):
+    env = dict(os.environ, **app_env(dsn), BOT_TOKEN=BOT_TOKEN, TELEGRAM_API_URL=fake_url)
+    if not args.respect_limits:
+        # Лимиты Telegram не проверяются: меряем сам бот, а не очередь отправки
+        env.update(SEND_GLOBAL_RATE='1000000', SEND_CHAT_RATE='1000000', SEND_CHAT_BURST='1000000')
+    return env
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise SystemExit(f"Бот не открыл порт {port}")
+
+
+class InProcessBot:
+    """bot.py, загруженный в процесс бенчмарка."""
+
+    def __init__(self, env):
+        os.environ.update(env)
+        import bot as shop
+        import metrics
+        from aiogram import Bot, Dispatcher
+        from aiogram.dispatcher.middlewares import BaseMiddleware
+
+        self.shop = shop
+        self.metrics = metrics
+        self.handler_samples = {}
+        self.tasks = set()
+        shop.setup()
+        Bot.set_current(shop.bot)
+        Dispatcher.set_current(shop.dp)
+
+        samples = self.handler_samples
+
+        class TimingMiddleware(BaseMiddleware):
+            async def _start(self, data):
+                data['_bench'] = time.perf_counter()
+
+            async def _finish(self, data):
+                # Имя берём в конце: маршрутизатор нажатий уточняет его уже внутри хендлера
+                if '_bench' in data:
+                    name = metrics.current_handler_name()
+                    samples.setdefault(name, []).append(time.perf_counter() - data['_bench'])
+
+            async def on_process_message(self, message, data):
+                await self._start(data)
+
+            async def on_post_process_message(self, message, results, data):
+                await self._finish(data)
+
+            async def on_process_callback_query(self, callback_query, data):
+                await self._start(data)
+
+            async def on_post_process_callback_query(self, callback_query, results, data):
+                await self._finish(data)
+
+            async def on_process_inline_query(self, inline_query, data):
+                await self._start(data)
+
+            async def on_post_process_inline_query(self, inline_query, results, data):
+                await self._finish(data)
+
+        shop.dp.middleware.setup(TimingMiddleware())
+
+    async def start(self):
+        await self.shop.on_startup()
+
+    async def send(self, update):
+        from aiogram import types
+        task = asyncio.create_task(self.shop.dp.process_update(types.Update(**update)))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def query_count(self):
+        return sum(series[2] for series in self.metrics.query_latency.values.values())
+
+    async def stop(self):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+        await self.shop.on_shutdown()
+
+
+class SubprocessBot:
+    """bot.py, запущенный отдельным процессом в режиме polling или webhook."""
+
+    def __init__(self, env, fake, mode, workers):
+        self.fake = fake
+        self.mode = mode
+        self.env = dict(env)
+        self.port = None
+        self.session = None
+        if mode == 'webhook':
+            self.port = _free_port()
+            self.env.update(WEBHOOK_URL='http://127.0.0.1', WEBHOOK_HOST='127.0.0.1',
+                            WEBHOOK_PORT=str(self.port), WEBHOOK_WORKERS=str(workers))
+        self.process = None
+
+    async def start(self):
+        self.process = subprocess.Popen([sys.executable, os.path.join(APP_DIR, 'bot.py')], cwd=APP_DIR, env=self.env)
+        if self.mode == 'webhook':
+            await _wait_port(self.port)
+            self.session = aiohttp.ClientSession()
+
+    async def send(self, update):
+        if self.mode == 'polling':
+            self.fake.updates.put_nowait(update)
+        else:
+            async with self.session.post(f'http://127.0.0.1:{self.port}/webhook', json=update) as response:
+                response.raise_for_status()
+
+    def query_count(self):
+        return None
+
+    async def stop(self):
+        if self.session:
+            await self.session.close()
+        self.process.terminate()
+        await asyncio.get_running_loop().run_in_executor(None, self.process.wait)
+
+
+async def run(args):
+    fake = FakeTelegram(latency=args.api_latency / 1000)
+    fake_url = await fake.start()
+
+    with throwaway_postgres() as dsn:
+        await prepare_database(dsn, args.products, args.stock, args.users, args.balance)
+        env = bot_env(args, dsn, fake_url)
+        if args.mode == 'inprocess':
+            target = InProcessBot(env)
+        else:
+            target = SubprocessBot(env, fake, args.mode, args.workers)
+        await target.start()
+
+        timings = {}
+        users = {}
+        sent = 0
+
+        async def send(update):
+            nonlocal sent
+            sent += 1
+            await target.send(update)
+
+        fake.on_message = lambda chat_id, message: users[chat_id].inbox.put_nowait(message) if chat_id in users else None
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        failures = {}
+
+        async def simulate(user_id):
+            async with semaphore:
+                user = users[user_id] = ShopUser(user_id, send, timings)
+                try:
+                    await user.run()
+                except StepFailed as e:
+                    failures[e.args[0]] = failures.get(e.args[0], 0) + 1
+                return user
+
+        queries_before = target.query_count()
+        started = time.perf_counter()
+        finished = await asyncio.gather(*(simulate(FIRST_USER_ID + i) for i in range(args.users)))
+        duration = time.perf_counter() - started
+        queries = target.query_count()
+
+        await target.stop()
+        oversold = await check_stock(dsn, args.stock)
+
+    await fake.stop()
+
+    result = {
+        'config': vars(args),
+        'duration_s': round(duration, 3),
+        'updates': sent,
+        'updates_per_s': round(sent / duration, 1),
+        'db_queries_per_update': round((queries - queries_before) / sent, 2) if queries is not None else None,
+        'api_calls': dict(fake.calls),
+        'sold_out_users': sum(user.sold_out for user in finished),
+        'failed_steps': failures,
+        'oversold_products': [dict(row) for row in oversold],
+        'steps': {name: percentiles(samples) for name, samples in timings.items()},
+        'handlers': ({name: percentiles(samples) for name, samples in target.handler_samples.items()}
+                     if isinstance(target, InProcessBot) else None),
+    }
+    return result
+
+
+def compare(result, baseline):
+    print(f"{'':24}{'было':>12}{'стало':>12}{'изменение':>12}")
+
+    def row(name, old, new):
+        if old is None or new is None:
+            return
+        change = (new - old) / old * 100 if old else 0
+        print(f"{name:24}{old:>12}{new:>12}{change:>11.1f}%")
+
+    row('updates/s', baseline['updates_per_s'], result['updates_per_s'])
+    row('запросов на апдейт', baseline.get('db_queries_per_update'), result.get('db_queries_per_update'))
+    for section in ('steps', 'handlers'):
+        for name, stats in (result.get(section) or {}).items():
+            old = (baseline.get(section) or {}).get(name)
+            if stats and old:
+                row(f'{name} p95, мс', old['p95_ms'], stats['p95_ms'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('inprocess', 'polling', 'webhook'), default='inprocess')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='процессов в режиме webhook')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100, help='одновременно активных покупателей')
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--stock', type=int, default=1000000, help='начальный остаток каждого товара')
+    parser.add_argument('--balance', type=int, default=1000000, help='начальный баланс покупателей')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='задержка fake Bot API, мс')
+    parser.add_argument('--respect-limits', action='store_true', help='не отключать лимиты очереди отправки')
+    parser.add_argument('--output', help='куда сохранить результат в JSON')
+    parser.add_argument('--compare', help='JSON предыдущего запуска для сравнения')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(result, json.load(file))
+
+    if result['oversold_products']:
+        raise SystemExit("Товар продан сверх остатка")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Бенчмарк статистики продаж админ-бота (/stats).
+
+Заполняет базу --orders заказами за --days последних дней (1–4 позиции из
+--products товаров), затем:
+  1. сворачивает их в сводные таблицы через sales.fold_sales и меряет скорость;
+  2. сверяет сводки с заказами через sales.rebuild_sales (расхождений быть не должно);
+  3. добавляет --pending ещё не свёрнутых заказов за сегодня и --repeat раз
+     выполняет запросы /stats за 7, 30 и 60 дней по сводкам и для сравнения
+     по сырым orders/order_items.
+Завершается с ошибкой, если сверка нашла расхождения или результаты по
+сводкам и по сырым таблицам отличаются.
+
+Пример:
+    python bench/sales.py --orders 500000 --days 365
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+
+import asyncpg
+
+import sales
+
+from postgres import throwaway_postgres, prepare_database
+from run import percentiles
+
+FIRST_USER_ID = 1001
+PERIODS = (7, 30, 60)
+
+# /stats без сводок: агрегация всех позиций заказов за период
+RAW_DAILY = """
+    SELECT o.created_at::date AS day, COUNT(*)::int AS orders, COALESCE(SUM(i.units), 0)::int AS units,
+           SUM(o.total_price) AS revenue
+    FROM orders o
+    LEFT JOIN LATERAL (SELECT SUM(quantity) AS units FROM order_items WHERE order_id = o.id) i ON true
+    WHERE o.created_at >= $1
+    GROUP BY 1
+    ORDER BY 1
+"""
+
+RAW_TOP_PRODUCTS = """
+    SELECT COALESCE(oi.product_id, 0) AS product_id, COUNT(DISTINCT o.id)::int AS orders,
+           SUM(oi.quantity)::int AS units, SUM(oi.total_price) AS revenue
+    FROM orders o
+    JOIN order_items oi ON oi.order_id = o.id
+    WHERE o.created_at >= $1
+    GROUP BY 1
+    ORDER BY revenue DESC, product_id
+    LIMIT $2
+"""
+
+
+async def seed_orders(dsn, count, days, products, users, first_id, now):
+    """Заказы со случайным временем за days дней до now и позиции к ним (1% — удалённые товары)."""
+    orders, items = [], []
+    for order_id in range(first_id, first_id + count):
+        created_at = now - timedelta(seconds=random.uniform(0, days * 24 * 60 * 60))
+        total = 0
+        for product_id in random.sample(range(1, products + 1), random.randint(1, 4)):
+            quantity, price = random.randint(1, 3), 100 + product_id % 900
+            total += quantity * price
+            items.append((order_id, None if random.random() < 0.01 else product_id, f'Товар {product_id}',
+                          quantity, price, quantity * price))
+        orders.append((order_id, FIRST_USER_ID + order_id % users, total, created_at))
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.copy_records_to_table('orders', records=orders, columns=('id', 'user_id', 'total_price', 'created_at'))
+        await conn.copy_records_to_table('order_items', records=items, columns=(
+            'order_id', 'product_id', 'product_name', 'quantity', 'price', 'total_price'))
+        await conn.execute("SELECT setval('orders_id_seq', (SELECT MAX(id) FROM orders))")
+        await conn.execute("ANALYZE orders; ANALYZE order_items")
+    finally:
+        await conn.close()
+    return len(items)
+
+
+async def timed(samples, coro):
+    started = time.perf_counter()
+    result = await coro
+    samples.append(time.perf_counter() - started)
+    return result
+
+
+async def run(args):
+    random.seed(args.seed)
+    with throwaway_postgres() as dsn:
+        await prepare_database(dsn, args.products, 0, args.users, 0)
+        now = datetime.now()
+        item_count = await seed_orders(dsn, args.orders, args.days, args.products, args.users, 1, now)
+        pool = await asyncpg.create_pool(dsn, min_size=1, max_size=2)
+
+        # 1. Свёртка истории
+        started = time.perf_counter()
+        folded = 0
+        while batch := await sales.fold_sales(pool, args.fold_batch):
+            folded += batch
+        fold_duration = time.perf_counter() - started
+        async with pool.acquire() as conn:
+            await conn.execute("ANALYZE")
+
+        # 2. Сверка с заказами
+        started = time.perf_counter()
+        mismatches = await sales.rebuild_sales(pool)
+        rebuild_duration = time.perf_counter() - started
+
+        # 3. Запросы /stats при наличии несвёрнутых заказов
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        await seed_orders(dsn, args.pending, 0, args.products, args.users, args.orders + 1, now)
+        async with pool.acquire() as conn:
+            pending = await conn.fetchval("SELECT COUNT(*) FROM orders WHERE NOT aggregated AND created_at >= $1", today)
+
+        queries, differences = {}, []
+        for days in PERIODS:
+            aggregated, raw = [], []
+            start = sales.period_start(days, now.date())
+            for _ in range(args.repeat):
+                daily = await timed(aggregated, sales.daily_sales(pool, days))
+                top = await timed(aggregated, sales.top_products(pool, days, 10))
+                async with pool.acquire() as conn:
+                    raw_daily = await timed(raw, conn.fetch(RAW_DAILY, start))
+                    raw_top = await timed(raw, conn.fetch(RAW_TOP_PRODUCTS, start, 10))
+            if [tuple(row) for row in daily] != [tuple(row) for row in raw_daily]:
+                differences.append(f'daily {days}')
+            if [(row['product_id'], row['orders'], row['units'], row['revenue']) for row in top] != [tuple(row) for row in raw_top]:
+                differences.append(f'top {days}')
+            queries[f'{days}_days'] = {
+                'orders': sum(row['orders'] for row in daily),
+                'aggregates': percentiles(aggregated),
+                'raw_tables': percentiles(raw),
+            }
+        await pool.close()
+
+    return {
+        'config': vars(args),
+        'order_items': item_count,
+        'fold_orders_per_s': round(folded / fold_duration, 1),
+        'rebuild_s': round(rebuild_duration, 3),
+        'rebuild_mismatches': mismatches,
+        'pending_orders_today': pending,
+        'stats_queries': queries,
+        'differences': differences,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=500000)
+    parser.add_argument('--days', type=int, default=365, help='за сколько последних дней распределены заказы')
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--pending', type=int, default=500, help='несвёрнутых заказов за сегодня')
+    parser.add_argument('--fold-batch', type=int, default=1000, help='заказов за одну свёртку')
+    parser.add_argument('--repeat', type=int, default=20, help='повторов каждого запроса /stats')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result['rebuild_mismatches'] or result['differences']:
+        raise SystemExit("Статистика по сводкам расходится с заказами")
+
+
+if __name__ == '__main__':
+    main()
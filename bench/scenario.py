@@ -0,0 +1,116 @@
+import time
+import random
+import asyncio
+import itertools
+
+# Сколько ждать ответа бота на один шаг сценария
+STEP_TIMEOUT = 30.0
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def message_update(user_id, text):
+    message = {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def callback_update(user_id, message, data):
+    return {'update_id': next(_update_ids), 'callback_query': {
+        'id': f'{user_id}:{next(_update_ids)}',
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'},
+        'message': message,
+        'chat_instance': str(user_id),
+        'data': data,
+    }}
+
+
+def find_buttons(message, text):
+    return [button['callback_data']
+            for row in message.get('reply_markup', {}).get('inline_keyboard', [])
+            for button in row
+            if text in button['text'] and 'callback_data' in button]
+
+
+def find_button(message, text):
+    buttons = find_buttons(message, text)
+    return buttons[0] if buttons else None
+
+
+def contains(*texts):
+    return lambda message: any(text in (message.get('text') or message.get('caption') or '') for text in texts)
+
+
+def has_button(text):
+    return lambda message: find_button(message, text) is not None
+
+
+class StepFailed(Exception):
+    pass
+
+
+class ShopUser:
+    """
+    Покупатель: /start → каталог → "Купить" → количество → корзина → оформление.
+
+    Апдейты отправляются функцией send(update), сообщения бота приходят в inbox.
+    Время каждого шага (от апдейта до нужного ответа бота) пишется в timings.
+    Если товар закончился, покупатель отменяет покупку и завершает сценарий.
+    """
+
+    def __init__(self, user_id, send, timings):
+        self.user_id = user_id
+        self.send = send
+        self.timings = timings
+        self.inbox = asyncio.Queue()
+        self.sold_out = False
+
+    async def step(self, name, update, expect):
+        started = time.perf_counter()
+        await self.send(update)
+        deadline = started + STEP_TIMEOUT
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise StepFailed(name)
+            try:
+                message = await asyncio.wait_for(self.inbox.get(), remaining)
+            except asyncio.TimeoutError:
+                raise StepFailed(name)
+            if expect(message):
+                self.timings.setdefault(name, []).append(time.perf_counter() - started)
+                return message
+
+    async def run(self):
+        user = self.user_id
+        await self.step('start', message_update(user, '/start'), contains('Привет'))
+        catalog = await self.step('catalog', message_update(user, '🔍Каталог'), has_button('Купить'))
+        buy = random.choice(find_buttons(catalog, 'Купить'))
+        prompt = await self.step('buy', callback_update(user, catalog, buy), contains('Сколько', 'закончился'))
+        if 'закончился' in (prompt.get('text') or ''):
+            self.sold_out = True
+            return
+        reply = await self.step('quantity', message_update(user, '1'), contains('корзин', 'На складе'))
+        if 'На складе' in reply['text']:
+            self.sold_out = True
+            await self.send(message_update(user, 'отмена'))
+            return
+        cart = await self.step('cart', message_update(user, '🛒Корзина'), has_button('Оформить'))
+        # Кнопки корзины редактируют то же сообщение: ещё одна единица и обратно. Если товар
+        # закончился, бот отвечает уведомлением, а корзина остаётся прежней
+        increased = await self.step('cart_increase', callback_update(user, cart, find_button(cart, '➕')),
+                                    contains('× 2', 'Больше этого товара'))
+        if has_button('Оформить')(increased):
+            cart = increased
+            if has_button('➖')(cart):
+                cart = await self.step('cart_decrease', callback_update(user, cart, find_button(cart, '➖')), contains('× 1'))
+        await self.step('checkout', callback_update(user, cart, find_button(cart, 'Оформить')),
+                        contains('оформлен', 'Недостаточно', 'Некоторых товаров'))
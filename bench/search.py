@@ -0,0 +1,158 @@
+"""
+Бенчмарк inline-поиска товаров.
+
+Заполняет базу --products товарами со случайными названиями и описаниями из
+словаря, затем:
+  1. выполняет --queries поисковых запросов напрямую через bot.search_goods
+     (без кэша) и меряет задержку запроса к базе;
+  2. отправляет столько же inline-апдейтов через dp.process_update с
+     --concurrency одновременно и меряет время хендлера search_products
+     (с кэшем результатов, запросы повторяются как у живых пользователей).
+С --foreign-file-ids замена Bot API не принимает file_id фото (их сохранил
+другой бот), и хендлер должен отвечать фото по ссылкам. Завершается с ошибкой,
+если p95 поиска без кэша больше --target-ms или ответ получили не все запросы.
+
+Пример:
+    python bench/search.py --products 100000 --queries 2000
+"""
+import os
+import sys
+import json
+import random
+import asyncio
+import argparse
+import itertools
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+
+import asyncpg
+from aiogram import types
+
+import cache
+
+from fake_telegram import FakeTelegram
+from postgres import throwaway_postgres, prepare_database
+from run import InProcessBot, bot_env, percentiles
+
+ADJECTIVES = ['красный', 'синий', 'зелёный', 'чёрный', 'белый', 'большой', 'маленький', 'новый', 'умный',
+              'быстрый', 'тихий', 'лёгкий', 'прочный', 'мягкий', 'тёплый', 'складной', 'беспроводной', 'детский']
+NOUNS = ['телефон', 'чехол', 'наушники', 'кабель', 'зарядка', 'колонка', 'часы', 'рюкзак', 'кружка', 'лампа',
+         'клавиатура', 'мышь', 'монитор', 'планшет', 'фонарик', 'термос', 'зонт', 'кресло', 'стол', 'подушка',
+         'плед', 'чайник', 'утюг', 'фен', 'пылесос', 'самокат', 'велосипед', 'шлем', 'перчатки', 'куртка']
+BRANDS = ['samsung', 'xiaomi', 'apple', 'huawei', 'sony', 'philips', 'bosch', 'lenovo', 'asus', 'acer',
+          'logitech', 'jbl', 'anker', 'baseus', 'tefal', 'braun', 'redmond', 'polaris', 'vitek', 'scarlett']
+FILLER = ['отличный', 'подарок', 'для', 'дома', 'офиса', 'путешествий', 'гарантия', 'год', 'доставка', 'быстрая',
+          'качество', 'материал', 'пластик', 'металл', 'ткань', 'комплект', 'цвет', 'размер', 'удобный', 'надёжный']
+
+_update_ids = itertools.count(1)
+
+
+async def seed(dsn, products):
+    records = []
+    for i in range(1, products + 1):
+        name = f"{random.choice(ADJECTIVES)} {random.choice(NOUNS)} {random.choice(BRANDS)} {i}"
+        description = ' '.join(random.choices(FILLER + NOUNS, k=12))
+        # У половины товаров уже есть file_id фото в Telegram
+        records.append((name, description, 1 + i % 100, 100 + i % 9900,
+                        f'https://example.com/{i}.jpg', f'file-{i}' if i % 2 == 0 else None))
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.copy_records_to_table('goods', records=records, columns=(
+            'name', 'description', 'quantity', 'price', 'image_url', 'telegram_file_id'))
+        await conn.execute("ANALYZE goods")
+    finally:
+        await conn.close()
+
+
+def random_query():
+    """Одно-два слова, второе часто недописано, как при наборе."""
+    words = [random.choice(NOUNS + BRANDS + ADJECTIVES) for _ in range(random.choice((1, 1, 2)))]
+    words[-1] = words[-1][:random.randint(2, len(words[-1]))]
+    return ' '.join(words)
+
+
+def inline_update(user_id, query, offset=''):
+    return {'update_id': next(_update_ids), 'inline_query': {
+        'id': str(next(_update_ids)),
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+        'query': query,
+        'offset': offset,
+    }}
+
+
+async def run(args):
+    random.seed(args.seed)
+    fake = FakeTelegram()
+    fake.file_ids_accepted = not args.foreign_file_ids
+    fake_url = await fake.start()
+
+    with throwaway_postgres() as dsn:
+        await prepare_database(dsn, 0, 0, 0, 0)
+        await seed(dsn, args.products)
+        target = InProcessBot(bot_env(argparse.Namespace(respect_limits=False), dsn, fake_url))
+        await target.start()
+        shop = target.shop
+
+        queries = [random_query() for _ in range(args.distinct_queries)]
+
+        # 1. Запросы к базе без кэша: первая страница и следующая за ней
+        direct, next_pages, found = [], [], 0
+        for _ in range(args.queries):
+            query = shop.normalize_query(random.choice(queries))
+            started = asyncio.get_running_loop().time()
+            goods = await shop.search_goods(query)
+            direct.append(asyncio.get_running_loop().time() - started)
+            found += bool(goods)
+            if len(goods) > shop.SEARCH_PAGE_SIZE:
+                started = asyncio.get_running_loop().time()
+                await shop.search_goods(query, goods[shop.SEARCH_PAGE_SIZE - 1]['id'])
+                next_pages.append(asyncio.get_running_loop().time() - started)
+
+        # 2. Inline-апдейты через хендлер с кэшем
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def send(i):
+            async with semaphore:
+                await shop.dp.process_update(types.Update(**inline_update(1000 + i, random.choice(queries))))
+
+        await asyncio.gather(*(send(i) for i in range(args.queries)))
+        await target.stop()
+
+    await fake.stop()
+    hits = cache.cache_hits.values.get(('search',), 0)
+    misses = cache.cache_misses.values.get(('search',), 0)
+    return {
+        'config': vars(args),
+        'db_first_page': percentiles(direct),
+        'db_next_page': percentiles(next_pages),
+        'queries_with_results': round(found / args.queries, 3),
+        'handler': percentiles(target.handler_samples.get('search_products', [])),
+        'cache_hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+        'answer_inline_query_calls': fake.calls.get('answerinlinequery', 0),
+        'rejected_answers': fake.rejected_answers,
+        'answered': fake.calls.get('answerinlinequery', 0) - fake.rejected_answers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--distinct-queries', type=int, default=500, help='различных запросов (повторы попадают в кэш)')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--target-ms', type=float, default=50.0, help='допустимый p95 поиска без кэша')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--foreign-file-ids', action='store_true', help='Bot API не принимает сохранённые file_id фото')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result['db_first_page']['p95_ms'] > args.target_ms:
+        raise SystemExit(f"p95 поиска {result['db_first_page']['p95_ms']} мс больше {args.target_ms} мс")
+    if result['answered'] != args.queries:
+        raise SystemExit(f"Ответ получили {result['answered']} из {args.queries} inline-запросов")
+
+
+if __name__ == '__main__':
+    main()
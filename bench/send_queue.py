@@ -0,0 +1,110 @@
+"""
+Бенчмарк очереди отправки бота (app/sender.py) при ответах 429.
+
+Локальная замена Bot API отвечает 429 с retry_after на каждую --flood-every-ю
+отправку в чат и на все отправки в этот чат до конца паузы. Бот одновременно
+отправляет в --chats чатов по --messages текстовых сообщений и массовой
+рассылкой в столько же других чатов по --photos фото. Проверяется, что после
+повторной постановки в очередь сообщения каждого чата доставлены по одному
+разу и по порядку, а фото объединены в альбомы sendMediaGroup не больше чем по
+10. Завершается с ошибкой при нарушении порядка, потерях, повторах или лишних
+вызовах.
+
+Пример:
+    python bench/send_queue.py --chats 20 --messages 20 --photos 45 --flood-every 3
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+
+from sender import ALBUM_SIZE, ThrottledBot, bulk_sends
+
+from fake_telegram import FakeTelegram
+from run import BOT_TOKEN
+
+FIRST_CHAT_ID = 1001
+
+
+def expected_calls(photos):
+    """(sendMediaGroup, sendPhoto) на один чат: одиночное фото в конце уходит через sendPhoto."""
+    albums, rest = divmod(photos, ALBUM_SIZE)
+    return albums + (rest > 1), int(rest == 1)
+
+
+async def run(args):
+    fake = FakeTelegram(latency=args.api_latency)
+    fake.flood_every = args.flood_every
+    fake.retry_after = args.retry_after
+    fake_url = await fake.start()
+    delivered = defaultdict(list)
+    fake.on_message = lambda chat_id, message: delivered[chat_id].append(message.get('text') or message.get('caption'))
+
+    os.environ['TELEGRAM_API_URL'] = fake_url
+    bot = ThrottledBot(token=BOT_TOKEN, global_rate=args.global_rate, chat_rate=args.chat_rate, chat_burst=args.chat_rate)
+    text_chats = range(FIRST_CHAT_ID, FIRST_CHAT_ID + args.chats)
+    photo_chats = range(FIRST_CHAT_ID + args.chats, FIRST_CHAT_ID + 2 * args.chats)
+
+    # Все сообщения чата ставятся в очередь сразу, в порядке номеров
+    async def send_texts(chat_id):
+        return await asyncio.gather(*(bot.send_message(chat_id, str(n)) for n in range(args.messages)),
+                                    return_exceptions=True)
+
+    async def send_photos(chat_id):
+        with bulk_sends():
+            return await asyncio.gather(*(bot.send_photo(chat_id, f'photo-{n}', caption=str(n)) for n in range(args.photos)),
+                                        return_exceptions=True)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(send_texts(chat_id) for chat_id in text_chats),
+                                   *(send_photos(chat_id) for chat_id in photo_chats))
+    duration = time.perf_counter() - started
+    await (await bot.get_session()).close()
+    await fake.stop()
+
+    def misordered(chats, count):
+        return sum(1 for chat_id in chats if delivered[chat_id] != [str(n) for n in range(count)])
+
+    albums, single_photos = expected_calls(args.photos)
+    calls = {method: fake.calls[method] - fake.flood_errors[method] for method in ('sendmessage', 'sendphoto', 'sendmediagroup')}
+    return {
+        'config': vars(args),
+        'duration_s': round(duration, 3),
+        'retry_after_responses': dict(fake.flood_errors),
+        'failed_sends': sum(1 for chat in results for result in chat if isinstance(result, Exception)),
+        'misordered_text_chats': misordered(text_chats, args.messages),
+        'misordered_photo_chats': misordered(photo_chats, args.photos),
+        'accepted_calls': calls,
+        'expected_calls': {'sendmessage': args.chats * args.messages, 'sendphoto': args.chats * single_photos,
+                           'sendmediagroup': args.chats * albums},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=20, help='чатов с текстовыми сообщениями (и столько же с фото)')
+    parser.add_argument('--messages', type=int, default=20, help='текстовых сообщений в чат')
+    parser.add_argument('--photos', type=int, default=45, help='фото в чат')
+    parser.add_argument('--flood-every', type=int, default=3, help='каждая N-я отправка в чат получает 429 (0 — никогда)')
+    parser.add_argument('--retry-after', type=int, default=1, help='пауза в ответе 429, с')
+    parser.add_argument('--global-rate', type=float, default=1000, help='лимит бота в секунду (SEND_GLOBAL_RATE)')
+    parser.add_argument('--chat-rate', type=float, default=100, help='лимит на чат в секунду (SEND_CHAT_RATE и SEND_CHAT_BURST)')
+    parser.add_argument('--api-latency', type=float, default=0.005, help='задержка ответа Bot API, с')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result['failed_sends'] or result['misordered_text_chats'] or result['misordered_photo_chats']:
+        raise SystemExit("Сообщения потеряны, повторены или доставлены не по порядку")
+    if result['accepted_calls'] != result['expected_calls']:
+        raise SystemExit("Фото не объединены в альбомы")
+
+
+if __name__ == '__main__':
+    main()
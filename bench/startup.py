@@ -0,0 +1,280 @@
+"""
+Бенчмарк запуска бота и задержки горячих запросов.
+
+Сравнивает прежнюю работу с базой (пул asyncpg с настройками по умолчанию:
+запрос разбирается и планируется при первом выполнении на каждом соединении)
+и общий слой app/db.py (соединения открываются при запуске, а горячие запросы
+готовятся на них в фоне после запуска, как в bot.py). Для каждого варианта
+--restarts раз:
+  1. создаёт пул: подключение, проверка миграций; для общего слоя отдельно
+     меряет фоновую подготовку запросов и дожидается её;
+  2. выполняет каждый горячий запрос на каждом соединении пула (все соединения
+     одновременно) — так первые апдейты после запуска попадают на новые соединения;
+  3. повторяет то же --repeat раз (установившийся режим).
+Кроме того, меряет импорт bot.py и создание бота и диспетчера в отдельном процессе.
+Изменяющие запросы выполняются в транзакции с откатом. Завершается с ошибкой,
+если после подготовки запросов какое-либо соединение пула осталось в открытой
+транзакции или с блокировками таблиц, или если первые запросы на подготовленных
+соединениях не взяты из кэша подготовленных запросов.
+
+Пример:
+    python bench/startup.py --restarts 10
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime
+from decimal import Decimal
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'app')
+sys.path.insert(0, APP_DIR)
+
+import asyncpg
+
+import db
+import metrics
+from migrate import migrate
+
+from postgres import throwaway_postgres, app_env, prepare_database
+from run import percentiles
+
+FIRST_USER_ID = 1001
+
+# Импорт модуля бота и создание бота и диспетчера в новом процессе (в миллисекундах)
+IMPORT_SCRIPT = """
+import time
+started = time.perf_counter()
+import aiogram
+aiogram_imported = time.perf_counter()
+import bot
+imported = time.perf_counter()
+bot.setup()
+ready = time.perf_counter()
+print((aiogram_imported - started) * 1000, (imported - started) * 1000, (ready - imported) * 1000)
+"""
+
+
+def hot_queries(worker, products):
+    """
+    Запросы одного апдейта каждого раздела: (название, запрос, параметры). У
+    каждого соединения свой пользователь и свой товар, чтобы изменяющие
+    запросы не ждали блокировок друг друга.
+    """
+    user_id, product_id = FIRST_USER_ID + worker, 1 + worker % products
+    return [
+        ('start', db.ADD_USER, (user_id, f'user{worker}')),
+        ('catalog', db.CATALOG_NEXT, (product_id, 6)),
+        ('search', db.SEARCH, ('товар & 12:*', 0, 21)),
+        ('buy', db.PRODUCT, (product_id,)),
+        ('reserve', db.RESERVE, (user_id, product_id, 1, 1800.0)),
+        ('cart', db.CART, (user_id,)),
+        ('cart_decrease', db.DECREASE_CART_ITEM, (user_id, product_id, 1)),
+        ('checkout_lock_user', db.LOCK_USER, (user_id,)),
+        ('checkout_balance', db.BALANCE, (user_id,)),
+        ('checkout_unreserved', db.UNRESERVED_CART_PRODUCTS, (user_id,)),
+        ('checkout_lock_goods', db.LOCK_GOODS, ([product_id],)),
+        ('checkout_cart', db.CHECKOUT_CART, (user_id,)),
+        ('checkout_take_stock', db.TAKE_STOCK, ([product_id], [1])),
+        ('checkout_order', db.CREATE_ORDER, (user_id, Decimal(100))),
+        ('checkout_delete_cart', db.DELETE_CART_ROWS, ([0],)),
+        ('orders', db.ORDERS_PAGE, (user_id, datetime.max, 0, 6)),
+        ('balance', db.USER, (user_id,)),
+    ]
+
+
+async def adhoc_pool():
+    """Пул, как его создавали bot.py и admin.py до общего слоя: метка запроса считалась на каждый запрос."""
+    def log_query(record):
+        metrics.query_latency.observe(record.elapsed, metrics._statement.__wrapped__(record.query))
+
+    async def init(conn):
+        conn.add_query_logger(log_query)
+
+    pool = await asyncpg.create_pool(
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        database=os.getenv('DB_NAME'),
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT'),
+        init=init,
+    )
+    pool = metrics.InstrumentedPool(pool)
+    await migrate(pool)
+    return pool
+
+
+async def shared_pool():
+    """Пул общего слоя, как его создаёт bot.py: подготовка запросов запускается в фоне после создания пула."""
+    pool = await db.create_pool()
+    pool.prewarm_task = asyncio.create_task(db.prewarm_pool(pool))
+    return pool
+
+
+async def cache_misses(pool, products):
+    """Горячие запросы, которых нет в кэше подготовленных запросов свободных соединений пула."""
+    misses = 0
+    connections = [await pool.acquire() for _ in range(pool.get_idle_size())]
+    try:
+        for index, conn in enumerate(connections):
+            # Ключ кэша asyncpg: текст запроса, класс записей и ignore_custom_codec
+            cache, record_class = conn._con._stmt_cache, conn._con._protocol.get_record_class()
+            misses += sum(1 for _, query, _ in hot_queries(index, products) if cache.get((query, record_class, False)) is None)
+    finally:
+        for conn in connections:
+            await pool.release(conn)
+    return misses
+
+
+async def run_round(pool, size, products, samples):
+    """Выполняет горячие запросы на size соединениях одновременно и добавляет их время в samples."""
+    async def worker(index):
+        async with pool.acquire() as conn:
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                for name, query, args in hot_queries(index, products):
+                    started = time.perf_counter()
+                    await conn.fetch(query, *args)
+                    samples.setdefault(name, []).append(time.perf_counter() - started)
+            finally:
+                await transaction.rollback()
+
+    await asyncio.gather(*(worker(index) for index in range(size)))
+
+
+async def open_transactions(monitor):
+    """
+    Соединения базы (кроме monitor), оставшиеся в открытой транзакции или с
+    блокировками таблиц: такие соединения мешают autovacuum и миграциям.
+    """
+    return await monitor.fetchval("""
+        SELECT COUNT(*)::int FROM pg_stat_activity a
+        WHERE a.datname = current_database() AND a.pid <> pg_backend_pid() AND a.backend_type = 'client backend'
+          AND (a.xact_start IS NOT NULL
+               OR EXISTS (SELECT 1 FROM pg_locks l WHERE l.pid = a.pid AND l.locktype = 'relation'))
+    """)
+
+
+async def measure(variants, args, monitor):
+    """
+    Создаёт пул каждого варианта по очереди --restarts раз (чередование
+    уравнивает для вариантов прогрев кэшей PostgreSQL и смену планов) и
+    возвращает результаты по вариантам.
+    """
+    samples = {name: ([], [], {}, {}) for name in variants}
+    leaked = dict.fromkeys(variants, 0)
+    misses = dict.fromkeys(variants, 0)
+    for _ in range(args.restarts):
+        for name, create_pool in variants.items():
+            startup, prewarm, first, steady = samples[name]
+            started = time.perf_counter()
+            pool = await create_pool()
+            startup.append(time.perf_counter() - started)
+            try:
+                prewarm_task = getattr(pool, 'prewarm_task', None)
+                if prewarm_task:
+                    started = time.perf_counter()
+                    await prewarm_task
+                    prewarm.append(time.perf_counter() - started)
+                    misses[name] = max(misses[name], await cache_misses(pool, args.products))
+                # Свободные после запуска соединения не должны держать транзакцию
+                leaked[name] = max(leaked[name], await open_transactions(monitor))
+                size = pool.get_max_size()
+                await run_round(pool, size, args.products, first)
+                for _ in range(args.repeat):
+                    await run_round(pool, size, args.products, steady)
+            finally:
+                await pool.close()
+
+    def total(by_query):
+        # Время всех запросов одного апдейта каждого раздела
+        return [sum(values) for values in zip(*by_query.values())]
+
+    return {name: {
+        'pool_ready': percentiles(startup),
+        'background_prewarm': percentiles(prewarm),
+        'hot_queries_missing_from_cache': misses[name],
+        'connections_in_transaction_after_startup': leaked[name],
+        'first_round_all_queries': percentiles(total(first)),
+        'steady_all_queries': percentiles(total(steady)),
+        'first_round': {query: percentiles(values) for query, values in first.items()},
+        'steady': {query: percentiles(values) for query, values in steady.items()},
+    } for name, (startup, prewarm, first, steady) in samples.items()}
+
+
+def measure_import(repeat):
+    env = dict(os.environ, BOT_TOKEN='1:bench')
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=APP_DIR, env=env,
+                                check=True, capture_output=True, text=True).stdout
+        runs.append([float(value) for value in output.split()])
+    aiogram_ms, import_ms, setup_ms = (sorted(values)[len(values) // 2] for values in zip(*runs))
+    return {'aiogram_import_ms': round(aiogram_ms, 1), 'bot_import_ms': round(import_ms, 1),
+            'setup_ms': round(setup_ms, 1)}
+
+
+async def run(args):
+    with throwaway_postgres() as dsn:
+        await prepare_database(dsn, args.products, 1000000, args.users, 1000000)
+        os.environ.update(app_env(dsn))
+        conn = await asyncpg.connect(dsn)
+        try:
+            # По несколько заказов у каждого пользователя для истории заказов
+            await conn.execute("""
+                WITH created AS (
+                    INSERT INTO orders (user_id, total_price, created_at)
+                    SELECT 1000 + u, 100, now() - (n || ' days')::interval
+                    FROM generate_series(1, $1) AS u, generate_series(1, 8) AS n
+                    RETURNING id
+                )
+                INSERT INTO order_items (order_id, product_id, product_name, quantity, price, total_price)
+                SELECT id, 1 + id % $2, 'Товар', 1, 100, 100 FROM created
+            """, args.users, args.products)
+            await conn.execute("ANALYZE")
+        finally:
+            await conn.close()
+
+        monitor = await asyncpg.connect(dsn)
+        try:
+            results = await measure({'adhoc': adhoc_pool, 'db': shared_pool}, args, monitor)
+        finally:
+            await monitor.close()
+
+    def gain(key):
+        return round(results['adhoc'][key]['p50_ms'] / results['db'][key]['p50_ms'], 2)
+
+    return {
+        'config': vars(args),
+        'import': measure_import(args.import_repeat),
+        'prepared_queries': len(db._prewarm_queries),
+        **results,
+        'first_round_speedup': gain('first_round_all_queries'),
+        'steady_speedup': gain('steady_all_queries'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--restarts', type=int, default=5, help='сколько раз создавать пул')
+    parser.add_argument('--repeat', type=int, default=20, help='раундов установившегося режима после каждого запуска')
+    parser.add_argument('--import-repeat', type=int, default=5, help='запусков процесса для замера импорта')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result['db']['connections_in_transaction_after_startup']:
+        raise SystemExit("Соединения пула остались в открытой транзакции после запуска")
+    if result['db']['hot_queries_missing_from_cache']:
+        raise SystemExit("Горячие запросы не попали в кэш подготовленных запросов")
+
+
+if __name__ == '__main__':
+    main()
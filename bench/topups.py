@@ -0,0 +1,102 @@
+"""
+Бенчмарк пополнений баланса: UPDATE users на месте против журнала balance_ledger.
+
+--topups пополнений выполняются с --concurrency одновременно для --users
+пользователей (чем их меньше, тем сильнее конкуренция за одни и те же строки).
+Режим inplace повторяет прежний хендлер (UPDATE users SET balance = balance + $1),
+режим ledger пишет через ledger.LedgerWriter. После прогона журнал сворачивается
+и проверяется, что сумма балансов равна сумме пополнений.
+
+Пример:
+    python bench/topups.py --topups 20000 --concurrency 200 --users 10
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from decimal import Decimal
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+
+import asyncpg
+
+import ledger
+from postgres import throwaway_postgres, prepare_database
+from run import percentiles
+
+FIRST_USER_ID = 1001
+
+
+async def run_mode(dsn, mode, args):
+    await prepare_database(dsn, 0, 0, args.users, 0)
+    pool = await asyncpg.create_pool(dsn, min_size=args.pool_size, max_size=args.pool_size)
+    writer = ledger.LedgerWriter(pool)
+    writer.start()
+
+    async def top_up(user_id, amount):
+        if mode == 'inplace':
+            async with pool.acquire() as conn:
+                await conn.execute("UPDATE users SET balance = balance + $1 WHERE telegram_id = $2", amount, user_id)
+        else:
+            await writer.append(user_id, amount, 'top_up')
+
+    samples = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    random.seed(1)
+    plan = [(FIRST_USER_ID + random.randrange(args.users), Decimal(random.randint(1, 1000))) for _ in range(args.topups)]
+
+    async def timed_top_up(user_id, amount):
+        async with semaphore:
+            started = time.perf_counter()
+            await top_up(user_id, amount)
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed_top_up(user_id, amount) for user_id, amount in plan))
+    duration = time.perf_counter() - started
+    await writer.close()
+
+    fold_started = time.perf_counter()
+    while await ledger.fold_balances(pool):
+        pass
+    fold_duration = time.perf_counter() - fold_started
+
+    async with pool.acquire() as conn:
+        total = await conn.fetchval("SELECT SUM(balance) FROM users")
+    await pool.close()
+
+    return {
+        'duration_s': round(duration, 3),
+        'topups_per_s': round(args.topups / duration, 1),
+        'latency': percentiles(samples),
+        'fold_s': round(fold_duration, 3) if mode == 'ledger' else None,
+        'balances_match': total == sum(amount for _, amount in plan),
+    }
+
+
+async def run(args):
+    with throwaway_postgres() as dsn:
+        return {mode: await run_mode(dsn, mode, args) for mode in args.modes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--topups', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--users', type=int, default=10, help='пользователей, между которыми распределены пополнения')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--modes', nargs='+', choices=('inplace', 'ledger'), default=['inplace', 'ledger'])
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps({'config': vars(args), **result}, ensure_ascii=False, indent=2))
+    if not all(mode['balances_match'] for mode in result.values()):
+        raise SystemExit("Сумма балансов не совпадает с суммой пополнений")
+
+
+if __name__ == '__main__':
+    main()